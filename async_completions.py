@@ -0,0 +1,269 @@
+import json
+import time
+import random
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tqdm import tqdm
+
+# Status codes worth retrying: rate limited, or the server side failed
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def estimate_tokens(prompt, max_tokens):
+    """Rough token count of a completion request (prompt + budget for the completion), ~4 chars per token"""
+    return len(prompt) // 4 + max_tokens
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute, holding at most capacity tokens
+    (one minute worth by default). acquire() waits until the requested amount is available.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self, amount=1):
+        # A single request larger than the bucket would wait forever
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class RateLimiter:
+    """Requests/min and tokens/min limits; either can be disabled with None"""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    async def acquire(self, n_tokens):
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(n_tokens)
+
+
+class RequestError(Exception):
+    def __init__(self, status, message, retry_after=None):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AsyncCompletionClient:
+    """
+    Concurrent client for the OpenAI completions endpoint (dv3).
+
+    Up to `concurrency` requests of at most `batch_size` prompts are in flight, throttled by a
+    token bucket on requests/min and tokens/min. Failed requests are retried with exponential
+    backoff and full jitter (honouring Retry-After). Prompts that are still missing from a
+    response, or whose batch kept failing, are retried individually, so one bad prompt does not
+    blank the whole batch. Prompts that fail on their own get None, and are not passed to on_result.
+
+    api_base can point to a local stand-in server (see FakeCompletionsServer) for offline tests.
+    """
+
+    def __init__(self,
+                 api_key,
+                 api_base="https://api.openai.com/v1",
+                 model="text-davinci-003",
+                 concurrency=8,
+                 batch_size=8,
+                 requests_per_minute=50,
+                 tokens_per_minute=None,
+                 max_retries=6,
+                 base_delay=1.0,
+                 max_delay=60.0,
+                 timeout=120,
+                 **completion_kwargs):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+        self.model = model
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        # Same decoding parameters as gpt3_generate
+        self.completion_kwargs = dict(temperature=1, max_tokens=100, top_p=1, frequency_penalty=0, presence_penalty=0)
+        self.completion_kwargs.update(completion_kwargs)
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def _post(self, session, prompts):
+        import aiohttp
+        payload = {"model": self.model, "prompt": prompts, **self.completion_kwargs}
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        async with session.post(f"{self.api_base}/completions", json=payload, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+            if resp.status != 200:
+                retry_after = resp.headers.get("Retry-After")
+                raise RequestError(resp.status, await resp.text(), float(retry_after) if retry_after else None)
+            return await resp.json()
+
+    async def _request(self, session, semaphore, limiter, prompts):
+        """Completions for a list of prompts, None for the ones that could not be obtained"""
+        import aiohttp
+        n_tokens = sum(estimate_tokens(prompt, self.completion_kwargs["max_tokens"]) for prompt in prompts)
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire(n_tokens)
+            try:
+                async with semaphore:
+                    response = await self._post(session, prompts)
+                texts = [None] * len(prompts)
+                for choice in response.get("choices", []):
+                    idx = choice.get("index", 0)
+                    if 0 <= idx < len(prompts):
+                        texts[idx] = choice.get("text", "")
+                return texts
+            except RequestError as e:
+                if e.status not in RETRYABLE_STATUS:
+                    print(f"Request failed, not retrying: {e}")
+                    break
+                delay = self._backoff(attempt, e.retry_after)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                delay = self._backoff(attempt)
+            if attempt < self.max_retries:
+                await asyncio.sleep(delay)
+        return [None] * len(prompts)
+
+    async def _complete(self, session, semaphore, limiter, indices, prompts, results, on_result, pbar):
+        texts = await self._request(session, semaphore, limiter, [prompts[i] for i in indices])
+        missing = [i for i, text in zip(indices, texts) if text is None]
+        done = [(i, text) for i, text in zip(indices, texts) if text is not None]
+        if len(missing) > 0 and len(indices) > 1:
+            # Partial failure: retry the missing prompts one by one
+            await asyncio.gather(*[self._complete(session, semaphore, limiter, [i], prompts, results, on_result, pbar) for i in missing])
+        elif len(missing) > 0:
+            print(f"Too many failures, giving up on prompt {missing[0]}")
+        if len(done) > 0:
+            for i, text in done:
+                results[i] = text
+            if on_result is not None:
+                on_result([i for i, _ in done], [text for _, text in done])
+            pbar.update(len(done))
+
+    async def agenerate(self, prompts, on_result=None):
+        """
+        Completion text for every prompt, in order, None for the prompts that failed for good.
+        on_result: called with (indices, texts) of the completed prompts as soon as a request finishes,
+        e.g. to checkpoint results
+        """
+        import aiohttp
+        results = [None] * len(prompts)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+        batches = [list(range(i, min(i + self.batch_size, len(prompts)))) for i in range(0, len(prompts), self.batch_size)]
+        with tqdm(total=len(prompts), desc="dv3...") as pbar:
+            async with aiohttp.ClientSession() as session:
+                await asyncio.gather(*[self._complete(session, semaphore, limiter, batch, prompts, results, on_result, pbar) for batch in batches])
+        return results
+
+    def generate(self, prompts, on_result=None):
+        return asyncio.run(self.agenerate(prompts, on_result=on_result))
+
+
+class FakeCompletionsServer:
+    """
+    Local stand-in for the completions endpoint, for testing without network or API key.
+    Answers POST <url>/completions with one choice per prompt ("RESPONSE: <prompt tail>").
+    failure_rate: fraction of requests answered with 429 (rate limited) instead.
+    fail_marker: prompts containing it always make the request fail with 500.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, failure_rate=0.0, fail_marker=None, latency=0.0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, obj):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                prompts = payload["prompt"]
+                if isinstance(prompts, str):
+                    prompts = [prompts]
+                with server.lock:
+                    server.n_requests += 1
+                time.sleep(server.latency)
+                if server.fail_marker is not None and any(server.fail_marker in prompt for prompt in prompts):
+                    return self._send(500, {"error": {"message": "internal error"}})
+                if random.random() < server.failure_rate:
+                    return self._send(429, {"error": {"message": "rate limited"}})
+                choices = [{"text": f"RESPONSE: {prompt[-20:]}", "index": i, "finish_reason": "stop"} for i, prompt in enumerate(prompts)]
+                self._send(200, {"object": "text_completion", "model": payload.get("model"), "choices": choices})
+
+        self.failure_rate = failure_rate
+        self.fail_marker = fail_marker
+        self.latency = latency
+        self.n_requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# Unit Test
+if __name__ == "__main__":
+    prompts = [f"User: hello number {i}\n Bot:" for i in range(200)] + ["User: FAIL ME\n Bot:"]
+    with FakeCompletionsServer(failure_rate=0.2, fail_marker="FAIL ME", latency=0.05) as server:
+        client = AsyncCompletionClient("sk-test", api_base=server.url, concurrency=16,
+                                       requests_per_minute=6000, tokens_per_minute=10**7,
+                                       base_delay=0.05, max_delay=0.5)
+        start = time.time()
+        texts = client.generate(prompts)
+        print(f"{len(prompts)} prompts in {time.time() - start:.2f}s, {server.n_requests} requests")
+
+    assert texts[-1] is None, "Prompt failing on its own should be reported as failed"
+    for prompt, text in zip(prompts[:-1], texts[:-1]):
+        assert text == f"RESPONSE: {prompt[-20:]}", (prompt, text)
+    print("OK")
@@ -1,14 +1,21 @@
 
+import torch
 from transformers import AutoTokenizer,BlenderbotTokenizerFast
 
+from torch.utils.data import Sampler
 from torch.utils.data.dataset import IterableDataset,Dataset
         
 class GenericDataset(Dataset):
 
-    def __init__(self, model_name_or_path: str, examples,max_seq_length=512):
+    def __init__(self, model_name_or_path: str, examples,max_seq_length=512,tokenizer=None,dynamic_padding=False):
         super(GenericDataset, self).__init__()
         
-        if model_name_or_path=="facebook/blenderbot-3B":
+        if tokenizer is not None:
+            # Reuse the generation tokenizer instead of reloading it for every run
+            self.tokenizer=tokenizer
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token=self.tokenizer.eos_token
+        elif model_name_or_path=="facebook/blenderbot-3B":
             self.tokenizer = BlenderbotTokenizerFast.from_pretrained(model_name_or_path)
             self.tokenizer.add_prefix_space=False
         else:
@@ -18,8 +25,11 @@ class GenericDataset(Dataset):
         
         self.examples=examples
         self.max_seq_length=max_seq_length
+        # With dynamic padding every instance keeps its own length, batches are padded by the collate function
+        self.dynamic_padding=dynamic_padding
+        self._input_ids=None
     def __getitem__(self,idx):
-        return self.parse_data(self.examples[idx])
+        return self.parse_data(self.examples[idx],idx)
     '''def __iter__(self):
         for example in self.examples:
             try:
@@ -33,11 +43,32 @@ class GenericDataset(Dataset):
     
     def __len__(self):
         return len(self.examples)
+
+    def _prompt(self,example):
+        return example["prompt"] if type(example)==dict else example
+
+    def lengths(self):
+        """Token length of every example (after truncation), used for length bucketing.
+        The token ids are kept so that the examples are not tokenized a second time in parse_data.
+        """
+        if self._input_ids is None:
+            prompts=[self._prompt(example) for example in self.examples]
+            self._input_ids=self.tokenizer(prompts,truncation=True,max_length=self.max_seq_length)["input_ids"]
+        return [len(ids) for ids in self._input_ids]
+
+    def _tokenize(self,input_sentence,idx=None):
+        if not self.dynamic_padding:
+            return self.tokenizer([input_sentence], return_tensors='pt',padding="max_length",truncation=True,max_length=self.max_seq_length)
+        if self._input_ids is not None and idx is not None:
+            input_ids=torch.tensor([self._input_ids[idx]])
+        else:
+            input_ids=self.tokenizer([input_sentence], return_tensors='pt',truncation=True,max_length=self.max_seq_length)["input_ids"]
+        return {"input_ids":input_ids,"attention_mask":torch.ones_like(input_ids)}
     
-    def parse_data(self,example):
+    def parse_data(self,example,idx=None):
         if type(example)==dict:
             input_sentence=example["prompt"]
-            input_ids = self.tokenizer([input_sentence], return_tensors='pt',padding="max_length",truncation=True,max_length=self.max_seq_length)
+            input_ids = self._tokenize(input_sentence,idx)
             instance={}
             instance["text"]=input_sentence 
             instance["gold_response"]=example["gold_response"]
@@ -49,10 +80,100 @@ class GenericDataset(Dataset):
             
         else:
             input_sentence=example
-            input_ids = self.tokenizer([input_sentence], return_tensors='pt',padding="max_length",truncation=True,max_length=self.max_seq_length)
+            input_ids = self._tokenize(input_sentence,idx)
             instance={}
             instance["text"]=example    
         
         instance["input_ids"]=input_ids["input_ids"]
         instance["attention_mask"]=input_ids["attention_mask"]
-        return instance
\ No newline at end of file
+        return instance
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler that groups examples of similar token length.
+    Indices are sorted by length (longest first, so that an OOM shows up on the first batch)
+    and chunked into batches, so padding to the longest member of a batch wastes little compute.
+    The order of the batches is deterministic; callers restore the original order by `id`.
+    """
+
+    def __init__(self, lengths, batch_size):
+        self.lengths=lengths
+        self.batch_size=batch_size
+        order=sorted(range(len(lengths)),key=lambda i: lengths[i],reverse=True)
+        self.batches=[order[i:i+batch_size] for i in range(0,len(order),batch_size)]
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield batch
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class DynamicPaddingCollator:
+    """
+    Collate function that pads input_ids/attention_mask to the longest member of the batch.
+    Works with instances produced by GenericDataset(dynamic_padding=True).
+    """
+
+    def __init__(self, tokenizer):
+        self.pad_token_id=tokenizer.pad_token_id
+        self.padding_side=tokenizer.padding_side
+
+    def __call__(self, instances):
+        max_len=max(instance["input_ids"].shape[-1] for instance in instances)
+        input_ids=torch.full((len(instances),max_len),self.pad_token_id,dtype=torch.long)
+        attention_mask=torch.zeros((len(instances),max_len),dtype=torch.long)
+        for i,instance in enumerate(instances):
+            ids=instance["input_ids"].view(-1)
+            if self.padding_side=="left":
+                input_ids[i,max_len-len(ids):]=ids
+                attention_mask[i,max_len-len(ids):]=1
+            else:
+                input_ids[i,:len(ids)]=ids
+                attention_mask[i,:len(ids)]=1
+
+        batch={"input_ids":input_ids,"attention_mask":attention_mask}
+        for key in instances[0]:
+            if key in batch:
+                continue
+            values=[instance[key] for instance in instances]
+            batch[key]=torch.tensor(values) if key=="id" else values
+        return batch
+
+
+class GenericIterableDataset(IterableDataset):
+    """
+    Streaming counterpart of GenericDataset for prompt generators (see prompt.iter_prompts_from_json).
+    examples_fn: zero-argument callable returning a fresh iterator over the prompts, so that the
+    dataset can be iterated more than once without holding all prompts in memory.
+    window_size: with dynamic padding, instances are sorted by length inside windows of this many
+    examples, which keeps the batches length-homogeneous while memory stays bounded.
+    """
+
+    def __init__(self, model_name_or_path: str, examples_fn, max_seq_length=512, tokenizer=None, dynamic_padding=True, window_size=1024):
+        super(GenericIterableDataset, self).__init__()
+        self.parser=GenericDataset(model_name_or_path,[],max_seq_length=max_seq_length,tokenizer=tokenizer,dynamic_padding=dynamic_padding)
+        self.tokenizer=self.parser.tokenizer
+        self.examples_fn=examples_fn
+        self.dynamic_padding=dynamic_padding
+        self.window_size=window_size
+
+    def _sorted_window(self, window):
+        window.sort(key=lambda instance: instance["input_ids"].shape[-1], reverse=True)
+        for instance in window:
+            yield instance
+
+    def __iter__(self):
+        window=[]
+        for example in self.examples_fn():
+            instance=self.parser.parse_data(example)
+            if not self.dynamic_padding:
+                yield instance
+                continue
+            window.append(instance)
+            if len(window)==self.window_size:
+                yield from self._sorted_window(window)
+                window=[]
+        yield from self._sorted_window(window)
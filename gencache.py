@@ -0,0 +1,55 @@
+import os
+import json
+import hashlib
+import sqlite3
+
+
+class GenerationCache:
+    """
+    On-disk, content-addressed cache of generated responses.
+    Entries are keyed by a hash of (model_path, prompt text, decoding parameters), so byte-identical
+    prompts from different sweep configurations are generated only once.
+    Safe to share between the generation processes of a run (SQLite in WAL mode).
+    """
+
+    def __init__(self, path="cache/generations.sqlite"):
+        self.path = path
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, model TEXT, response TEXT)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model_path, prompt, min_length, max_length, precision):
+        blob = json.dumps([model_path, prompt, min_length, max_length, precision], ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """Cached responses of the given keys, as a dict (misses are absent)"""
+        keys = list(set(keys))
+        found = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = f"SELECT key, response FROM generations WHERE key IN ({','.join('?' * len(chunk))})"
+            for key, response in self.conn.execute(query, chunk):
+                found[key] = response
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, model_path, items):
+        """items: iterable of (key, response)"""
+        self.conn.executemany("INSERT OR REPLACE INTO generations (key, model, response) VALUES (?, ?, ?)",
+                              [(key, model_path, response) for key, response in items])
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
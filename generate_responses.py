@@ -20,10 +20,19 @@ from accelerate import notebook_launcher
 from torch import nn, Tensor
 import json
 import os
+import functools
+import itertools
 from torch.utils.data.dataset import IterableDataset,Dataset
 
 from prompt import *
 from datautils import *
+from resultutils import *
+from async_completions import AsyncCompletionClient
+from gencache import GenerationCache
+
+# Decoding parameters of the seq2seq models (part of the generation cache key)
+MIN_LENGTH=24
+MAX_LENGTH=128
 
 
 def to_device(batch_or_tensor, device, non_blocking: bool = False) :
@@ -43,7 +52,54 @@ def to_device(batch_or_tensor, device, non_blocking: bool = False) :
     else:
         raise NotImplementedError(f"Not supported type: {type(batch_or_tensor)}")
 
-def generate_responses(tokenizer,model,dataloader,precision_mode,write_to_file=None):
+def filter_cached(prompts,cache,key_fn,writer,model_path,chunk_size=1024):
+    """
+    Yields the prompts missing from the generation cache.
+    Cached responses are written straight to the output through writer and never reach the model.
+    """
+    def flush(chunk):
+        keys=[key_fn(example["prompt"]) for example in chunk]
+        found=cache.get_many(keys)
+        if model_path=="dv3":
+            # Empty dv3 completions were cached for failed prompts by earlier runs, they are misses
+            found={key:response for key,response in found.items() if response}
+        hits=[response_entry(example,found[key],model_path) for example,key in zip(chunk,keys) if key in found]
+        if len(hits)>0:
+            writer.write(hits)
+        for example,key in zip(chunk,keys):
+            if key not in found:
+                yield example
+
+    chunk=[]
+    for example in prompts:
+        chunk.append(example)
+        if len(chunk)==chunk_size:
+            yield from flush(chunk)
+            chunk=[]
+    yield from flush(chunk)
+
+
+def make_batch_entries(batch,responses):
+    """Output entries for a collated batch and its decoded responses"""
+    prompts=[x for x in batch["text"]]      
+    responses=[x for x in responses]
+    if "gold_response" in batch:
+        gold_response=[x.strip() for x in batch["gold_response"]]
+    if "summary" in batch:
+        summaries=[x.strip() for x in batch["summary"]]
+    if "current_utterance" in batch:
+        current_utterance=[x.strip() for x in batch["current_utterance"]]
+    if "history" in batch:
+        history=[x.strip() for x in batch["history"]]
+    if "id" in batch:
+        ids=batch["id"].tolist()
+    batch_entries=[]
+    for i,response in enumerate(responses):
+        batch_entries.append({"prompts":prompts[i],"current_utterance":current_utterance[i],"predicted_response":responses[i],"gold_response":gold_response[i],"history":history[i],"summary":summaries[i],"id":ids[i]})
+    return batch_entries
+
+
+def generate_responses(tokenizer,model,dataloader,precision_mode,write_to_file,cache_path=None,model_path=None):
     #print("Write to file")
     #print(write_to_file)
     accelerator=Accelerator(mixed_precision=precision_mode)
@@ -51,11 +107,15 @@ def generate_responses(tokenizer,model,dataloader,precision_mode,write_to_file=N
     model.eval()
     model.to(accelerator.device)
     #model.to(torch.device("cuda:0"))
-    response_list=[]
+    # Every process appends its finished batches to its own shard, so a crashed run can be resumed
+    writer=ResultWriter(write_to_file,accelerator.process_index)
+    cache=GenerationCache(cache_path) if cache_path is not None else None
     for batch in tqdm(dataloader):
         
-        batch["input_ids"]=batch["input_ids"].squeeze(1)
-        batch["attention_mask"]=batch["attention_mask"].squeeze(1)
+        # Fixed-length instances come as (bs, 1, max_seq_length), dynamically padded batches are already 2D
+        if batch["input_ids"].dim()==3:
+            batch["input_ids"]=batch["input_ids"].squeeze(1)
+            batch["attention_mask"]=batch["attention_mask"].squeeze(1)
         sub_batch={}
         sub_batch["input_ids"]=batch["input_ids"]
         sub_batch["attention_mask"]=batch["attention_mask"]
@@ -63,28 +123,44 @@ def generate_responses(tokenizer,model,dataloader,precision_mode,write_to_file=N
         with torch.no_grad():
 
             if accelerator.state.num_processes == 1:
-                preds=model.generate(**sub_batch,min_length=24,max_length=128)
+                preds=model.generate(**sub_batch,min_length=MIN_LENGTH,max_length=MAX_LENGTH)
             else:
-                preds=model.module.generate(**sub_batch,min_length=24,max_length=128)
+                preds=model.module.generate(**sub_batch,min_length=MIN_LENGTH,max_length=MAX_LENGTH)
             responses=tokenizer.batch_decode(preds, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
         prompts=[x for x in batch["text"]]      
-        responses=[x for x in responses]
-        if "gold_response" in batch:
-            gold_response=[x.strip() for x in batch["gold_response"]]
-        if "summary" in batch:
-            summaries=[x.strip() for x in batch["summary"]]
-        if "current_utterance" in batch:
-            current_utterance=[x.strip() for x in batch["current_utterance"]]
-        if "history" in batch:
-            history=[x.strip() for x in batch["history"]]
-        if "id" in batch:
-            ids=batch["id"].tolist()
-        for i,response in enumerate(responses):
-            response_list.append({"prompts":prompts[i],"current_utterance":current_utterance[i],"predicted_response":responses[i],"gold_response":gold_response[i],"history":history[i],"summary":summaries[i]})
-
-    for entry in response_list:
-        print(json.dumps(entry)+"\n")
+        batch_entries=make_batch_entries(batch,responses)
+        writer.write(batch_entries)
+        if cache is not None:
+            cache.put_many(model_path,[(GenerationCache.make_key(model_path,prompt,MIN_LENGTH,MAX_LENGTH,precision_mode),response) for prompt,response in zip(prompts,responses)])
+
+    writer.close()
+    if cache is not None:
+        cache.close()
+
+def generate_responses_onnx(tokenizer,model,dataloader,precision_mode,write_to_file,cache_path=None,model_path=None):
+    """
+    CPU generation loop for the ONNX Runtime backend (see onnx_backend.load_onnx_model).
+    Greedy decoding through the exported encoder and decoder-with-past graphs, no accelerate.
+    """
+    writer=ResultWriter(write_to_file)
+    cache=GenerationCache(cache_path) if cache_path is not None else None
+    for batch in tqdm(dataloader, desc="onnx..."):
+        if batch["input_ids"].dim()==3:
+            batch["input_ids"]=batch["input_ids"].squeeze(1)
+            batch["attention_mask"]=batch["attention_mask"].squeeze(1)
+        preds=model.generate(input_ids=batch["input_ids"],attention_mask=batch["attention_mask"],min_length=MIN_LENGTH,max_length=MAX_LENGTH)
+        responses=tokenizer.batch_decode(preds, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+        prompts=[x for x in batch["text"]]
+        writer.write(make_batch_entries(batch,responses))
+        if cache is not None:
+            cache.put_many(model_path,[(GenerationCache.make_key(model_path,prompt,MIN_LENGTH,MAX_LENGTH,precision_mode),response) for prompt,response in zip(prompts,responses)])
+
+    writer.close()
+    if cache is not None:
+        cache.close()
+
 
 def gpt3_generate(prompts, openai_key):
     openai.api_key = openai_key
@@ -99,48 +175,33 @@ def gpt3_generate(prompts, openai_key):
     )
     return response 
 
-def delayed_batched_gpt3_generate(prompts, openai_key, batch_size=8):
-    import time
-    rate_limit = 50 # per minute
-    batched_prompts = [prompts[i:i+batch_size] for i in range(0, len(prompts), batch_size)]
-    responses = []
-    prev_time = time.time()
-
-    for batch in tqdm(batched_prompts):
-        max_exceptions = 3
-        exception_delay = 5
-
-        subset = None
-        while subset is None:
-            try:
-                prompt_batch = [x["prompt"] for x in batch]
-                subset = gpt3_generate(prompt_batch, openai_key)
-                break
-            except Exception as e:
-                max_exceptions -= 1
-                time.sleep(exception_delay)
-                if max_exceptions == 0:
-                    print("Too many exceptions, skipping batch")
-                    print(e)
-                    break
-                else:
-                    print("Exception encountered, retrying")
-                    continue
-        if subset is not None:
-            responses.extend(subset["choices"])
-        else:
-            dummy_openai_response = {
-                "choices": [{"text": ""} for _ in batch]
-            }
-            responses.extend(dummy_openai_response["choices"])
-        print(responses[-1])
-        curr_time = time.time()
-        delay_needed = 60 / rate_limit
-        if curr_time - prev_time < delay_needed:
-            time.sleep(delay_needed - (curr_time - prev_time))
-        prev_time = curr_time
-    
-    return responses
+def load_model(model_path):
+    """Load the tokenizer and model for a model path.
+    Returns (None, None) for API-backed models (dv3), which have nothing to load.
+    """
+    tokenizer, model = None, None
+    if model_path=="facebook/blenderbot-3B":
+        tokenizer = BlenderbotTokenizerFast.from_pretrained(model_path)
+        tokenizer.add_prefix_space=False
+        model = BlenderbotForConditionalGeneration.from_pretrained(model_path)
+    elif model_path == "google/flan-t5-xl":
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+        tokenizer=AutoTokenizer.from_pretrained(model_path)
+    elif model_path == "bigscience/T0_3B":
+        #print("Bigscience")
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    elif model_path == "allenai/tk-instruct-3b-def-pos":
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    elif model_path== "allenai/tk-instruct-3b-def":
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    elif model_path=="EleutherAI/gpt-neo-2.7B":        
+        tokenizer = GPT2Tokenizer.from_pretrained(model_path)
+        
+        model = GPTNeoForCausalLM.from_pretrained(model_path)
+    return tokenizer, model
 
 
 def helper(input_file,
@@ -158,19 +219,94 @@ def helper(input_file,
            bart_summary=False,
            use_fsb_prompt=False,
            segment_utt=False,
-           num_processes=8):
+           num_processes=8,
+           model=None,
+           tokenizer=None,
+           length_bucketing=True,
+           streaming=False,
+           dv3_options=None,
+           cache_path=None,
+           cache_replay=False,
+           backend="torch",
+           onnx_parity=0,
+           onnx_parity_threshold=0.9,
+           cpu_workers=0):
+    """Generate responses for every prompt built from input_file.
+    model/tokenizer: an already loaded pair (see load_model), so that a sweep can
+    reuse one checkpoint across configurations. Loaded from model_path if not given.
+    length_bucketing: batch prompts of similar token length and pad each batch only to its
+    longest member instead of padding everything to max_seq_length.
+    streaming: build and tokenize the prompts lazily instead of materializing all of them
+    (length bucketing then happens within windows of the stream).
+    outfile: the generated responses end up here, ordered by id. Until the run completes, finished
+    batches are checkpointed in per-process shards next to it (see ResultWriter); instances already
+    present there from an interrupted run are not generated again.
+    dv3_options: keyword arguments for the AsyncCompletionClient used for dv3 (concurrency, rate limits, api_base)
+    cache_path: generation cache (see GenerationCache) consulted before batching, only misses are generated.
+    cache_replay: serve the whole run from the cache without loading the model, fails on any miss.
+    backend: "torch", or "onnx" for CPU generation through ONNX Runtime (seq2seq models only).
+    onnx_parity: with the onnx backend, compare against the torch model on this many prompts first.
+    onnx_parity_threshold: minimum fraction of the parity prompts with the same response as torch, below it the run fails.
+    cpu_workers: generate on CPU with this many worker processes attached to a single shared-memory
+    copy of the weights (see shared_generation.generate_shared) instead of the accelerate launcher.
+    """
+    if backend=="onnx":
+        if model_path=="dv3":
+            raise ValueError("The onnx backend is not available for dv3")
+        # fp16 mixed precision does not apply on CPU, the exported graphs run in fp32
+        precision_mode="onnx-fp32"
+    elif cpu_workers>0:
+        if model_path=="dv3":
+            raise ValueError("cpu_workers is not available for dv3")
+        precision_mode="cpu-fp32"
+
     
-    prompts=generate_prompts_from_json(input_file,
-                                       prompt_template,
-                                       current_utterance_only=current_utterance_only,
-                                       use_shorter_template=use_shorter_template,
-                                       bart_summary=bart_summary,
-                                       has_persona_only=has_persona_only,
-                                       has_persona_and_summary=has_persona_and_summary,
-                                       has_knowledge_only=has_knowledge_only,
-                                       has_knowledge_and_summary=has_knowledge_and_summary,
-                                       use_fsb_prompt=use_fsb_prompt,
-                                       segment_utt=segment_utt)
+    prompt_kwargs=dict(current_utterance_only=current_utterance_only,
+                       use_shorter_template=use_shorter_template,
+                       bart_summary=bart_summary,
+                       has_persona_only=has_persona_only,
+                       has_persona_and_summary=has_persona_and_summary,
+                       has_knowledge_only=has_knowledge_only,
+                       has_knowledge_and_summary=has_knowledge_and_summary,
+                       use_fsb_prompt=use_fsb_prompt,
+                       segment_utt=segment_utt)
+    writer=ResultWriter(outfile)
+    completed_ids=writer.completed_ids()
+    if len(completed_ids)>0:
+        print(f"Resuming: {len(completed_ids)} instances already in {writer.shard_dir}")
+
+    def pending_prompts():
+        for prompt in iter_prompts_from_json(input_file,prompt_template,**prompt_kwargs):
+            if prompt["id"] not in completed_ids:
+                yield prompt
+
+    if cache_path is not None:
+        if model_path=="dv3":
+            key_fn=functools.partial(GenerationCache.make_key,model_path,min_length=None,max_length=(dv3_options or {}).get("max_tokens",100),precision="api")
+        else:
+            key_fn=functools.partial(GenerationCache.make_key,model_path,min_length=MIN_LENGTH,max_length=MAX_LENGTH,precision=precision_mode)
+        def uncached_prompts():
+            # Opened here so that every process iterating the prompts has its own connection and shard
+            cache=GenerationCache(cache_path)
+            with ResultWriter(outfile,f"cache-{os.getpid()}") as cache_writer:
+                yield from filter_cached(pending_prompts(),cache,key_fn,cache_writer,model_path)
+            cache.close()
+    else:
+        uncached_prompts=pending_prompts
+
+    if cache_replay:
+        if cache_path is None:
+            raise ValueError("cache_replay needs a cache_path")
+        missing=sum(1 for _ in uncached_prompts())
+        if missing>0:
+            raise Exception(f"{missing} prompts are missing from the cache {cache_path}, cannot replay the run")
+        prompts=[]
+    elif streaming and model_path != "dv3":
+        # Prompts are built lazily while the dataloader consumes them
+        prompts=None
+        prompts_fn=uncached_prompts
+    else:
+        prompts=list(uncached_prompts())
     if current_utterance_only:
         max_seq_length=256
     elif use_shorter_template:        
@@ -180,49 +316,65 @@ def helper(input_file,
     #print("Model path")
     #print(model_path)
     #print(model_path=="bigscience/T0_3B")
-    if model_path=="facebook/blenderbot-3B":
-        tokenizer = BlenderbotTokenizerFast.from_pretrained(model_path)
-        tokenizer.add_prefix_space=False
-        model = BlenderbotForConditionalGeneration.from_pretrained(model_path)
-    elif model_path == "google/flan-t5-xl":
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
-        tokenizer=AutoTokenizer.from_pretrained(model_path)
-    elif model_path == "bigscience/T0_3B":
-        #print("Bigscience")
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
-    elif model_path == "allenai/tk-instruct-3b-def-pos":
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
-    elif model_path== "allenai/tk-instruct-3b-def":
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
-    elif model_path=="EleutherAI/gpt-neo-2.7B":        
-        tokenizer = GPT2Tokenizer.from_pretrained(model_path)
-        
-        model = GPTNeoForCausalLM.from_pretrained(model_path)
+    pending=(prompts is None) or len(prompts)>0
+    if pending and backend=="onnx":
+        from onnx_backend import load_onnx_model, parity_check
+        if model is None or tokenizer is None:
+            tokenizer, model = load_onnx_model(model_path)
+        if onnx_parity>0:
+            sample=[x["prompt"] for x in itertools.islice(iter_prompts_from_json(input_file,prompt_template,**prompt_kwargs),onnx_parity)]
+            agreement=parity_check(model_path,tokenizer,model,sample,MIN_LENGTH,MAX_LENGTH,max_seq_length=max_seq_length)
+            if agreement<onnx_parity_threshold:
+                raise Exception(f"ONNX parity check failed for {model_path}: {agreement:.1%} of the responses match torch, below {onnx_parity_threshold:.1%}")
+    elif pending and (model is None or tokenizer is None):
+        tokenizer, model = load_model(model_path)
 
-    if model_path != "dv3":
-        dataset=GenericDataset(model_path,prompts,max_seq_length=max_seq_length)
-        dataloader = DataLoader(dataset,  batch_size=bs)
-        args=(tokenizer,model,dataloader,precision_mode,outfile)
+    if not pending:
+        print("All instances already generated")
+    elif cpu_workers>0 and backend=="torch":
+        from shared_generation import generate_shared
+        generate_shared(tokenizer,model,prompts if prompts is not None else prompts_fn(),outfile,cpu_workers,bs=bs,
+                        cache_path=cache_path,model_path=model_path,precision_mode=precision_mode,
+                        max_seq_length=max_seq_length,min_length=MIN_LENGTH,max_length=MAX_LENGTH)
+    elif model_path != "dv3":
+        if prompts is None:
+            dataset=GenericIterableDataset(model_path,prompts_fn,max_seq_length=max_seq_length,tokenizer=tokenizer,dynamic_padding=length_bucketing)
+            collate_fn=DynamicPaddingCollator(dataset.tokenizer) if length_bucketing else None
+            dataloader = DataLoader(dataset, batch_size=bs, collate_fn=collate_fn)
+        else:
+            dataset=GenericDataset(model_path,prompts,max_seq_length=max_seq_length,tokenizer=tokenizer,dynamic_padding=length_bucketing)
+            if length_bucketing:
+                batch_sampler=LengthGroupedBatchSampler(dataset.lengths(),bs)
+                dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=DynamicPaddingCollator(dataset.tokenizer))
+            else:
+                dataloader = DataLoader(dataset,  batch_size=bs)
+        args=(tokenizer,model,dataloader,precision_mode,outfile,cache_path,model_path)
         #print(outfile)
-        notebook_launcher(generate_responses,args,num_processes=num_processes)
+        if backend=="onnx":
+            generate_responses_onnx(*args)
+        else:
+            notebook_launcher(generate_responses,args,num_processes=num_processes)
     else:
         # OpenAI text-davinci-03
         if "OPENAI_API_KEY" not in os.environ:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
         api_key = os.getenv("OPENAI_API_KEY")
-        response_list=[]
-        
-        responses = delayed_batched_gpt3_generate(prompts, api_key, batch_size=bs)
-        for i, sample in tqdm(enumerate(prompts), total=len(prompts)):
-            # print(sample)
-            response = responses[i]
-            # if i==0:
-            #     break
-            response_list.append(sample)
-            response_list[-1]["predicted_response"]=response["text"]
+        cache=GenerationCache(cache_path) if cache_path is not None else None
+        def on_result(indices, texts):
+            writer.write([response_entry(prompts[i],text,model_path) for i,text in zip(indices,texts)])
+            if cache is not None:
+                # An empty completion is not worth serving forever, the next run asks again
+                cache.put_many(model_path,[(key_fn(prompts[i]["prompt"]),text) for i,text in zip(indices,texts) if text])
+
+        client=AsyncCompletionClient(api_key, batch_size=bs, **(dv3_options or {}))
+        texts=client.generate([x["prompt"] for x in prompts], on_result=on_result)
+        # Failed prompts are left out of the shards, a rerun generates them again
+        n_failed=sum(1 for text in texts if text is None)
+        if n_failed>0:
+            print(f"WARNING: {n_failed} dv3 prompts failed, they are missing from {outfile} until the run is repeated")
+        writer.close()
+        if cache is not None:
+            cache.close()
 
         # for i, sample in tqdm(enumerate(prompts), total=len(prompts)):
         #     # print(sample)
@@ -231,30 +383,9 @@ def helper(input_file,
         #     #     break
         #     response_list.append(sample)
         #     response_list[-1]["predicted_response"]=response["choices"][0]["text"]
-        
-        for entry in response_list:
-            print(json.dumps(entry)+"\n")
-
-    
 
-def compute_preds(output):
-    with open(output,"r") as fp:
-        content=fp.readlines()
-    preds=list(set([x.strip() for x in content if len(x.strip())>0]))
-    cnt=0
-    filtered_preds=[]
-    for entry in tqdm(preds):
-        try:
-            entry=json.loads(entry)
-            #print(list(entry.keys()))
-            if len(list(entry.keys())) in [6,7]:
-                filtered_preds.append(entry)
-                cnt+=1
-        except:
-            #print(entry)
-            continue
-    print(cnt)
-    return filtered_preds
+    n_entries=writer.merge()
+    print(f"Saved {n_entries} responses to {outfile}")
 
 
 # Unit Test
@@ -266,23 +397,11 @@ if __name__ == "__main__":
     inputfile="context_data/multi_session_chat/previous_utterances/msc_previous_utterances_last2.txt"
     prompt_template=pegasusft_template_pplbased_tk_instruct
 
-    temp_output="intermediate_file.txt"
-    stdout = sys.stdout
-    sys.stdout = open(temp_output, 'w')
+    output_file="outputs/{2}/{0}/{1}_optimalppltemplate_tk_instruct.txt".format(output_folder,outputfile_prefix,input_dataset)
     helper(inputfile,
         24,
-        temp_output,
+        output_file,
         prompt_template=prompt_template,
         precision_mode="fp16",
         model_path="allenai/tk-instruct-3b-def",
         use_shorter_template=True)
-    sys.stdout = stdout
-    filtered_preds=compute_preds(temp_output)
-    path = "outputs/{2}/{0}/"
-    if not os.path.isdir(path):
-        os.makedirs(path, exist_ok=True)
-    fp=open("outputs/{2}/{0}/{1}_optimalppltemplate_tk_instruct.txt".format(output_folder,outputfile_prefix,input_dataset),"w")
-    for entry in tqdm(filtered_preds):
-        fp.write(json.dumps(entry)+"\n")
-    fp.close()
-
@@ -4,6 +4,7 @@ import argparse
 import uuid
 import os
 import sys
+import traceback
 from tqdm import tqdm
 import json
 import pandas as pd
@@ -20,6 +21,7 @@ def cmdline_args(x=None):
     --history_k: Number of utterances to use in recent-k or semantic-k
     --wandb: Use wandb or not
     --num_gpus: Number of GPUs to use
+    --sweep: Run the whole configuration grid in-process, loading each model once
     """
     parser = argparse.ArgumentParser(description='Launcher')
     parser.add_argument('-d', '--dataset', type=str, default='MSC', help='Dataset to use (MSC or TC)', choices=["MSC", "TC"])
@@ -34,6 +36,21 @@ def cmdline_args(x=None):
     parser.add_argument('-w','--wandb',  action="store_true", help='Use wandb or not')
     parser.add_argument('-ngpu', '--num_gpus', type=int, default=1, help='Number of GPUs to use')
     parser.add_argument('-e', '--eval_mode', action="store_true", help='Evaluation mode')
+    parser.add_argument('--dv3_concurrency', type=int, default=8, help='Concurrent requests for dv3')
+    parser.add_argument('--dv3_rpm', type=int, default=50, help='Requests per minute limit for dv3')
+    parser.add_argument('--dv3_tpm', type=int, default=None, help='Tokens per minute limit for dv3 (unlimited if not given)')
+    parser.add_argument('--dv3_api_base', type=str, default=os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"), help='Completions endpoint base url (e.g. a local stand-in server)')
+    parser.add_argument('--cache_path', type=str, default="cache/generations.sqlite", help='Generation cache shared by all runs (keyed on model, prompt and decoding parameters)')
+    parser.add_argument('--no_cache', action="store_true", help='Do not consult or fill the generation cache')
+    parser.add_argument('--cache_replay', action="store_true", help='Serve the whole run from the generation cache without loading the model')
+    parser.add_argument('--backend', type=str, default="torch", choices=["torch", "onnx"], help='Inference backend, onnx runs greedy generation on CPU through ONNX Runtime')
+    parser.add_argument('--onnx_parity', type=int, default=0, help='With the onnx backend, check parity against torch on this many prompts first')
+    parser.add_argument('--onnx_parity_threshold', type=float, default=0.9, help='Abort the onnx run when fewer of the parity prompts get the same response as torch')
+    parser.add_argument('--cpu_workers', type=int, default=0, help='Generate on CPU with this many processes sharing one copy of the model weights')
+    parser.add_argument('--streaming', action="store_true", help='Build and tokenize prompts lazily (bounded memory, for full train splits)')
+    parser.add_argument('-s', '--sweep', action="store_true", help='Run the full config grid (as in all_exp_batch.sh) in one process')
+    parser.add_argument('--sweep_datasets', type=str, nargs='+', default=["MSC", "TC"], choices=["MSC", "TC"], help='Datasets to cover in sweep mode')
+    parser.add_argument('--sweep_models', type=str, nargs='+', default=["flan-t5", "T0", "tk-instruct"], choices=["flan-t5", "T0", "tk-instruct", "dv3"], help='Models to cover in sweep mode')
     if x is not None:
         return parser.parse_args(x)
     else:
@@ -63,18 +80,29 @@ def full_model_path(model_path):
     return full_path
 
 
+_TEMPLATE_DF = None
+
+def load_templates():
+    """Read templates.csv once per process
+    """
+    global _TEMPLATE_DF
+    if _TEMPLATE_DF is None:
+        template_df = pd.read_csv("templates.csv")
+        # Create new rows by splitting 'history_signal_type' by a semicolon
+        template_df = template_df.assign(history_signal_type=template_df['history_signal_type'].str.split(';'))
+
+        # Explode the new rows
+        _TEMPLATE_DF = template_df.explode('history_signal_type')
+    return _TEMPLATE_DF
+
+
 def search_template(args):
     """Search for the best template
     """
     # dv3 + ppl combination is invalid
     assert not (args.model=="dv3" and args.prompt_type=="ppl"), "dv3 + ppl combination is invalid"
 
-    template_df = pd.read_csv("templates.csv")
-    # Create new rows by splitting 'history_signal_type' by a semicolon
-    template_df = template_df.assign(history_signal_type=template_df['history_signal_type'].str.split(';'))
-
-    # Explode the new rows
-    template_df = template_df.explode('history_signal_type')
+    template_df = load_templates()
 
     # MODs
     ## MOD-1
@@ -105,38 +133,35 @@ def search_template(args):
     return template_df["value"].values[0]
 
 
-def main():
-    args = cmdline_args()
-    print(args)
-    arg_dict = vars(args)
-    if args.wandb:
-        wandb.init(project="frugal-prompts", config=arg_dict)
+# args.model to model_path
+model_path_translator = {
+    'flan-t5': 'google/flan-t5-xl',
+    'T0': 'bigscience/T0_3B',
+    'tk-instruct': 'allenai/tk-instruct-3b-def',
+    'dv3': "dv3"
+}
 
-    prompt_template = search_template(args)
 
-    dataset = load_dataset(
-        dataset = args.dataset,
-        prompt_type = args.prompt_type,
-        few_shot = args.few_shot,
-        background_knowledge = args.background_knowledge,
-        history_signal_type = args.history_signal_type,
-        history_k = args.history_k
-    )
-
-    # model = load_model(args.model)
-    # responses = inference(model, dataset)
-
-    # Generation Block
-    if args.dataset == "MSC":
+def dataset_info(dataset):
+    """Returns (total_instances, input_dataset, data_path) for a dataset
+    """
+    if dataset == "MSC":
         total_instances = 16300
         input_dataset="MSC"
         data_path = "context_data/multi_session_chat/"
-    elif args.dataset == "TC":
+    elif dataset == "TC":
         total_instances = 22452
         input_dataset="TC"
         data_path = "context_data/topical_chat/"
     else:
         raise Exception("Invalid dataset")
+    return total_instances, input_dataset, data_path
+
+
+def get_inputfile(args):
+    """Input file holding the history signal for the given config
+    """
+    _, _, data_path = dataset_info(args.dataset)
 
     if args.history_signal_type == "recent-k":
         inputfile = os.path.join(data_path, "previous_utterances", f"last{args.history_k}.txt")
@@ -158,24 +183,32 @@ def main():
         elif args.dataset == "TC":
             inputfile = os.path.join(data_path, "generated_summary", "test_summary_and_knowledge_dialogdata.txt")
 
-    if not os.path.exists(inputfile):
-        raise Exception("Input file not found")
+    return inputfile
+
+
+def get_output_path(args):
+    """Returns (output directory, output filename) for the given config
+    """
+    _, input_dataset, _ = dataset_info(args.dataset)
+    path = f"outputs/{input_dataset}/"
+    # use all args to create a filename
+    output_filename = f"{args.model}_" \
+                        f"{args.prompt_type}_" \
+                        f"{'fs' if args.few_shot else 'zs'}_" \
+                        f"{'bk' if args.background_knowledge else 'nbk'}_" \
+                        f"{args.history_signal_type}"
+    if args.history_signal_type in ["recent-k", "semantic-k"]:
+        output_filename += f"_{args.history_k}.jsonl"
     else:
-        print(f"Input file: {inputfile}")
+        output_filename += f".jsonl"
+    return path, output_filename
 
-    # TODO: Prompt template logic
-    # To be read from a csv file, based on the arguments
-    
-    temp_dir = "./tmp"
-    if not os.path.exists(temp_dir):
-        os.makedirs(temp_dir)
-    # UNIQ hash id for the run
-    hash_id = uuid.uuid4().hex[:6].upper()
-    temp_output = os.path.join(temp_dir, f"intermediate_file_{hash_id}.txt")
-    # temp_output="intermediate_file.txt"
-    print(f"Temp output file: {temp_output}")
-    stdout = sys.stdout
-    sys.stdout = open(temp_output, 'w')
+
+def run_generation(args, prompt_template, inputfile, model=None, tokenizer=None):
+    """Generation for a single config.
+    model/tokenizer: preloaded by the caller in sweep mode, loaded by helper otherwise
+    """
+    path, output_filename = get_output_path(args)
 
     # helper(input_file,
     #        bs,
@@ -194,123 +227,163 @@ def main():
     #        segment_utt=False,
     #        num_processes=8)
 
-    # OUTPUT PATH
-    path = f"outputs/{input_dataset}/"
-    # use all args to create a filename
-    output_filename = f"{args.model}_" \
-                        f"{args.prompt_type}_" \
-                        f"{'fs' if args.few_shot else 'zs'}_" \
-                        f"{'bk' if args.background_knowledge else 'nbk'}_" \
-                        f"{args.history_signal_type}"
-    if args.history_signal_type in ["recent-k", "semantic-k"]:
-        output_filename += f"_{args.history_k}.jsonl"
-    else:
-        output_filename += f".jsonl"
+    # Delay the import to avoid loading the model-libraries before the template is found (takes time)
+    from generate_responses import helper
+    has_persona_only = False
+    has_knowledge_only = False
+    has_persona_and_summary = False
+    has_knowledge_and_summary = False
+    if args.background_knowledge:
+        has_persona_only = (args.history_signal_type == "none") and (args.dataset=="MSC")
+        has_knowledge_only = (args.history_signal_type == "none") and (args.dataset=="TC")
 
-    if not args.eval_mode:
-        # Delay the import to avoid loading the model-libraries before the template is found (takes time)
-        from generate_responses import helper, compute_preds
-        has_persona_only = False
-        has_knowledge_only = False
-        has_persona_and_summary = False
-        has_knowledge_and_summary = False
-        if args.background_knowledge:
-            has_persona_only = (args.history_signal_type == "none") and (args.dataset=="MSC")
-            has_knowledge_only = (args.history_signal_type == "none") and (args.dataset=="TC")
-
-            has_persona_and_summary = (args.history_signal_type != "none") and (args.dataset=="MSC")
-            has_knowledge_and_summary = (args.history_signal_type != "none") and (args.dataset=="TC")
-        
-        # args.model to model_path
-        model_path_translator = {
-            'flan-t5': 'google/flan-t5-xl',
-            'T0': 'bigscience/T0_3B',
-            'tk-instruct': 'allenai/tk-instruct-3b-def',
-            'dv3': "dv3"
-        }
-        model_path = model_path_translator[args.model]
- 
-        helper(inputfile,
-            args.batch_size,
-            temp_output,
-            prompt_template=prompt_template,
-            precision_mode="fp16",
-            model_path=model_path,
-            use_shorter_template=(not args.few_shot), 
-            has_persona_only=has_persona_only,
-            has_knowledge_only=has_knowledge_only,
-            has_persona_and_summary=has_persona_and_summary,
-            has_knowledge_and_summary=has_knowledge_and_summary,
-            current_utterance_only=(args.history_signal_type == "none"),
-            bart_summary=((args.history_signal_type == "bart") or (args.history_signal_type == "peg")),
-            num_processes=args.num_gpus)
-
-        sys.stdout = stdout
-
-        filtered_preds=compute_preds(temp_output)
-        
-        if not os.path.isdir(path):
-            os.makedirs(path, exist_ok=True)    
-        print(f"Saving to {path}/{output_filename}")
-        with open(f"{path}/{output_filename}", "w") as fp:
-            for entry in tqdm(filtered_preds):
-                fp.write(json.dumps(entry)+"\n")
+        has_persona_and_summary = (args.history_signal_type != "none") and (args.dataset=="MSC")
+        has_knowledge_and_summary = (args.history_signal_type != "none") and (args.dataset=="TC")
+    
+    model_path = model_path_translator[args.model]
+    dv3_options = dict(
+        concurrency=args.dv3_concurrency,
+        requests_per_minute=args.dv3_rpm,
+        tokens_per_minute=args.dv3_tpm,
+        api_base=args.dv3_api_base
+    )
 
-        wandb.finish()
+    # Responses are written (and checkpointed) by the generation processes themselves;
+    # a restarted run only generates the missing ids
+    output_file = os.path.join(path, output_filename)
+    print(f"Saving to {output_file}")
+    helper(inputfile,
+        args.batch_size,
+        output_file,
+        prompt_template=prompt_template,
+        precision_mode="fp16",
+        model_path=model_path,
+        use_shorter_template=(not args.few_shot), 
+        has_persona_only=has_persona_only,
+        has_knowledge_only=has_knowledge_only,
+        has_persona_and_summary=has_persona_and_summary,
+        has_knowledge_and_summary=has_knowledge_and_summary,
+        current_utterance_only=(args.history_signal_type == "none"),
+        bart_summary=((args.history_signal_type == "bart") or (args.history_signal_type == "peg")),
+        num_processes=args.num_gpus,
+        model=model,
+        tokenizer=tokenizer,
+        streaming=args.streaming,
+        dv3_options=dv3_options,
+        cache_path=None if args.no_cache else args.cache_path,
+        cache_replay=args.cache_replay,
+        backend=args.backend,
+        onnx_parity=args.onnx_parity,
+        onnx_parity_threshold=args.onnx_parity_threshold,
+        cpu_workers=args.cpu_workers)
+
+
+def run_evaluation(args, my_eval=None):
+    """Evaluation for a single config.
+    my_eval: an Evaluator to reuse (keeps the DEB/BLEURT models loaded across configs)
+    """
+    import numpy as np
+    own_eval = my_eval is None
+    if own_eval:
+        from utils.Evaluator import Evaluator
+        my_eval = Evaluator()
 
-    else:
-        # Evaluation
+    total_instances, _, _ = dataset_info(args.dataset)
+    path, output_filename = get_output_path(args)
 
-        import evaluate 
-        import numpy as np
-        from utils.deb.eval_deb import DEB
-        from transformers import AutoTokenizer
-        from bleurt import score as bleurt_scorer
-        from utils.Evaluator import Evaluator
+    # TODO: Load deb model
+    os.environ["DEB-PATH"] = "./utils/deb/data/deb_model/"
+    os.environ["BLEURT-PATH"] = "./utils/bleurt/bleurt/BLEURT-20"
 
 
-        my_eval = Evaluator()
-        # TODO: Load deb model
-        os.environ["DEB-PATH"] = "./utils/deb/data/deb_model/"
-        os.environ["BLEURT-PATH"] = "./utils/bleurt/bleurt/BLEURT-20"
+    all_metrics = ["bleu", "meteor", "rouge", "bert", "deb", "bleurt", "length"]
+    all_res, eval_instances, logs = my_eval.compute(os.path.join(path, output_filename), all_metrics)
+    if own_eval:
+        my_eval.close()
 
+    correction_factor = eval_instances / total_instances
 
-        # all_metrics = ["bleu", "meteor", "rouge", "bert", "deb", "bleurt", "length"]
-        all_metrics = ["meteor", "deb", "bleurt", "length"]
-        all_res, eval_instances, logs = my_eval.compute(os.path.join(path, output_filename), all_metrics)
+    res = {}
+    for metric in all_res:
+        res[metric] = {}
+        for submetric in all_res[metric]:
+            res[metric][submetric] = np.mean(all_res[metric][submetric]) * correction_factor
+    
+    # Metrics whose checks failed on this file are missing from res, they are left out of the results
+    result_names = [
+            ("BLEU", "bleu", "bleu"),
+            ("METEOR", "meteor", "meteor"),
+            ("ROUGE-1", "rouge", "rouge1"),
+            ("ROUGE-2", "rouge", "rouge2"),
+            ("ROUGE-L", "rouge", "rougeL"),
+            ("BERTScore-p", "bert", "precision"),
+            ("BERTScore-r", "bert", "recall"),
+            ("BERTScore-F1", "bert", "f1"),
+            ("DEB", "deb", "deb"),
+            ("BLEURT", "bleurt", "scores"),
+            ("prompt_len", "length", "prompt_length"),
+            ("output_len", "length", "response_length")
+        ]
+    results_obj = {}
+    for name, metric, submetric in result_names:
+        if metric in res and submetric in res[metric]:
+            results_obj[name] = res[metric][submetric]
+        elif name == "prompt_len" and metric in res:
+            results_obj[name] = -1
+    
+    print(results_obj)
+    
+    # Save results to file
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
 
-        correction_factor = eval_instances / total_instances
+    eval_filename = output_filename.replace(".jsonl", ".eval.json")
+    with open(f"{path}/{eval_filename}", "w") as fp:
+        json.dump(results_obj, fp, indent=4)
+    
+    return results_obj
 
-        res = {}
-        for metric in all_res:
-            res[metric] = {}
-            for submetric in all_res[metric]:
-                res[metric][submetric] = np.mean(all_res[metric][submetric]) * correction_factor
-        
-        results_obj = {
-                "BLEU": res["bleu"]["bleu"],
-                "METEOR": res["meteor"]["meteor"],
-                "ROUGE-1": res["rouge"]["rouge1"],
-                "ROUGE-2": res["rouge"]["rouge2"],
-                "ROUGE-L": res["rouge"]["rougeL"],
-                "BERTScore-p": res["bert"]["precision"],
-                "BERTScore-r": res["bert"]["recall"],
-                "BERTScore-F1": res["bert"]["f1"],
-                "DEB": res["deb"]["deb"],
-                "BLEURT": res["bleurt"]["scores"],
-                "prompt_len": res["length"]["prompt_length"] if "prompt_length" in res["length"] else -1,
-                "output_len": res["length"]["response_length"]
-            }
-        
-        print(results_obj)
-        
-        # Save results to file
-        if not os.path.isdir(path):
-            os.makedirs(path, exist_ok=True)
 
-        eval_filename = output_filename.replace(".jsonl", ".eval.json")
-        with open(f"{path}/{eval_filename}", "w") as fp:
-            json.dump(results_obj, fp, indent=4)
+def run_config(args, model=None, tokenizer=None, my_eval=None):
+    """Run generation (or evaluation with -e) for one config
+    """
+    print(args)
+    arg_dict = vars(args)
+    if args.wandb:
+        wandb.init(project="frugal-prompts", config=arg_dict)
+
+    prompt_template = search_template(args)
+
+    dataset = load_dataset(
+        dataset = args.dataset,
+        prompt_type = args.prompt_type,
+        few_shot = args.few_shot,
+        background_knowledge = args.background_knowledge,
+        history_signal_type = args.history_signal_type,
+        history_k = args.history_k
+    )
+
+    # model = load_model(args.model)
+    # responses = inference(model, dataset)
+
+    # Generation Block
+    inputfile = get_inputfile(args)
+    if not os.path.exists(inputfile):
+        raise Exception("Input file not found")
+    else:
+        print(f"Input file: {inputfile}")
+
+    # TODO: Prompt template logic
+    # To be read from a csv file, based on the arguments
+
+    if not args.eval_mode:
+        run_generation(args, prompt_template, inputfile, model=model, tokenizer=tokenizer)
+
+        wandb.finish()
+
+    else:
+        # Evaluation
+        results_obj = run_evaluation(args, my_eval=my_eval)
         
         # Test: report some random results to wandb for now
         if args.wandb:        
@@ -318,5 +391,108 @@ def main():
             wandb.log(results_obj)
             wandb.finish()
 
+
+def expand_sweep(args):
+    """Expand the configuration grid of all_exp_batch.sh.
+    Every config copies the run-level options (batch size, gpus, eval mode, wandb) from args.
+    Combinations without a unique template or input signal are dropped.
+    """
+    prompt_types = ["manual", "ppl"]
+    few_shot_options = [False, True]
+    background_knowledge_options = [False, True]
+    history_signal_types = ["full", "peg", "bart", "recent-k", "semantic-k", "none"]
+    history_k_values = [2, 4, 8, 10]
+
+    configs = []
+    for dataset in args.sweep_datasets:
+        for model in args.sweep_models:
+            for prompt_type in prompt_types:
+                for few_shot in few_shot_options:
+                    for background_knowledge in background_knowledge_options:
+                        for history_signal_type in history_signal_types:
+                            if history_signal_type in ["recent-k", "semantic-k"]:
+                                ks = history_k_values
+                            else:
+                                ks = [args.history_k]
+                            for history_k in ks:
+                                config = argparse.Namespace(**vars(args))
+                                config.dataset = dataset
+                                config.model = model
+                                config.prompt_type = prompt_type
+                                config.few_shot = few_shot
+                                config.background_knowledge = background_knowledge
+                                config.history_signal_type = history_signal_type
+                                config.history_k = history_k
+                                config.sweep = False
+                                if background_knowledge and history_signal_type not in ['bart', 'peg']:
+                                    continue
+                                try:
+                                    search_template(config)
+                                except AssertionError:
+                                    continue
+                                configs.append(config)
+    return configs
+
+
+def run_sweep(args):
+    """Run every config of the grid, loading each model (and the Evaluator) only once
+    """
+    configs = expand_sweep(args)
+    print(f"Sweep over {len(configs)} configs")
+
+    # Group the configs by model so that each checkpoint is loaded once
+    by_model = {}
+    for config in configs:
+        by_model.setdefault(config.model, []).append(config)
+
+    failed = []
+    my_eval = None
+    if args.eval_mode:
+        from utils.Evaluator import Evaluator
+        my_eval = Evaluator()
+
+    for model_name, model_configs in by_model.items():
+        model, tokenizer = None, None
+        if not args.eval_mode:
+            print(f"Loading {model_name} for {len(model_configs)} configs")
+            # A model that cannot be loaded (e.g. dv3 or another model onnx cannot serve) fails its configs only
+            try:
+                if args.backend == "onnx":
+                    from onnx_backend import load_onnx_model
+                    tokenizer, model = load_onnx_model(model_path_translator[model_name])
+                else:
+                    from generate_responses import load_model
+                    tokenizer, model = load_model(model_path_translator[model_name])
+            except Exception as e:
+                print(f"Could not load {model_name}, skipping its {len(model_configs)} configs", file=sys.stderr)
+                traceback.print_exc()
+                failed.extend(model_configs)
+                continue
+
+        for config in tqdm(model_configs, desc=model_name):
+            try:
+                run_config(config, model=model, tokenizer=tokenizer, my_eval=my_eval)
+            except Exception as e:
+                print(f"Config failed: {config}", file=sys.stderr)
+                traceback.print_exc()
+                failed.append(config)
+
+        del model, tokenizer
+
+    if my_eval is not None:
+        my_eval.close()
+
+    print(f"Sweep done: {len(configs) - len(failed)}/{len(configs)} configs succeeded")
+    for config in failed:
+        print(f"FAILED: {get_output_path(config)[1]}")
+
+
+def main():
+    args = cmdline_args()
+    if args.sweep:
+        run_sweep(args)
+    else:
+        run_config(args)
+
 if __name__ == "__main__":
     main()
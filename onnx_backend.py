@@ -0,0 +1,78 @@
+import os
+import time
+
+from tqdm import tqdm
+
+# Seq2seq checkpoints the ONNX backend has been checked with (all T5 based)
+SUPPORTED_MODELS = ["google/flan-t5-xl", "bigscience/T0_3B", "allenai/tk-instruct-3b-def", "allenai/tk-instruct-3b-def-pos"]
+
+
+def _import_ort():
+    try:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError:
+        raise ImportError("The onnx backend needs onnxruntime and optimum: pip install optimum[onnxruntime]")
+    return ORTModelForSeq2SeqLM
+
+
+def onnx_export_dir(model_path, export_root="onnx_models"):
+    return os.path.join(export_root, model_path.replace("/", "__"))
+
+
+def load_onnx_model(model_path, export_root="onnx_models"):
+    """
+    Tokenizer and ONNX Runtime model for a seq2seq checkpoint.
+    The first call exports the encoder, the decoder and the decoder-with-past (KV cache) graphs
+    to export_root, later calls load the exported graphs directly.
+    """
+    from transformers import AutoTokenizer
+    ORTModelForSeq2SeqLM = _import_ort()
+    if model_path not in SUPPORTED_MODELS:
+        raise ValueError(f"ONNX backend not supported for {model_path}, choose from {SUPPORTED_MODELS}")
+
+    export_dir = onnx_export_dir(model_path, export_root)
+    if os.path.isdir(export_dir):
+        model = ORTModelForSeq2SeqLM.from_pretrained(export_dir, use_cache=True)
+        tokenizer = AutoTokenizer.from_pretrained(export_dir)
+    else:
+        print(f"Exporting {model_path} to ONNX in {export_dir}")
+        model = ORTModelForSeq2SeqLM.from_pretrained(model_path, export=True, use_cache=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model.save_pretrained(export_dir)
+        tokenizer.save_pretrained(export_dir)
+    return tokenizer, model
+
+
+def parity_check(model_path, tokenizer, ort_model, prompts, min_length, max_length, max_seq_length=1024):
+    """
+    Greedy-decodes prompts with the torch checkpoint (fp32, CPU) and with the ONNX model and
+    compares the responses. Returns the fraction of identical responses.
+    """
+    import torch
+    from transformers import AutoModelForSeq2SeqLM
+    torch_model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    torch_model.eval()
+
+    n_same = 0
+    torch_time, ort_time = 0.0, 0.0
+    for prompt in tqdm(prompts, desc="ONNX parity..."):
+        inputs = tokenizer([prompt], return_tensors="pt", truncation=True, max_length=max_seq_length)
+        start = time.time()
+        with torch.no_grad():
+            torch_out = torch_model.generate(**inputs, min_length=min_length, max_length=max_length)
+        torch_time += time.time() - start
+        start = time.time()
+        ort_out = ort_model.generate(**inputs, min_length=min_length, max_length=max_length)
+        ort_time += time.time() - start
+
+        torch_text = tokenizer.batch_decode(torch_out, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
+        ort_text = tokenizer.batch_decode(ort_out, skip_special_tokens=True, clean_up_tokenization_spaces=False)[0]
+        if torch_text == ort_text:
+            n_same += 1
+        else:
+            print(f"Parity mismatch:\n  torch: {torch_text}\n  onnx:  {ort_text}")
+
+    del torch_model
+    agreement = n_same / max(len(prompts), 1)
+    print(f"ONNX parity: {n_same}/{len(prompts)} identical responses, torch {torch_time:.1f}s vs onnx {ort_time:.1f}s")
+    return agreement
@@ -1,6 +1,131 @@
 from templates import *
 import json
 
+def process_summary(history,summary):
+    history_lines=history.split("\n")
+    if history_lines[-1]=="__SILENCE__":
+        last_line=history_lines[-2]
+    else:
+        last_line=history_lines[-1]
+    new_summary=""
+    if last_line.startswith("Person2:"):
+        # new_summary=summary.replace("Person2","Bot").replace("Person1","User")
+        pass
+    else:
+        # new_summary=summary.replace("Person2","User").replace("Person1","Bot")
+        new_summary=summary.replace("Person2","Person1").replace("Person1","Person2")
+    return new_summary
+
+
+def merge_speaker_turns(content):
+    """
+    Merge consecutive lines of the same speaker into a single "Speaker: utt1 utt2" line.
+    Single iterative pass over the lines (replaces the recursive dfs over runs of the same
+    speaker, which hit the recursion limit on long semantic segments).
+    """
+    content=content.split("\n")
+    revised_content=[]
+    i=0
+    while i<len(content):
+        speaker=content[i].split(":")[0]
+        # Run of consecutive lines spoken by the same speaker
+        j=i+1
+        while j<len(content) and content[j].split(":")[0]==speaker:
+            j+=1
+
+        utt=""
+        prev_utt="."
+        for line in content[i:j]:
+            if len(line)==0 or prev_utt==line:
+                continue
+            utt+=line.split(":")[1]+" "
+            prev_utt=line
+        utt=utt.strip()
+        utt=speaker+": "+utt
+        if len(utt)>0:
+            revised_content.append(utt)
+        i=j
+
+    return "\n".join(revised_content)
+
+
+def _summary_source(entry,bart_summary):
+    if bart_summary:
+        return "bart"
+    elif "past_utterance" in entry:
+        return "past_utterance"
+    elif "semantic_utterances" in entry:
+        return "semantic_utterances"
+    return "summary"
+
+
+def _get_summary(entry,source,segment_utt=False):
+    """History signal of a record, as used for both the current and the example (previous) instance"""
+    if source=="bart":
+        #Convert Person1 and Person2 to User and Bot , based on the last line in history
+        #check the last line of history
+        return process_summary(entry["history"],entry["summary"])
+    elif source=="past_utterance":
+        return entry["past_utterance"]
+    elif source=="semantic_utterances":
+        summary=entry["semantic_utterances"]
+        if segment_utt:
+            summary=merge_speaker_turns(summary)
+        return summary
+    return entry["summary"].replace("<n>",".")
+
+
+def iter_prompts_from_json(input_file,
+                           prompt_template,
+                           use_shorter_template=False,
+                           current_utterance_only=False,
+                           bart_summary=False,
+                           has_persona_only=False,
+                           has_knowledge_only=False,
+                           has_persona_and_summary=False,
+                           has_knowledge_and_summary=False,
+                           no_prompt_blenderbot=False,
+                           use_fsb_prompt=False,
+                           segment_utt=False):
+    """
+    Lazily yields one prompt record per line of input_file.
+    Every line is parsed once and only the previous record (the few-shot example) is kept,
+    so memory stays bounded irrespective of the size of the split.
+    """
+    with open(input_file,"r",encoding="utf-8") as fp:
+        prev_entry=None
+        # (source, summary) of prev_entry, so the history signal is only computed once per record
+        prev_cache=None
+        for ind,line in enumerate(fp):
+            line=line.strip()
+            if len(line)==0:
+                prev_entry=None
+                prev_cache=None
+                continue
+            entry=json.loads(line)
+            source=_summary_source(entry,bart_summary)
+            summary=_get_summary(entry,source,segment_utt)
+            if prev_entry is not None:
+                if prev_cache[0]==source:
+                    prev_summary=prev_cache[1]
+                else:
+                    prev_summary=_get_summary(prev_entry,source,segment_utt)
+                record=_build_prompt(entry,prev_entry,ind,summary,prev_summary,
+                                     prompt_template,
+                                     use_shorter_template=use_shorter_template,
+                                     current_utterance_only=current_utterance_only,
+                                     has_persona_only=has_persona_only,
+                                     has_knowledge_only=has_knowledge_only,
+                                     has_persona_and_summary=has_persona_and_summary,
+                                     has_knowledge_and_summary=has_knowledge_and_summary,
+                                     no_prompt_blenderbot=no_prompt_blenderbot,
+                                     use_fsb_prompt=use_fsb_prompt)
+                if record is not None:
+                    yield record
+            prev_entry=entry
+            prev_cache=(source,summary)
+
+
 def generate_prompts_from_json(input_file,
                                prompt_template,
                                use_shorter_template=False,
@@ -13,210 +138,152 @@ def generate_prompts_from_json(input_file,
                                no_prompt_blenderbot=False,
                                use_fsb_prompt=False,
                                segment_utt=False):
-    def process_summary(history,summary):
-        history_lines=history.split("\n")
-        if history_lines[-1]=="__SILENCE__":
-            last_line=history_lines[-2]
+    """List version of iter_prompts_from_json"""
+    return list(iter_prompts_from_json(input_file,
+                                       prompt_template,
+                                       use_shorter_template=use_shorter_template,
+                                       current_utterance_only=current_utterance_only,
+                                       bart_summary=bart_summary,
+                                       has_persona_only=has_persona_only,
+                                       has_knowledge_only=has_knowledge_only,
+                                       has_persona_and_summary=has_persona_and_summary,
+                                       has_knowledge_and_summary=has_knowledge_and_summary,
+                                       no_prompt_blenderbot=no_prompt_blenderbot,
+                                       use_fsb_prompt=use_fsb_prompt,
+                                       segment_utt=segment_utt))
+
+
+def _build_prompt(entry,
+                  prev_entry,
+                  ind,
+                  summary,
+                  prev_summary,
+                  prompt_template,
+                  use_shorter_template=False,
+                  current_utterance_only=False,
+                  has_persona_only=False,
+                  has_knowledge_only=False,
+                  has_persona_and_summary=False,
+                  has_knowledge_and_summary=False,
+                  no_prompt_blenderbot=False,
+                  use_fsb_prompt=False):
+    """Prompt record for entry, with prev_entry as the few-shot example"""
+    history=entry["history"]
+    prev_summary_lines=prev_summary.split("\n")
+    if has_persona_only or has_persona_and_summary or has_knowledge_only or has_knowledge_and_summary or use_fsb_prompt:
+        if "user_summary" in entry:
+
+            current_user_summary=entry["user_summary"].replace("\n",".")
+            current_bot_summary=entry["bot_summary"].replace("\n",".")
+            persona=current_user_summary+"\t"+current_bot_summary
+            previous_user_summary=prev_entry["bot_summary"].replace("\n",".")
+            previous_bot_summary=prev_entry["user_summary"].replace("\n",".")
+        if "kg1_summary" in entry:
+            kg1_summary=entry["kg1_summary"].replace("\n",".")
+            kg2_summary=entry["kg2_summary"].replace("\n",".")
+            kg3_summary=entry["kg3_summary"].replace("\n",".")
+            total_knowledge="\t".join([kg1_summary,kg2_summary,kg3_summary])
+            prev_kg1_summary=prev_entry["kg1_summary"].replace("\n",".") if "kg1_summary" in prev_entry else ""
+            prev_kg2_summary=prev_entry["kg1_summary"].replace("\n",".") if "kg2_summary" in prev_entry else ""
+            prev_kg3_summary=prev_entry["kg1_summary"].replace("\n",".") if "kg3_summary" in prev_entry else ""
+            prev_total_knowledge="\t".join([prev_kg1_summary,prev_kg2_summary,prev_kg3_summary])
+        
+        
+    current=entry["current_utterance"]
+    response=entry["response"] if "response" in entry else entry["gold_response"]
+    summary_lines=summary.split("\n")
+    history_lines=history.split("\n")
+    history_lines=[x for x in history_lines if not x.startswith("__SILENCE__")]
+    last_two_utterances=history_lines[-2:]
+    
+    prev_utt=prev_entry["current_utterance"] 
+    prev_response=prev_entry["response"] if "response" in prev_entry else prev_entry["gold_response"]
+    new_sents=prev_summary_lines
+    '''for i,sent in enumerate(prev_summary_lines):
+        if bart_summary:
+            new_sent=sent
         else:
-            last_line=history_lines[-1]
-        new_summary=""
-        if last_line.startswith("Person2:"):
-            # new_summary=summary.replace("Person2","Bot").replace("Person1","User")
-            pass
+            new_sent=str(i+1)+": "+sent
+        new_sents.append(new_sent)'''
+    prompt1="\n".join(new_sents)
+    prompt2=prev_utt
+    prompt3=prev_response
+    '''new_sents=[]
+    for i,sent in enumerate(summary_lines):
+        if bart_summary or no_prompt_blenderbot:
+            new_sent=sent
         else:
-            # new_summary=summary.replace("Person2","User").replace("Person1","Bot")
-            new_summary=summary.replace("Person2","Person1").replace("Person1","Person2")
-        return new_summary
-    
-    def dfs_util(content,i,visited,new_content):
-        #print(content)
-        if i==len(content):
-            return 
-
-        visited[i]=True
-        new_content.append(content[i])
-        same_speaker=((i+1)<len(content)) and content[i].split(":")[0]==content[i+1].split(":")[0]
-        #print(same_speaker)
-        #print(len(content))
-        #print(content[i].split(":")[0])
-        #print(content[i+1].split(":")[0])
-        if same_speaker and not visited[i+1]:
-            dfs_util(content,i+1,visited,new_content)
-    
-    def dfs(content):
-        content=content.split("\n")
-        visited=[False]*len(content)
-        revised_content=[]
-        for i in range(len(content)):
-            if not visited[i]:
-                new_content=[]
-                dfs_util(content,i,visited,new_content)
-                #print(new_content)
-                
-                speaker=new_content[0].split(":")[0]
-                utt=""
-                prev_utt="."
-                for j in range(len(new_content)):
-                    if len(new_content[j])==0 or prev_utt==new_content[j]:
-                        continue
-                    utt+=new_content[j].split(":")[1]+" "
-                    prev_utt=new_content[j]
-                utt=utt.strip()
-                utt=speaker+": "+utt
-                if len(utt)>0:
-                    revised_content.append(utt)
-
-        return "\n".join(revised_content)
-    
-    with open(input_file,"r",encoding="utf-8") as fp:
-         content=fp.readlines()
-
-    summaries=[x.strip() for x in content]
-    prompts=[]
-    local_index=0
-    for ind,entry in enumerate(summaries):
-        if len(entry)==0 or ind==0 or len(summaries[ind-1])==0:
-            continue
-        entry=json.loads(entry)
-        prev_entry=json.loads(summaries[ind-1])
-        history=entry["history"]
-        if "past_utterance" in entry:
+            new_sent=str(i+1)+": "+sent
+        new_sents.append(new_sent)'''
+    prompt4="\n".join(summary_lines)
+    prompt5=current
+    if use_shorter_template:
+        if has_persona_and_summary:
+            if prompt_template.count('{') != 4:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(current_user_summary,current_bot_summary,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona}
+        elif has_knowledge_and_summary:                
+            if prompt_template.count('{') != 3:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(total_knowledge,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind}
+        elif has_persona_only:
+            if prompt_template.count('{') != 3:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(current_user_summary,current_bot_summary,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona}
+        elif has_knowledge_only:
+            if prompt_template.count('{') != 2:
+                raise ValueError("The number of positional arguments is incorrect")
+            
+            return {"prompt":prompt_template.format(total_knowledge,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind}
+                       
         
-            summary=entry["past_utterance"]
-            prev_summary_lines=prev_entry["past_utterance"].split("\n")
-        elif "semantic_utterances" in entry:
-            summary=entry["semantic_utterances"]
-            prev_summary=prev_entry["semantic_utterances"]
-            if segment_utt:
-                summary=dfs(summary)
-                prev_summary=dfs(prev_summary)
-                
-            prev_summary_lines=prev_summary.split("\n")
+        elif current_utterance_only:
+            #print(no_prompt_short_template)
+            return {"prompt":prompt_template.format(prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"id":ind}
+        elif no_prompt_blenderbot:
+            return {"prompt":prompt5.strip(),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"id":ind}
+          
         else:
-            summary=entry["summary"].replace("<n>",".")
-            prev_summary_lines=prev_entry["summary"].replace("<n>",".").split("\n")
-        if bart_summary:
-            #Convert Person1 and Person2 to User and Bot , based on the last line in history
-            #check the last line of history
-            summary=process_summary(entry["history"],entry["summary"])
-            prev_summary=process_summary(prev_entry["history"],prev_entry["summary"])
-            prev_summary_lines=prev_summary.split("\n")
+
+            return {"prompt":prompt_template.format(prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind}
+       
             
-        if has_persona_only or has_persona_and_summary or has_knowledge_only or has_knowledge_and_summary or use_fsb_prompt:
-            if "user_summary" in entry:
-
-                current_user_summary=entry["user_summary"].replace("\n",".")
-                current_bot_summary=entry["bot_summary"].replace("\n",".")
-                persona=current_user_summary+"\t"+current_bot_summary
-                previous_user_summary=prev_entry["bot_summary"].replace("\n",".")
-                previous_bot_summary=prev_entry["user_summary"].replace("\n",".")
-            if "kg1_summary" in entry:
-                kg1_summary=entry["kg1_summary"].replace("\n",".")
-                kg2_summary=entry["kg2_summary"].replace("\n",".")
-                kg3_summary=entry["kg3_summary"].replace("\n",".")
-                total_knowledge="\t".join([kg1_summary,kg2_summary,kg3_summary])
-                prev_kg1_summary=prev_entry["kg1_summary"].replace("\n",".") if "kg1_summary" in prev_entry else ""
-                prev_kg2_summary=prev_entry["kg1_summary"].replace("\n",".") if "kg2_summary" in prev_entry else ""
-                prev_kg3_summary=prev_entry["kg1_summary"].replace("\n",".") if "kg3_summary" in prev_entry else ""
-                prev_total_knowledge="\t".join([prev_kg1_summary,prev_kg2_summary,prev_kg3_summary])
+   
+    else:
+        if has_persona_and_summary:
+            if prompt_template.count('{') != 9:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(previous_user_summary,previous_bot_summary,prompt1,prompt2,prompt3,current_user_summary,current_bot_summary,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona}
             
+        elif has_knowledge_and_summary:
+            if prompt_template.count('{') != 7:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(total_knowledge,prompt1,prompt2,prompt3,prev_total_knowledge,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind}
             
-        current=entry["current_utterance"]
-        response=entry["response"] if "response" in entry else entry["gold_response"]
-        summary_lines=summary.split("\n")
-        history_lines=history.split("\n")
-        history_lines=[x for x in history_lines if not x.startswith("__SILENCE__")]
-        last_two_utterances=history_lines[-2:]
+        elif has_persona_only:
+            if prompt_template.count('{') != 7:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(previous_user_summary,previous_bot_summary,prompt2,prompt3,current_user_summary,current_bot_summary,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona}
         
-        prev_utt=prev_entry["current_utterance"] 
-        prev_response=prev_entry["response"] if "response" in prev_entry else prev_entry["gold_response"]
-        new_sents=prev_summary_lines
-        '''for i,sent in enumerate(prev_summary_lines):
-            if bart_summary:
-                new_sent=sent
-            else:
-                new_sent=str(i+1)+": "+sent
-            new_sents.append(new_sent)'''
-        prompt1="\n".join(new_sents)
-        prompt2=prev_utt
-        prompt3=prev_response
-        '''new_sents=[]
-        for i,sent in enumerate(summary_lines):
-            if bart_summary or no_prompt_blenderbot:
-                new_sent=sent
-            else:
-                new_sent=str(i+1)+": "+sent
-            new_sents.append(new_sent)'''
-        prompt4="\n".join(summary_lines)
-        prompt5=current
-        if use_shorter_template:
-            if has_persona_and_summary:
-                if prompt_template.count('{') != 4:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(current_user_summary,current_bot_summary,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona})
-            elif has_knowledge_and_summary:                
-                if prompt_template.count('{') != 3:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(total_knowledge,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind})
-            elif has_persona_only:
-                if prompt_template.count('{') != 3:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(current_user_summary,current_bot_summary,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona})
-            elif has_knowledge_only:
-                if prompt_template.count('{') != 2:
-                    raise ValueError("The number of positional arguments is incorrect")
-                
-                prompts.append({"prompt":prompt_template.format(total_knowledge,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind})
-                           
-            
-            elif current_utterance_only:
-                #print(no_prompt_short_template)
-                prompts.append({"prompt":prompt_template.format(prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"id":ind})
-            elif no_prompt_blenderbot:
-                prompts.append({"prompt":prompt5.strip(),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"id":ind})
+        elif has_knowledge_only:
+            if prompt_template.count('{') != 5:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(total_knowledge,prompt2,prompt3,prev_total_knowledge,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind}
               
-            else:
-
-                prompts.append({"prompt":prompt_template.format(prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind})
-           
-                
-       
+        elif current_utterance_only:
+            if prompt_template.count('{') != 3:
+                raise ValueError("The number of positional arguments is incorrect")
+            return {"prompt":prompt_template.format(prompt2,prompt3,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"id":ind}
+        elif no_prompt_blenderbot:
+            return {"prompt":prompt4+"\n"+prompt5.strip(),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4.strip(),"id":ind}
+                     
         else:
-            if has_persona_and_summary:
-                if prompt_template.count('{') != 9:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(previous_user_summary,previous_bot_summary,prompt1,prompt2,prompt3,current_user_summary,current_bot_summary,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona})
-                
-            elif has_knowledge_and_summary:
-                if prompt_template.count('{') != 7:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(total_knowledge,prompt1,prompt2,prompt3,prev_total_knowledge,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind})
-                
-            elif has_persona_only:
-                if prompt_template.count('{') != 7:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(previous_user_summary,previous_bot_summary,prompt2,prompt3,current_user_summary,current_bot_summary,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind,"personas":persona})
-            
-            elif has_knowledge_only:
-                if prompt_template.count('{') != 5:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(total_knowledge,prompt2,prompt3,prev_total_knowledge,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind})
-                  
-            elif current_utterance_only:
-                if prompt_template.count('{') != 3:
-                    raise ValueError("The number of positional arguments is incorrect")
-                prompts.append({"prompt":prompt_template.format(prompt2,prompt3,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"id":ind})
-            elif no_prompt_blenderbot:
-                prompts.append({"prompt":prompt4+"\n"+prompt5.strip(),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4.strip(),"id":ind})
-                         
-            else:
-                if prompt_template.count('{') != 5:
-                    raise ValueError("The number of positional arguments is incorrect")
-                 
-                prompts.append({"prompt":prompt_template.format(prompt1,prompt2,prompt3,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind})
-           
-                 
-    return prompts
+            if prompt_template.count('{') != 5:
+                raise ValueError("The number of positional arguments is incorrect")
+             
+            return {"prompt":prompt_template.format(prompt1,prompt2,prompt3,prompt4,prompt5),"gold_response":response,"history":history.strip(),"current_utterance":prompt5.strip(),"summary":prompt4,"id":ind}
+    return None
+
     
 
 # Unit Test
@@ -0,0 +1,142 @@
+import os
+import json
+import glob
+import shutil
+
+
+def shard_dir_for(output_file):
+    """Directory holding the per-process checkpoint shards of an output file"""
+    if output_file.endswith(".jsonl"):
+        output_file = output_file[:-len(".jsonl")]
+    return output_file + ".shards"
+
+
+def shard_file(shard_dir, process_index):
+    # process_index: rank of a generation process, or a name for other writers (e.g. cache hits)
+    if isinstance(process_index, int):
+        process_index = f"{process_index:03d}"
+    return os.path.join(shard_dir, f"shard-{process_index}.jsonl")
+
+
+def open_shard(shard_dir, process_index):
+    """Open the shard of a process for appending"""
+    os.makedirs(shard_dir, exist_ok=True)
+    path = shard_file(shard_dir, process_index)
+    fp = open(path, "a")
+    # Terminate a line left truncated by a crash, so the next entry starts on its own line
+    if fp.tell() > 0:
+        with open(path, "rb") as check:
+            check.seek(-1, os.SEEK_END)
+            if check.read(1) != b"\n":
+                fp.write("\n")
+    return fp
+
+
+def read_shards(shard_dir):
+    """
+    Yields every entry written to the shards of shard_dir.
+    A run killed in the middle of a write leaves a truncated last line, which is skipped.
+    """
+    for path in sorted(glob.glob(os.path.join(shard_dir, "shard-*.jsonl"))):
+        with open(path, "r") as fp:
+            for line in fp:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def load_completed_ids(shard_dir):
+    """Ids of the instances already generated by a previous (possibly crashed) run"""
+    if not os.path.isdir(shard_dir):
+        return set()
+    return set(entry["id"] for entry in read_shards(shard_dir) if "id" in entry)
+
+
+def append_entries(fp, entries):
+    """Append entries to an open shard and make them durable before moving on to the next batch"""
+    for entry in entries:
+        fp.write(json.dumps(entry) + "\n")
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def merge_shards(shard_dir):
+    """All entries of the shards, deduplicated and sorted by id"""
+    by_id = {}
+    for entry in read_shards(shard_dir):
+        by_id[entry["id"]] = entry
+    return [by_id[idx] for idx in sorted(by_id)]
+
+
+def response_entry(example, response, model_path):
+    """Output entry for a prompt record, in the format written by generate_responses"""
+    if model_path == "dv3":
+        return {**example, "predicted_response": response}
+    return {"prompts": example["prompt"], "current_utterance": example["current_utterance"].strip(), "predicted_response": response,
+            "gold_response": example["gold_response"].strip(), "history": example["history"].strip(),
+            "summary": example.get("summary", "").strip(), "id": example["id"]}
+
+
+class ResultWriter:
+    """
+    Writer for generated responses.
+    Every generation process writes its batches directly to its own shard of the output
+    (no stdout capture), entries are validated once when they are written, and merge()
+    builds the final output file deterministically ordered by id.
+    """
+
+    required_keys = ["predicted_response", "gold_response", "current_utterance", "history", "id"]
+
+    def __init__(self, output_file, process_index=0):
+        self.output_file = output_file
+        self.shard_dir = shard_dir_for(output_file)
+        self.process_index = process_index
+        self.fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def validate(self, entry):
+        for key in self.required_keys:
+            if key not in entry:
+                raise ValueError(f"Key {key} missing from generated entry {entry.get('id')}")
+        if ("prompts" not in entry) and ("prompt" not in entry):
+            raise ValueError(f"Prompt missing from generated entry {entry['id']}")
+        if not isinstance(entry["predicted_response"], str):
+            raise ValueError(f"predicted_response of entry {entry['id']} is not a string")
+
+    def completed_ids(self):
+        return load_completed_ids(self.shard_dir)
+
+    def write(self, entries):
+        for entry in entries:
+            self.validate(entry)
+        if self.fp is None:
+            self.fp = open_shard(self.shard_dir, self.process_index)
+        append_entries(self.fp, entries)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def merge(self, cleanup=True):
+        """Write the deduplicated, id-ordered output file from all shards. Returns the number of entries."""
+        entries = merge_shards(self.shard_dir)
+        out_dir = os.path.dirname(self.output_file)
+        if out_dir and not os.path.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+        with open(self.output_file, "w") as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry) + "\n")
+        # The run is complete, the checkpoint is not needed anymore
+        if cleanup:
+            shutil.rmtree(self.shard_dir, ignore_errors=True)
+        return len(entries)
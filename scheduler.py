@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import subprocess
+
+import pandas as pd
+
+from launcher import cmdline_args, expand_sweep, get_output_path, dataset_info
+
+
+class Job:
+    """
+    A node of the sweep DAG.
+    cmd: command line run in a subprocess, or fn: callable run in the scheduler process.
+    resource: the slot type the job occupies while running ("gpu" or "cpu").
+    outputs: files produced by the job, it is skipped when they all exist (and no dependency was rerun).
+    partial: run even if some dependencies failed (aggregation over whatever finished).
+    """
+
+    def __init__(self, name, resource, outputs, deps=(), cmd=None, fn=None, partial=False):
+        self.name = name
+        self.resource = resource
+        self.outputs = outputs
+        self.deps = list(deps)
+        self.cmd = cmd
+        self.fn = fn
+        self.partial = partial
+        self.state = "pending"     # pending, running, done, skipped, failed
+        self.ran = False
+        self.proc = None
+        self.slot = None
+        self.log_fp = None
+        self.start = None
+
+    def outputs_exist(self):
+        return all(os.path.exists(path) for path in self.outputs)
+
+
+def config_flags(config):
+    """Command line flags of launcher.py for a config"""
+    flags = ["-d", config.dataset, "-m", config.model, "-pt", config.prompt_type, "-hst", config.history_signal_type, "-hk", str(config.history_k)]
+    if config.few_shot:
+        flags.append("--few_shot")
+    if config.background_knowledge:
+        flags.append("--background_knowledge")
+    return flags
+
+
+def configs_from_file(cmds_file, launcher_args):
+    """Configs of a file of launcher.py command lines (e.g. analysis/data/cmds_superset.sh)"""
+    configs = []
+    with open(cmds_file, "r") as fp:
+        for line in fp:
+            argv = shlex.split(line, comments=True)
+            if "launcher.py" not in argv:
+                continue
+            argv = argv[argv.index("launcher.py") + 1:]
+            argv = [x for x in argv if x not in ["-e", "--eval_mode"]]
+            configs.append(cmdline_args(argv + launcher_args))
+    return configs
+
+
+def aggregate(eval_files, out_file):
+    """Collects the .eval.json results of a dataset into one csv"""
+    rows = []
+    for eval_file in eval_files:
+        if not os.path.exists(eval_file):
+            continue
+        with open(eval_file, "r") as fp:
+            row = json.load(fp)
+        row["config"] = os.path.basename(eval_file).replace(".eval.json", "")
+        rows.append(row)
+    df = pd.DataFrame(rows)
+    if len(rows) > 0:
+        df = df.set_index("config").sort_index()
+    df.to_csv(out_file)
+    print(f"Aggregated {len(rows)} results into {out_file}")
+
+
+def build_dag(configs, launcher_args, eval_resource="cpu"):
+    """generate -> evaluate jobs per config, and an aggregate job per dataset over its evaluations"""
+    jobs = []
+    evals_by_dataset = {}
+    for config in configs:
+        path, output_filename = get_output_path(config)
+        output_file = os.path.join(path, output_filename)
+        eval_file = os.path.join(path, output_filename.replace(".jsonl", ".eval.json"))
+        flags = config_flags(config) + launcher_args
+        name = output_filename.replace(".jsonl", "")
+
+        gen = Job(f"gen:{config.dataset}/{name}", "gpu", [output_file], cmd=[sys.executable, "launcher.py"] + flags)
+        ev = Job(f"eval:{config.dataset}/{name}", eval_resource, [eval_file], deps=[gen], cmd=[sys.executable, "launcher.py", "-e"] + flags)
+        jobs += [gen, ev]
+        evals_by_dataset.setdefault(config.dataset, []).append(ev)
+
+    for dataset, evals in evals_by_dataset.items():
+        _, input_dataset, _ = dataset_info(dataset)
+        out_file = os.path.join("outputs", input_dataset, "sweep_results.csv")
+        eval_files = [ev.outputs[0] for ev in evals]
+        jobs.append(Job(f"aggregate:{dataset}", "cpu", [out_file], deps=evals, partial=True, fn=lambda eval_files=eval_files, out_file=out_file: aggregate(eval_files, out_file)))
+    return jobs
+
+
+class Scheduler:
+    """
+    Runs a job DAG with a fixed number of worker slots per resource type.
+    Generation of the next configs (gpu slots) overlaps with the evaluation of the finished ones
+    (cpu slots), so a sweep takes about max(generation, evaluation) instead of their sum.
+    Every gpu slot is pinned to one device through CUDA_VISIBLE_DEVICES, cpu slots see no device.
+    """
+
+    def __init__(self, jobs, slots, log_dir="logs/scheduler", poll_interval=1.0, dry_run=False):
+        self.jobs = jobs
+        self.slots = slots
+        self.free_slots = {resource: list(range(n)) for resource, n in slots.items()}
+        self.log_dir = log_dir
+        self.poll_interval = poll_interval
+        self.dry_run = dry_run
+
+    def _ready(self, job):
+        finished = ["done", "skipped", "failed"] if job.partial else ["done", "skipped"]
+        return job.state == "pending" and all(dep.state in finished for dep in job.deps)
+
+    def _resolve(self, job):
+        """Skip or fail a job without running it. Returns True if the job was resolved."""
+        if not job.partial and any(dep.state == "failed" for dep in job.deps):
+            job.state = "failed"
+            print(f"[blocked] {job.name}")
+            return True
+        if self._ready(job) and job.outputs_exist() and not any(dep.ran for dep in job.deps):
+            job.state = "skipped"
+            return True
+        return False
+
+    def _launch(self, job):
+        job.slot = self.free_slots[job.resource].pop(0)
+        job.start = time.time()
+        job.state = "running"
+        job.ran = True
+        print(f"[start] {job.name} ({job.resource}:{job.slot})")
+        if self.dry_run:
+            print("  " + (" ".join(job.cmd) if job.cmd is not None else "in-process"))
+            self._finish(job, 0)
+            return
+        if job.fn is not None:
+            try:
+                job.fn()
+                self._finish(job, 0)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                self._finish(job, 1)
+            return
+        env = dict(os.environ)
+        if job.resource == "gpu":
+            env["CUDA_VISIBLE_DEVICES"] = str(job.slot)
+        else:
+            # DEB, BLEURT and BERTScore move to cuda when they see a GPU, keep cpu jobs off the generation GPUs
+            env["CUDA_VISIBLE_DEVICES"] = ""
+        os.makedirs(self.log_dir, exist_ok=True)
+        job.log_fp = open(os.path.join(self.log_dir, job.name.replace("/", "__").replace(":", "_") + ".log"), "w")
+        job.proc = subprocess.Popen(job.cmd, stdout=job.log_fp, stderr=subprocess.STDOUT, env=env)
+
+    def _finish(self, job, returncode):
+        self.free_slots[job.resource].append(job.slot)
+        self.free_slots[job.resource].sort()
+        if job.log_fp is not None:
+            job.log_fp.close()
+        # A job that exits cleanly without writing its outputs did not succeed either
+        if returncode == 0 and (self.dry_run or job.outputs_exist()):
+            job.state = "done"
+            print(f"[done] {job.name} in {time.time() - job.start:.0f}s")
+        else:
+            job.state = "failed"
+            print(f"[failed] {job.name} (exit code {returncode})", file=sys.stderr)
+
+    def run(self):
+        while True:
+            for job in self.jobs:
+                if job.state == "pending":
+                    self._resolve(job)
+            for job in self.jobs:
+                if self._ready(job) and len(self.free_slots[job.resource]) > 0:
+                    self._launch(job)
+
+            running = [job for job in self.jobs if job.state == "running"]
+            if len(running) == 0 and not any(self._ready(job) for job in self.jobs):
+                break
+            time.sleep(self.poll_interval)
+            for job in running:
+                if job.proc is not None and job.proc.poll() is not None:
+                    self._finish(job, job.proc.returncode)
+
+        counts = {}
+        for job in self.jobs:
+            counts[job.state] = counts.get(job.state, 0) + 1
+        print(f"Scheduler done: {counts}")
+        return [job for job in self.jobs if job.state == "failed"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep scheduler: generate -> evaluate -> aggregate for every config of the grid")
+    parser.add_argument('--cmds_file', type=str, default=None, help='File of launcher.py command lines (e.g. analysis/data/cmds_superset.sh) instead of the built-in grid')
+    parser.add_argument('--gpu_slots', type=int, default=1, help='Generation jobs run concurrently (one per GPU)')
+    parser.add_argument('--cpu_slots', type=int, default=2, help='Evaluation jobs run concurrently')
+    parser.add_argument('--eval_resource', type=str, default="cpu", choices=["cpu", "gpu"], help='Slot type used by evaluation jobs')
+    parser.add_argument('--log_dir', type=str, default="logs/scheduler", help='Output of every job goes to a log file here')
+    parser.add_argument('--dry_run', action="store_true", help='Print the jobs that would run')
+    args, launcher_argv = parser.parse_known_args()
+
+    # Unknown arguments are launcher.py options (--sweep_datasets/--sweep_models select the grid,
+    # the rest, e.g. -bs or --no_cache, is passed on to every job)
+    launcher_args = cmdline_args(launcher_argv)
+    passthrough = list(launcher_argv)
+    for option in ["--sweep_datasets", "--sweep_models"]:
+        if option in passthrough:
+            i = passthrough.index(option) + 1
+            while i < len(passthrough) and not passthrough[i].startswith("-"):
+                i += 1
+            del passthrough[passthrough.index(option):i]
+
+    if args.cmds_file is not None:
+        configs = configs_from_file(args.cmds_file, passthrough)
+    else:
+        configs = expand_sweep(launcher_args)
+    jobs = build_dag(configs, passthrough, eval_resource=args.eval_resource)
+    print(f"{len(configs)} configs, {len(jobs)} jobs")
+
+    slots = {"gpu": args.gpu_slots, "cpu": args.cpu_slots}
+    failed = Scheduler(jobs, slots, log_dir=args.log_dir, dry_run=args.dry_run).run()
+    for job in failed:
+        print(f"FAILED: {job.name}")
+    sys.exit(1 if len(failed) > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import queue
+import itertools
+
+import torch
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+
+def _worker(worker_index, model, tokenizer, task_queue, progress_queue, write_to_file, cache_path, model_path,
+            precision_mode, bs, max_seq_length, min_length, max_length, n_threads):
+    """
+    Generation worker. model lives in shared memory and is only read here; prompts arrive in
+    chunks through task_queue (None ends the worker).
+    """
+    from resultutils import ResultWriter, response_entry
+    from gencache import GenerationCache
+
+    torch.set_num_threads(n_threads)
+    writer = ResultWriter(write_to_file, worker_index)
+    cache = GenerationCache(cache_path) if cache_path is not None else None
+
+    with torch.inference_mode():
+        while True:
+            chunk = task_queue.get()
+            if chunk is None:
+                break
+            # Length-sorted batches inside the chunk, padded to their longest member
+            chunk.sort(key=lambda example: len(example["prompt"]), reverse=True)
+            for i in range(0, len(chunk), bs):
+                batch = chunk[i:i + bs]
+                prompts = [example["prompt"] for example in batch]
+                inputs = tokenizer(prompts, return_tensors="pt", padding=True, truncation=True, max_length=max_seq_length)
+                preds = model.generate(**inputs, min_length=min_length, max_length=max_length)
+                responses = tokenizer.batch_decode(preds, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+                writer.write([response_entry(example, response, model_path) for example, response in zip(batch, responses)])
+                if cache is not None:
+                    cache.put_many(model_path, [(GenerationCache.make_key(model_path, prompt, min_length, max_length, precision_mode), response)
+                                                for prompt, response in zip(prompts, responses)])
+                progress_queue.put(len(batch))
+
+    writer.close()
+    if cache is not None:
+        cache.close()
+
+
+def _put(task_queue, item, workers):
+    # Do not block forever on a full queue if the workers died
+    while True:
+        try:
+            task_queue.put(item, timeout=5)
+            return
+        except queue.Full:
+            if not any(p.is_alive() for p in workers):
+                raise Exception("All generation workers died, rerun to resume from the written shards")
+
+
+def generate_shared(tokenizer, model, prompts, write_to_file, num_workers, bs=8, chunk_size=None, cache_path=None,
+                    model_path=None, precision_mode="cpu-fp32", max_seq_length=1024, min_length=24, max_length=128):
+    """
+    Multi-process CPU generation with a single copy of the weights.
+
+    The parameters are moved to shared memory once (model.share_memory()) and the workers attach
+    to them read-only instead of each holding a private copy of the checkpoint, so the number of
+    workers is bounded by cores rather than RAM. prompts (a list or a lazy iterator) is cut into
+    chunks that the workers pull from a bounded queue; every worker writes its own ResultWriter shard.
+    """
+    model.eval()
+    model.share_memory()
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if chunk_size is None:
+        chunk_size = 4 * bs
+    n_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    # spawn: forking a process that already runs torch intra-op threads can deadlock
+    ctx = mp.get_context("spawn")
+    task_queue = ctx.Queue(maxsize=2 * num_workers)
+    progress_queue = ctx.Queue()
+    workers = []
+    for worker_index in range(num_workers):
+        p = ctx.Process(target=_worker, args=(worker_index, model, tokenizer, task_queue, progress_queue, write_to_file,
+                                              cache_path, model_path, precision_mode, bs, max_seq_length, min_length, max_length, n_threads))
+        p.start()
+        workers.append(p)
+
+    pbar = tqdm(desc=f"cpu x{num_workers}...")
+    prompts = iter(prompts)
+    while True:
+        chunk = list(itertools.islice(prompts, chunk_size))
+        if len(chunk) == 0:
+            break
+        _put(task_queue, chunk, workers)
+        while not progress_queue.empty():
+            pbar.update(progress_queue.get())
+    for _ in workers:
+        _put(task_queue, None, workers)
+    for p in workers:
+        p.join()
+    while not progress_queue.empty():
+        pbar.update(progress_queue.get())
+    pbar.close()
+
+    failed = [p.exitcode for p in workers if p.exitcode != 0]
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} generation workers failed, rerun to resume from the written shards")
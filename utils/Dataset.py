@@ -1,6 +1,75 @@
 import torch
 from abc import abstractmethod, ABC
 
+
+class HistoryTokenizer:
+    """
+    Tokenizes dialogue histories from per-utterance token ids.
+    Consecutive turns of a dialogue share all but their last history utterance, so each distinct
+    utterance is tokenized once and a history's ids are the concatenation of its utterances' ids,
+    instead of re-tokenizing the whole (growing) history for every turn.
+
+    This is only equal to tokenizing the joined history when the tokenizer splits on whitespace before
+    subword tokenization (WordPiece, as DEB's bert-base-uncased). That is probed once at construction;
+    for any other tokenizer whole histories are tokenized (and still cached per distinct string).
+    """
+
+    def __init__(self, tokenizer, sep="\n", max_cached=500000):
+        self.tokenizer = tokenizer
+        self.sep = sep
+        self.max_cached = max_cached
+        self._ids = {}
+        probe = ["Hello there, how are you?", "I'm fine; thanks!", "  ok  "]
+        self.exact = self.tokenizer.encode(sep.join(probe), add_special_tokens=False) == \
+            [token for utterance in probe for token in self.tokenizer.encode(utterance, add_special_tokens=False)]
+
+    def utterance_ids(self, utterance):
+        if utterance not in self._ids:
+            if len(self._ids) > self.max_cached:
+                self._ids.clear()
+            self._ids[utterance] = self.tokenizer.encode(utterance, add_special_tokens=False)
+        return self._ids[utterance]
+
+    def history_ids(self, history):
+        """Token ids (no special tokens) of a history: a list of utterances or a sep-joined string"""
+        if isinstance(history, str):
+            if not self.exact:
+                return self.utterance_ids(history)
+            history = history.split(self.sep)
+        elif not self.exact:
+            return self.utterance_ids(self.sep.join(history))
+        ids = []
+        for utterance in history:
+            ids.extend(self.utterance_ids(utterance))
+        return ids
+
+    def encode(self, history, max_len=None):
+        """Same ids as tokenizer.encode(sep.join(history)), left-trimmed to the max_len most recent tokens"""
+        ids = self.tokenizer.build_inputs_with_special_tokens(self.history_ids(history))
+        if max_len is not None and len(ids) >= max_len:
+            ids = ids[-max_len:]
+        return ids
+
+    def encode_pair(self, history, response):
+        """
+        Same encoding as tokenizer(sep.join(history), response, truncation=True), or None when the pair
+        would be truncated or the response has no tokens (the caller then falls back to the tokenizer:
+        an empty response is encoded as no pair at all, a whitespace-only one as an empty second segment).
+        """
+        history_ids = self.history_ids(history)
+        response_ids = self.utterance_ids(response)
+        if not response_ids:
+            return None
+        if len(history_ids) + len(response_ids) + self.tokenizer.num_special_tokens_to_add(pair=True) > self.tokenizer.model_max_length:
+            return None
+        input_ids = self.tokenizer.build_inputs_with_special_tokens(history_ids, response_ids)
+        encoding = {"input_ids": input_ids}
+        if "token_type_ids" in self.tokenizer.model_input_names:
+            encoding["token_type_ids"] = self.tokenizer.create_token_type_ids_from_sequences(history_ids, response_ids)
+        encoding["attention_mask"] = [1] * len(input_ids)
+        return encoding
+
+
 # TODO: Review the max_len argument and the trim technique in the _custom_tok method
 class BaseDataset(ABC):
     """
@@ -11,6 +80,7 @@ class BaseDataset(ABC):
     def __init__(self, tokenizer=None):
         self.data = []
         self.tokenizer = tokenizer
+        self.history_tokenizer = HistoryTokenizer(tokenizer) if tokenizer else None
 
         if not self.tokenizer:
             print("WARNING: Tokenizer not instantiated, only raw text will be available, manual tokenization is required!")
@@ -93,6 +163,21 @@ class BaseDataset(ABC):
             tokens = utterance
 
         return tokens
+
+    def _custom_tok_history(self, utterances, max_len=128):
+        """
+        _custom_tok("\\n".join(utterances), max_len), with every utterance tokenized only once
+        over the dataset (see HistoryTokenizer).
+        """
+        if not self.tokenizer:
+            return "\n".join(utterances)
+
+        tokens = dict()
+        tokens["text"] = "\n".join(utterances)
+        # NOTE: Just keep the most recent part of the history
+        tokens["input_ids"] = torch.tensor([self.history_tokenizer.encode(utterances, max_len=max_len)])
+        tokens["attention_mask"] = torch.ones(tokens["input_ids"].shape)
+        return tokens
     
     def __len__(self):
         return len(self.data)
@@ -104,3 +189,30 @@ class BaseDataset(ABC):
     def __iter__(self):
         for data in self.data:
             yield data
+
+
+# Unit Test
+if __name__ == "__main__":
+    import random
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
+    history_tokenizer = HistoryTokenizer(tokenizer)
+    random.seed(0)
+    words = "The cat cats sat on a mat , . ran running fast it's I'm fine hello how are you ?".split()
+    utterances = [" ".join(random.choices(words, k=random.randint(1, 30))) for _ in range(200)]
+    responses = utterances[1:] + ["", " ", "\n", "  \t "]
+    n_encoded = 0
+    for i, response in enumerate(responses):
+        history = utterances[max(0, i - 10):i + 1]
+        encoding = history_tokenizer.encode_pair(history, response)
+        expected = dict(tokenizer("\n".join(history), response, truncation=True))
+        if encoding is not None:
+            assert encoding == expected, (history, response, encoding, expected)
+            n_encoded += 1
+        assert history_tokenizer.encode(history, max_len=128) == tokenizer.encode("\n".join(history))[-128:]
+    # Empty and whitespace-only responses are left to the tokenizer
+    for response in ["", " ", "\n", "  \t "]:
+        assert history_tokenizer.encode_pair(utterances[:3], response) is None
+    print(f"{n_encoded}/{len(responses)} pairs encoded from the utterance cache")
+    print("OK")
@@ -4,7 +4,6 @@ import json
 import time
 import argparse
 import traceback
-import multiprocessing
 
 import evaluate 
 import numpy as np
@@ -13,10 +12,22 @@ from utils.deb.eval_deb import DEB
 # from ctc_score import DialogScorer
 from transformers import AutoTokenizer
 from bleurt import score as bleurt_scorer
+from bleurt import checkpoint as bleurt_checkpoint
+from utils.metrics.bleu import sentence_bleu
+from utils.metrics.rouge import RougeScorer
+from utils.metrics.meteor import Meteor
+from utils.metrics.bertscore import BertScorer
+from utils.score_store import ScoreStore
 
 class Evaluator:
     
-    def __init__(self):
+    def __init__(self, meteor_lexicon="cache/meteor_lexicon.json", score_store="cache/scores.sqlite", deb_precision="fp32", bleurt_token_budget=16384):
+        """
+        meteor_lexicon: file persisting the stem/synonym lookups of METEOR across runs (None to keep them in memory)
+        score_store: per-pair score store consulted before computing any metric (None to always recompute)
+        deb_precision: "fp32", or "bf16" / "int8" to run DEB cheaper on CPU
+        bleurt_token_budget: max tokens (pairs x padded length) per BLEURT batch, for checkpoints with dynamic sequence lengths
+        """
         # List function and the dependencies
         self.supported_metrics = {
             "bleu": (self.bleu_f, self.check_pred_gt),
@@ -35,6 +46,11 @@ class Evaluator:
         self.e_roberta = None
         self.bleurt = None
         self.tokenizer = None
+        self.meteor = None
+        self.meteor_lexicon = meteor_lexicon
+        self.store = ScoreStore(score_store) if score_store is not None else None
+        self.deb_precision = deb_precision
+        self.bleurt_token_budget = bleurt_token_budget
 
     def _parse(self, input_file):
         data = []
@@ -128,200 +144,63 @@ class Evaluator:
         return True, message
     
     def bleu_f(self, data):
-        bleu = evaluate.load("bleu")
-        reqd_vals = ["bleu"]
+        # Same scores as averaging evaluate's bleu over max_order 1..4, computed in one pass
+        predictions = [instance["predicted_response"] for instance in data]
+        references = [instance["gold_response"] for instance in data]
+        scores = sentence_bleu(predictions, references, max_order=4)
+        return {"bleu": scores.tolist()}
 
-        results = dict()
-        for val in reqd_vals:
-            results[val] = []
-
-        for instance in tqdm(data, desc="bleu..."):
-            total = 0
-            # incorporate averages
-            for max_order in range(4):
-                ### Caution: total has to be a dict for multiple metrics
-                for metric in reqd_vals:
-                    computed_val = bleu.compute(predictions=[instance["predicted_response"]], references=[instance["gold_response"]], max_order=max_order + 1)
-                    total += computed_val[metric]
-
-            for metric in reqd_vals:
-                results[metric].append(total / 4)
-
-        print(np.mean(results["bleu"]) / 22484)
-        return results
-
-    def _compute_meteor(self, pid, data, results):
-        meteor = evaluate.load("meteor")
-        reqd_vals = ["meteor"]
-
-        my_results = dict()
-        for val in reqd_vals:
-            my_results[val] = []
-
-        if pid == 0:
-            for instance in tqdm(data, desc="meteor..."):
-                computed_val = meteor.compute(predictions=[instance["predicted_response"]], references=[instance["gold_response"]])
-                for metric in reqd_vals:
-                    my_results[metric].append(computed_val[metric])
-        else:
-            for instance in data:
-                computed_val = meteor.compute(predictions=[instance["predicted_response"]], references=[instance["gold_response"]])
-                for metric in reqd_vals:
-                    my_results[metric].append(computed_val[metric])
-
-        results[pid] = my_results
-        
     def meteor_f(self, data):
-        n_proc = 24
-        if len(data) < 1000:
-            n_proc = 6
-        elif len(data) < 3000:
-            n_proc = 12
-
-        #n_proc = 1
-
-        chunked_data = self._chunk(data, n_proc)
-
-        manager = multiprocessing.Manager()
-        results = manager.dict()
-        fin_results = dict()
-
-        reqd_vals = ["meteor"]
-
-        for val in reqd_vals:
-            fin_results[val] = []
-
-        processes = []
-        for i in range(n_proc):
-            if len(chunked_data[i]) == 0:
-                continue
-            p = multiprocessing.Process(target=self._compute_meteor,args=(i, chunked_data[i], results))
-            processes.append(p)
-            p.start()
-
-        for process in processes:
-            process.join()
-
-        for idx in results:
-            for val in reqd_vals:
-                fin_results[val].extend(results[idx][val])
-
-        return fin_results
-
-
-    def _compute_rouge(self, pid, data, results):
-        rouge = evaluate.load("rouge")
-        reqd_vals = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
-
-        my_res = dict()
-        for val in reqd_vals:
-            my_res[val] = []
-
-        if pid == 0:
-            for instance in tqdm(data, desc="Rouge..."):
-                computed_val = rouge.compute(predictions=[instance["predicted_response"]], references=[instance["gold_response"]])
-                for metric in reqd_vals:
-                    my_res[metric].append(computed_val[metric])
-        else:
-            for instance in data:
-                computed_val = rouge.compute(predictions=[instance["predicted_response"]], references=[instance["gold_response"]])
-                for metric in reqd_vals:
-                    my_res[metric].append(computed_val[metric])
-
-
-        results[pid] = my_res
-
+        # One Meteor per Evaluator: tokenizations and lexicon lookups carry over to the next files
+        if self.meteor is None:
+            self.meteor = Meteor(lexicon_path=self.meteor_lexicon)
+        predictions = [instance["predicted_response"] for instance in data]
+        references = [instance["gold_response"] for instance in data]
+        return {"meteor": self.meteor.score(predictions, references).tolist()}
 
     def rouge_f(self, data):
-        n_proc = 96
-        if len(data) < 1000:
-            n_proc = 32
-        elif len(data) < 3000:
-            n_proc = 64
-
-        chunked_data = self._chunk(data, n_proc)
-
-        manager = multiprocessing.Manager()
-        results = manager.dict()
-        fin_results = dict()
-
-        reqd_vals = ["rouge1", "rouge2", "rougeL"]
-
-        for val in reqd_vals:
-            fin_results[val] = []
-
-        processes = []
-        for i in range(n_proc):
-            if len(chunked_data[i]) == 0:
-                continue
-            p = multiprocessing.Process(target=self._compute_rouge,args=(i, chunked_data[i], results))
-            processes.append(p)
-            p.start()
-
-        for process in processes:
-            process.join()
-
-        for idx in results:
-            for val in reqd_vals:
-                fin_results[val].extend(results[idx][val])
-
-        return fin_results
+        predictions = [instance["predicted_response"] for instance in data]
+        references = [instance["gold_response"] for instance in data]
+        scores = RougeScorer(use_stemmer=False).score(predictions, references)
+        return {key: values.tolist() for key, values in scores.items()}
 
     def _init_bert(self):
-        self.bertscore = evaluate.load("bertscore")
+        # Reference embeddings are cached across files, only predictions are encoded per file
+        self.bertscore = BertScorer(model_type="roberta-large", num_layers=17, cache_dir="cache/bertscore")
         return self.bertscore
 
     def bert_f(self, data):
         if self.bertscore is None:
             self._init_bert()
-        
-        reqd_vals = ["precision", "recall", "f1"]
-        results = dict()        
-        for metric in reqd_vals:
-            results[metric] = []
-            
-        batch_size = 64
-        for i in tqdm(range(0, len(data), batch_size), desc="Bertscore..."):
-            batch = data[i:i+batch_size]
-            predictions = []
-            references = []
-            
-            for instance in batch:
-                predictions.append(instance["predicted_response"])
-                references.append(instance["gold_response"])
-            
-            score = self.bertscore.compute(predictions=predictions, references=references, lang="en")
-            for metric in reqd_vals:
-                results[metric].extend(score[metric])
 
-        # for instance in tqdm(data, desc="Bertscore..."):
-        #     score = self.bertscore.compute(predictions=[instance["predicted_response"]], references=[instance["gold_response"]], lang="en")
-        #     for metric in reqd_vals:
-        #         results[metric].append(score[metric])
-
-        return results
+        predictions = [instance["predicted_response"] for instance in data]
+        references = [instance["gold_response"] for instance in data]
+        scores = self.bertscore.score(predictions, references)
+        return {key: values.tolist() for key, values in scores.items()}
 
     def _init_bleurt(self):
         # self.bleurt = evaluate.load("bleurt", module_type="metric")
-        self.bleurt = bleurt_scorer.BleurtScorer(os.getenv("BLEURT-PATH"))
-                
+        checkpoint = os.getenv("BLEURT-PATH")
+        # Older checkpoints are exported with a fixed sequence length, and can only be run padded to max_seq_length
+        if checkpoint and bleurt_checkpoint.read_bleurt_config(checkpoint)["dynamic_seq_length"]:
+            self.bleurt = bleurt_scorer.LengthBatchingBleurtScorer(checkpoint)
+        else:
+            print(f"WARNING: BLEURT checkpoint {checkpoint} has no dynamic sequence length, scoring without length batching")
+            self.bleurt = bleurt_scorer.BleurtScorer(checkpoint)
+
     def bleurt_f(self, data):
         if self.bleurt is None:
             self._init_bleurt()
 
-        results = {"scores" : []}
-        batch_size = 32
-        for i in tqdm(range(0, len(data), batch_size), desc="Bleurt..."):
-            batch = data[i:i+batch_size]
-            predictions = []
-            references = []
-            for instance in batch:
-                predictions.append(instance["predicted_response"])
-                references.append(instance["gold_response"])
-            scores = self.bleurt.score(candidates=predictions, references=references)
-            results["scores"].extend(list(scores))    
-        
-        return results
+        predictions = [instance["predicted_response"] for instance in data]
+        references = [instance["gold_response"] for instance in data]
+        # The whole file is encoded once, sorted by length and split into length-homogeneous batches
+        print(f"Bleurt... {len(data)} pairs")
+        if isinstance(self.bleurt, bleurt_scorer.LengthBatchingBleurtScorer):
+            scores = self.bleurt.score(candidates=predictions, references=references, batch_size=256, token_budget=self.bleurt_token_budget)
+        else:
+            scores = self.bleurt.score(candidates=predictions, references=references, batch_size=32)
+        return {"scores": list(scores)}
 
     def _init_e_bert(self, align):
         self.e_bert = DialogScorer(align=align)
@@ -361,30 +240,21 @@ class Evaluator:
         return results
     
     def _init_deb(self):
-        self.deb = DEB(deb_ckpt_basepath=os.getenv("DEB-PATH"))
+        self.deb = DEB(deb_ckpt_basepath=os.getenv("DEB-PATH"), precision=self.deb_precision)
 
     def deb_f(self, data):
         if self.deb is None:
             self._init_deb()
         
-        print("DEB...")
-        results = {"deb":[]}
-        batch_size = 32
-        
-        for i in tqdm(range(0, len(data), batch_size), desc="DEB..."):
-            batch = data[i:i+batch_size]
-            dialog_history = []
-            predicted_response = []
-            
-            for instance in batch:
-                dialog_history.append(instance["history"])
-                if "current_utterance" in instance.keys():
-                    dialog_history[-1] = dialog_history[-1] + "\n" + instance["current_utterance"]
-                predicted_response.append(instance["predicted_response"])
-            label, prob = self.deb.evaluate(dialog_history, predicted_response)
-            results["deb"].extend(prob)
-            
-        return results
+        dialog_history = []
+        predicted_response = []
+        for instance in data:
+            dialog_history.append(instance["history"])
+            if "current_utterance" in instance.keys():
+                dialog_history[-1] = dialog_history[-1] + "\n" + instance["current_utterance"]
+            predicted_response.append(instance["predicted_response"])
+        label, prob = self.deb.score(dialog_history, predicted_response)
+        return {"deb": prob}
 
     def _init_length(self):
         self.tokenizer = AutoTokenizer.from_pretrained("google/flan-t5-xl")
@@ -395,7 +265,7 @@ class Evaluator:
             self._init_length()
 
         prompt = False
-        if len(data) != 0 and "prompts" in data[0].keys():
+        if len(data) != 0 and all(self._prompt(ins) is not None for ins in data):
             prompt = True
             results = {"response_length":[], "prompt_length":[]}
         else:
@@ -404,10 +274,15 @@ class Evaluator:
         for ins in tqdm(data, desc='length...'):
             results["response_length"].append(len(self.tokenizer(ins['predicted_response'])['input_ids']))
             if prompt:
-                results["prompt_length"].append(len(self.tokenizer(ins['prompts'])['input_ids']))
+                results["prompt_length"].append(len(self.tokenizer(self._prompt(ins))['input_ids']))
 
         return results
 
+    @staticmethod
+    def _prompt(instance):
+        # Generation files store the prompt under "prompts", older ones under "prompt"
+        return instance.get("prompts", instance.get("prompt"))
+
     def get_key(self, my_dict):
         return my_dict["current_utterance"].strip() + "\n" + my_dict["gold_response"].strip()
 
@@ -434,6 +309,62 @@ class Evaluator:
         print(f"Extra {cnt}")
         return cur_data
 
+    def metric_version(self, metric):
+        """Part of the score store key: scores of a different implementation or checkpoint are not reused"""
+        versions = {
+            "bleu": "13a-avg1to4",
+            "meteor": "nltk-a0.9-b3-g0.5",
+            "rouge": "rouge_score-nostem",
+            "bert": "roberta-large-L17-f16refs",
+            "bleurt": os.path.basename(os.path.normpath(os.getenv("BLEURT-PATH", "BLEURT-20"))),
+            "deb": os.path.normpath(os.getenv("DEB-PATH", "deb_model")) + f"-{self.deb_precision}",
+            "length": "flan-t5-xl",
+        }
+        return versions.get(metric, "v0")
+
+    def _pair_text(self, metric, instance):
+        # What the prediction is scored against
+        if metric in ["deb", "ctc"]:
+            context = instance["history"]
+            if "current_utterance" in instance.keys():
+                context = context + "\n" + instance["current_utterance"]
+            return context
+        if metric == "length":
+            # Keeps instances without a prompt (no prompt_length) apart from the ones with an empty prompt
+            prompt = self._prompt(instance)
+            return "" if prompt is None else "prompt:" + prompt
+        return instance["gold_response"]
+
+    def _compute_stored(self, metric, data, chunk_size=4096):
+        """
+        Runs a metric function only on the pairs missing from the score store (each distinct pair once),
+        writing the scores back after every chunk. Returns the per-instance results in data order.
+        """
+        metric_f = self.supported_metrics[metric][0]
+        if self.store is None or len(data) == 0:
+            return metric_f(data)
+
+        version = self.metric_version(metric)
+        keys = [ScoreStore.pair_key(instance["predicted_response"], self._pair_text(metric, instance)) for instance in data]
+        found = self.store.get_many(metric, version, keys)
+        missing = {}
+        for idx, key in enumerate(keys):
+            if key not in found and key not in missing:
+                missing[key] = idx
+        print(f"{metric}: {len(data) - sum(1 for key in keys if key in missing)} scores from the store, computing {len(missing)} pairs")
+
+        missing_keys = list(missing.keys())
+        for i in range(0, len(missing_keys), chunk_size):
+            chunk_keys = missing_keys[i:i + chunk_size]
+            res = metric_f([data[missing[key]] for key in chunk_keys])
+            items = [(key, {submetric: float(res[submetric][j]) for submetric in res}) for j, key in enumerate(chunk_keys)]
+            self.store.put_many(metric, version, items)
+            found.update(items)
+
+        # Only the sub-metrics every pair has (length rows have prompt_length only when there was a prompt)
+        submetrics = [submetric for submetric in found[keys[0]] if all(submetric in found[key] for key in keys)]
+        return {submetric: [found[key][submetric] for key in keys] for submetric in submetrics}
+
     # This is the entrypoint
     def compute(self, input_file, metrics=None):
         print("Parsing file...")
@@ -473,10 +404,18 @@ class Evaluator:
         print("Computing metrics...")
         res_data = dict()
         for metric in required_metrics:
-            res_data[metric] = self.supported_metrics[metric][0](data)
+            res_data[metric] = self._compute_stored(metric, data)
 
         return res_data, length, logs
 
+    def close(self):
+        """Persists the METEOR lexicon and closes the score store"""
+        if self.meteor is not None:
+            self.meteor.lexicon.save()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
 def cmdline_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--compute", type=str, choices=["cpu", "gpu"], required=True, help="CPU/GPU based metrics")
@@ -576,7 +515,8 @@ if __name__ == "__main__":
             except Exception as e:
                 # traceback.print_exc()
                 print(f"Exception occured {e}")
-    
+
+    my_eval.close()
     print("***"*15)
     print("All logs")
     for metric, message in all_logs:
@@ -1,12 +1,12 @@
 import json
 import os
 import re
+import sys
 
 import torch
 import numpy as np
 from transformers import BertTokenizer
 from abc import abstractmethod, ABC
-import copy
 
 
 from Dataset import BaseDataset
@@ -43,7 +43,7 @@ class GroundTruthPersona(BaseDataset):
         for example in data:
             if example[0] == "1" and int(example.split(" ")[0]) == 1 and history:
                 base_obj = {}
-                base_obj["history"] = self._custom_tok("\n".join(history))
+                base_obj["history"] = self._custom_tok_history(history)
                 base_obj["current_utterance"] = self._custom_tok(context)
                 base_obj["response"] = self._custom_tok(response)
                 res_data.append(base_obj)
@@ -179,17 +179,18 @@ class GroundTruthMultiSessionChat(BaseDataset):
 
     # override
     def compile_persona_dialog_input(self, dialog, personas, previous_dialogs):
-        new_dialog = copy.deepcopy(dialog)
-        new_previous_dialogs = copy.deepcopy(previous_dialogs)
+        # The turns are shared with the raw data (never modified), only the lists are new
         your_persona = ""
         partner_persona = ""
         your_persona = '\n'.join([f'your persona: {x}' for x in personas[0]])
         partner_persona = '\n'.join([f"partner's persona: {x}" for x in personas[1]])
-        for prev_dialog in new_previous_dialogs:
-            prev_dialog['dialog'].insert(0, {"text": DUMMY_TEXT})
-            if len(prev_dialog['dialog']) % 2 == 1:
-                prev_dialog['dialog'].append({"text": DUMMY_TEXT})
-            new_dialog.insert(0, {"text": DUMMY_TEXT})
+        new_previous_dialogs = []
+        for prev_dialog in previous_dialogs:
+            turns = [{"text": DUMMY_TEXT}] + prev_dialog['dialog']
+            if len(turns) % 2 == 1:
+                turns.append({"text": DUMMY_TEXT})
+            new_previous_dialogs.append({**prev_dialog, 'dialog': turns})
+        new_dialog = [{"text": DUMMY_TEXT}] * len(previous_dialogs) + list(dialog)
         return your_persona, partner_persona, new_dialog, new_previous_dialogs
 
     def normalize_replies(self, x):
@@ -211,7 +212,13 @@ class GroundTruthMultiSessionChat(BaseDataset):
         return "\n".join(xs2)
 
     def _construct(self, data, length=None):
+        """
+        Every example is stored as (dialog id, start, end, current utterance, response): its history is
+        self.dialogs[dialog id][start:end], the utterances of a dialog being shared by all its examples
+        (see __getitem__). Utterances are interned, sessions 2-5 repeat the previous sessions.
+        """
         res_data = []
+        self.dialogs = []
         if not length:
             length = len(data)
         else:
@@ -226,65 +233,65 @@ class GroundTruthMultiSessionChat(BaseDataset):
                 dialog_dict['dialog'],
                 personas,
                 dialog_dict['previous_dialogs'])
-            previous_sessions_msgs = []
-            if self.previous_context == 'raw_history':
-                for d_id in range(len(new_previous_dialogs)):
-                    previous_dialog_msg = [
-                        x['text'] for x in new_previous_dialogs[d_id]['dialog']
-                    ]
-
-                    previous_sessions_msgs.append(
-                        '\n'.join(previous_dialog_msg)
-                    )
 
             episodes = []
             for i in range(0, len(new_dialog) - 1, 2):
                 text = new_dialog[i]['text']
-                action = {
-                    'text': self.normalize_replies(text),
-                    'labels': [self.normalize_replies(new_dialog[i + 1]['text'])]
-                }
-
-                episodes.append(action)
+                episodes.append((sys.intern(self.normalize_replies(text)),
+                                 sys.intern(self.normalize_replies(new_dialog[i + 1]['text']))))
 
             if self.version == 1:
 
-                utterances = []
-                for episode in episodes:
-                    if episode["text"] != DUMMY_TEXT:
-                        base_obj = {}
-                        base_obj['history'] = "\n".join(utterances) if len(utterances) >= 1 else DUMMY_TEXT
-                        base_obj['current_utterance'] = episode["text"]
-                        base_obj['response'] = episode["labels"]
-                        res_data.append(base_obj)
-                        if len(episode["text"]) > 0:
-                            utterances.append(episode["text"])
+                dialog_id, utterances = len(self.dialogs), []
+                self.dialogs.append(utterances)
+                for text, label in episodes:
+                    if text != DUMMY_TEXT:
+                        res_data.append((dialog_id, 0, len(utterances), text, label))
+                        if len(text) > 0:
+                            utterances.append(text)
                 break
 
             persona_context_str = ""
             if self.previous_context == "persona":
                 previous_context_str = ((partner_persona + '\n') if len(partner_persona) > 0 else "") + your_persona
-            elif self.previous_context == 'raw_history':
-                persona_context_str = previous_sessions_msgs
+            elif self.previous_context == 'raw_history' and len(new_previous_dialogs) > 0:
+                # Lines of the previous session, as in "\n".join(texts).split("\n")
+                persona_context_str = [sys.intern(line) for x in new_previous_dialogs[0]['dialog'] for line in x['text'].split("\n")]
 
             if persona_context_str and len(persona_context_str) > 0:
 
-                utterances = persona_context_str[0].split("\n")
-                # print(len(utterances))
-                for episode in episodes:
-                    if episode["text"] != DUMMY_TEXT:
-                        base_obj = {}
-                        base_obj['history'] = "\n".join(utterances)
-                        base_obj['current_utterance'] = episode["text"]
-                        base_obj['response'] = episode["labels"]
-                        res_data.append(base_obj)
-                        if len(episode["text"]) > 0:
-                            utterances.append(episode["text"])
-                        # since we already have a long history we keep a fixed length history by continuously popping the first element
-                        utterances.pop(0)
+                dialog_id, utterances = len(self.dialogs), persona_context_str
+                self.dialogs.append(utterances)
+                start = 0
+                for text, label in episodes:
+                    if text != DUMMY_TEXT:
+                        res_data.append((dialog_id, start, len(utterances), text, label))
+                        if len(text) > 0:
+                            utterances.append(text)
+                        # since we already have a long history we keep a fixed length history by sliding its start
+                        start += 1
 
         return res_data
 
+    def history(self, index):
+        dialog_id, start, end, _, _ = self.data[index]
+        if self.version == 1 and end == 0:
+            return DUMMY_TEXT
+        return "\n".join(self.dialogs[dialog_id][start:end])
+
+    def __getitem__(self, index):
+        assert index < len(self) and index >= 0, "Index out of range!"
+        _, _, _, current_utterance, response = self.data[index]
+        return {
+            'history': self.history(index),
+            'current_utterance': current_utterance,
+            'response': [response],
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
 
 if __name__ == "__main__":
     my_dataset = GroundTruthTopical(os.path.join(os.getcwd(), "data/topical_chat/topical_chat_test_rare.json"))
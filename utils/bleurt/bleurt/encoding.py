@@ -14,6 +14,10 @@
 # limitations under the License.
 """Data tokenization, encoding and serialization library."""
 import collections
+import concurrent.futures
+import hashlib
+import json
+import os
 
 from bleurt.lib import tokenizers
 import numpy as np
@@ -41,6 +45,19 @@ flags.DEFINE_string(
     "Path to SentencePiece model, without `.model` extension. This flag "
     "will override `vocab_file` and `do_lower_case`.")
 
+flags.DEFINE_integer(
+    "serialization_workers", None,
+    "Number of processes encoding and serializing the ratings. Uses all the "
+    "CPUs if None.")
+
+flags.DEFINE_integer("serialization_shards", 16,
+                     "Number of TFRecord shards of the serialized ratings.")
+
+flags.DEFINE_string(
+    "serialization_cache_dir", None,
+    "[optional] Directory where the serialized ratings are cached, keyed by "
+    "the ratings file, the vocabulary and `max_seq_length`.")
+
 
 def _truncate_seq_pair(tokens_ref, tokens_cand, max_length):
   """Truncates a sequence pair in place to the maximum length."""
@@ -54,6 +71,24 @@ def _truncate_seq_pair(tokens_ref, tokens_cand, max_length):
       tokens_cand.pop()
 
 
+def _truncated_lengths(ref_lengths, cand_lengths, max_length):
+  """Lengths of sequence pairs after _truncate_seq_pair, for arrays of pairs.
+
+  Popping from the longer sequence (the candidate on ties) leaves a shorter
+  sequence that fits in half of `max_length` untouched, and otherwise splits
+  `max_length` in two halves, the reference taking the odd token.
+  """
+  ref_lengths = np.asarray(ref_lengths, dtype=np.int64)
+  cand_lengths = np.asarray(cand_lengths, dtype=np.int64)
+  truncated = ref_lengths + cand_lengths > max_length
+  new_ref_lengths = np.minimum(
+      ref_lengths,
+      np.maximum(max_length - cand_lengths, (max_length + 1) // 2))
+  ref_lengths = np.where(truncated, new_ref_lengths, ref_lengths)
+  cand_lengths = np.where(truncated, max_length - ref_lengths, cand_lengths)
+  return ref_lengths, cand_lengths
+
+
 def encode_example(reference, candidate, tokenizer, max_seq_length):
   """Tokenization and encoding of an example rating.
 
@@ -120,6 +155,23 @@ def serialize_example(reference,
     max_seq_length: maximum length of BLEURT's input after tokenization.
     score: [optional] float that indicates the score to be modelled.
 
+  Returns:
+    A serialized tf.Example object.
+  """
+  input_ids, input_mask, segment_ids = encode_example(reference, candidate,
+                                                      tokenizer, max_seq_length)
+  return serialize_encoded_example(input_ids, input_mask, segment_ids, score)
+
+
+def serialize_encoded_example(input_ids, input_mask, segment_ids, score=None):
+  """Serializes an encoded pair of sentences into a tf.Example.
+
+  Args:
+    input_ids: token ids, as returned by `encode_example`.
+    input_mask: input mask, as returned by `encode_example`.
+    segment_ids: segment ids, as returned by `encode_example`.
+    score: [optional] float that indicates the score to be modelled.
+
   Returns:
     A serialized tf.Example object.
   """
@@ -132,9 +184,6 @@ def serialize_example(reference,
     f = tf.train.Feature(float_list=tf.train.FloatList(value=list(values)))
     return f
 
-  input_ids, input_mask, segment_ids = encode_example(reference, candidate,
-                                                      tokenizer, max_seq_length)
-
   # Creates the TFExample.
   features = collections.OrderedDict()
   features["input_ids"] = _create_int_feature(input_ids)
@@ -178,33 +227,96 @@ def serialize_raw_example(reference, candidate):
   return tf_example.SerializeToString()
 
 
-def encode_batch(references, candidates, tokenizer, max_seq_length):
+def _encode_pairs(references, candidates, tokenizer, max_seq_length,
+                  pad_to_max_seq_length, dtype):
+  """Shared implementation of encode_batch and encode_batch_ragged."""
+  references, candidates = list(references), list(candidates)
+  n_pairs = len(references)
+
+  # Tokenizes every distinct sentence once.
+  token_ids = {}
+  for sentence in references + candidates:
+    if sentence not in token_ids:
+      token_ids[sentence] = tokenizer.convert_tokens_to_ids(
+          tokenizer.tokenize(sentence))
+  cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+  ref_lengths, cand_lengths = _truncated_lengths(
+      [len(token_ids[ref]) for ref in references],
+      [len(token_ids[cand]) for cand in candidates], max_seq_length - 3)
+  seq_lengths = ref_lengths + cand_lengths + 3
+
+  if pad_to_max_seq_length:
+    width = max_seq_length
+  else:
+    width = int(seq_lengths.max()) if n_pairs else 0
+
+  # Layout: [CLS] reference [SEP] candidate [SEP] padding.
+  input_ids = np.zeros((n_pairs, width), dtype=dtype)
+  for i, (ref, cand) in enumerate(zip(references, candidates)):
+    ref_len, cand_len = ref_lengths[i], cand_lengths[i]
+    input_ids[i, 0] = cls_id
+    input_ids[i, 1:ref_len + 1] = token_ids[ref][:ref_len]
+    input_ids[i, ref_len + 1] = sep_id
+    cand_start = ref_len + 2
+    input_ids[i, cand_start:cand_start + cand_len] = token_ids[cand][:cand_len]
+    input_ids[i, ref_len + cand_len + 2] = sep_id
+
+  positions = np.arange(width)[None, :]
+  input_mask = (positions < seq_lengths[:, None]).astype(dtype)
+  segment_ids = ((positions >= ref_lengths[:, None] + 2) &
+                 (positions < seq_lengths[:, None])).astype(dtype)
+  return input_ids, input_mask, segment_ids, seq_lengths
+
+
+def encode_batch(references, candidates, tokenizer, max_seq_length,
+                 dtype=np.int64):
   """Encodes a batch of sentence pairs to be fed to a BLEURT checkpoint.
 
+  Produces the same arrays as stacking `encode_example` over the pairs, but
+  tokenizes each distinct sentence once, computes the truncation of all pairs
+  at once and writes into preallocated arrays.
+
   Args:
     references: list of reference sentences.
     candidates: list of candidate sentences.
     tokenizer: BERT-style WordPiece tokenizer.
     max_seq_length: maximum length of BLEURT's input after tokenization.
+    dtype: integer type of the returned arrays.
 
   Returns:
     A triplet (input_ids, input_mask, segment_ids), all numpy arrays with type
       np.int64<n_sentences, max_seq_length>.
   """
-  encoded_examples = []
-  for ref, cand in zip(references, candidates):
-    triplet = encode_example(ref, cand, tokenizer, max_seq_length)
-    example = np.stack(triplet)
-    encoded_examples.append(example)
-  stacked_examples = np.stack(encoded_examples)
-  assert stacked_examples.shape == (len(encoded_examples), 3, max_seq_length)
-  return (stacked_examples[:, 0, :], stacked_examples[:, 1, :],
-          stacked_examples[:, 2, :])
+  input_ids, input_mask, segment_ids, _ = _encode_pairs(
+      references, candidates, tokenizer, max_seq_length,
+      pad_to_max_seq_length=True, dtype=dtype)
+  return input_ids, input_mask, segment_ids
 
 
-def encode_and_serialize(input_file, output_file, vocab_file, do_lower_case,
-                         sp_model, max_seq_length):
-  """Encodes and serializes a set of ratings in JSON format."""
+def encode_batch_ragged(references, candidates, tokenizer, max_seq_length,
+                        dtype=np.int64):
+  """Like `encode_batch`, but only pads to the longest pair of the batch.
+
+  Args:
+    references: list of reference sentences.
+    candidates: list of candidate sentences.
+    tokenizer: BERT-style WordPiece tokenizer.
+    max_seq_length: maximum length of BLEURT's input after tokenization.
+    dtype: integer type of the returned arrays.
+
+  Returns:
+    A tuple (input_ids, input_mask, segment_ids, seq_lengths): three numpy
+      arrays <n_sentences, longest sequence length> and the length of each
+      sequence.
+  """
+  return _encode_pairs(
+      references, candidates, tokenizer, max_seq_length,
+      pad_to_max_seq_length=False, dtype=dtype)
+
+
+def _read_ratings(input_file):
+  """Reads a JSONL file of ratings into a DataFrame."""
   assert tf.io.gfile.exists(input_file), "Could not find file."
   logging.info("Reading data...")
   with tf.io.gfile.GFile(input_file, "r") as f:
@@ -212,8 +324,15 @@ def encode_and_serialize(input_file, output_file, vocab_file, do_lower_case,
   for col in ["reference", "candidate", "score"]:
     assert col in examples_df.columns, \
         "field {} not found in input file!".format(col)
+  logging.info("Read {} examples.".format(len(examples_df)))
+  return examples_df
+
+
+def encode_and_serialize(input_file, output_file, vocab_file, do_lower_case,
+                         sp_model, max_seq_length):
+  """Encodes and serializes a set of ratings in JSON format."""
+  examples_df = _read_ratings(input_file)
   n_records = len(examples_df)
-  logging.info("Read {} examples.".format(n_records))
 
   logging.info("Encoding and writing TFRecord file...")
   tokenizer = tokenizers.create_tokenizer(
@@ -232,3 +351,127 @@ def encode_and_serialize(input_file, output_file, vocab_file, do_lower_case,
           score=record.score)
       writer.write(tf_example)
   logging.info("Done writing {} tf examples.".format(n_records))
+
+
+def file_checksum(path, block_size=1 << 20):
+  """SHA-256 of a file, read by blocks."""
+  sha = hashlib.sha256()
+  with tf.io.gfile.GFile(path, "rb") as f:
+    for block in iter(lambda: f.read(block_size), b""):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+def _serialization_key(input_file, vocab_file, do_lower_case, sp_model,
+                       max_seq_length, num_shards):
+  """Identifies the TFRecord shards created from a ratings file."""
+  sha = hashlib.sha256(file_checksum(input_file).encode("utf-8"))
+  if sp_model:
+    sha.update(file_checksum(sp_model + ".model").encode("utf-8"))
+  else:
+    sha.update(file_checksum(vocab_file).encode("utf-8"))
+    sha.update(str(bool(do_lower_case)).encode("utf-8"))
+  sha.update(json.dumps([max_seq_length, num_shards]).encode("utf-8"))
+  return sha.hexdigest()
+
+
+def sharded_file_names(output_file, num_shards):
+  """Returns the paths of the TFRecord shards with prefix `output_file`."""
+  return [
+      "{}-{:05d}-of-{:05d}".format(output_file, i, num_shards)
+      for i in range(num_shards)
+  ]
+
+
+def _serialize_shard(shard_file, references, candidates, scores, vocab_file,
+                     do_lower_case, sp_model, max_seq_length, batch_size=1024):
+  """Encodes and writes a shard of ratings, batch by batch."""
+  tokenizer = tokenizers.create_tokenizer(
+      vocab_file=vocab_file, do_lower_case=do_lower_case, sp_model=sp_model)
+  tmp_file = shard_file + ".tmp"
+  with tf.python_io.TFRecordWriter(tmp_file) as writer:
+    for start in range(0, len(references), batch_size):
+      end = start + batch_size
+      input_ids, input_mask, segment_ids = encode_batch(
+          references[start:end], candidates[start:end], tokenizer,
+          max_seq_length)
+      for i, score in enumerate(scores[start:end]):
+        writer.write(
+            serialize_encoded_example(input_ids[i], input_mask[i],
+                                      segment_ids[i], score))
+  # Only complete shards get their final name.
+  tf.io.gfile.rename(tmp_file, shard_file, overwrite=True)
+  return len(references)
+
+
+def encode_and_serialize_sharded(input_file,
+                                 output_file,
+                                 vocab_file,
+                                 do_lower_case,
+                                 sp_model,
+                                 max_seq_length,
+                                 num_shards=16,
+                                 num_workers=None,
+                                 cache_dir=None):
+  """Encodes and serializes a set of ratings into TFRecord shards.
+
+  The shards are encoded in a process pool. Example i goes to shard
+  i % num_shards, so that reading the shards in a round robin (see
+  `model.input_fn_builder`) yields the examples in their original order.
+  The shards are reused if they were created from the same ratings file,
+  vocabulary and `max_seq_length`.
+
+  Args:
+    input_file: JSONL file of ratings.
+    output_file: prefix of the shards, ignored if `cache_dir` is set.
+    vocab_file: vocabulary file for WordPiece tokenization.
+    do_lower_case: whether to lower case the input text.
+    sp_model: path to SentencePiece model, without `.model` extension.
+    max_seq_length: maximum length of BLEURT's input after tokenization.
+    num_shards: number of TFRecord shards.
+    num_workers: number of processes, all the CPUs if None.
+    cache_dir: [optional] directory where the shards are cached.
+
+  Returns:
+    A glob pattern matching the shards.
+  """
+  key = _serialization_key(input_file, vocab_file, do_lower_case, sp_model,
+                           max_seq_length, num_shards)
+  if cache_dir:
+    tf.io.gfile.makedirs(cache_dir)
+    output_file = os.path.join(cache_dir, key[:16] + ".tfrecord")
+  shard_files = sharded_file_names(output_file, num_shards)
+  pattern = "{}-?????-of-{:05d}".format(output_file, num_shards)
+
+  key_file = output_file + ".sha256"
+  if tf.io.gfile.exists(key_file) and all(
+      tf.io.gfile.exists(shard_file) for shard_file in shard_files):
+    with tf.io.gfile.GFile(key_file, "r") as f:
+      if f.read().strip() == key:
+        logging.info("Reusing serialized examples {}.".format(pattern))
+        return pattern
+    tf.io.gfile.remove(key_file)
+
+  examples_df = _read_ratings(input_file)
+  references = examples_df["reference"].tolist()
+  candidates = examples_df["candidate"].tolist()
+  scores = examples_df["score"].tolist()
+
+  logging.info("Encoding and writing {} TFRecord shards...".format(num_shards))
+  args = [(shard_file, references[i::num_shards], candidates[i::num_shards],
+           scores[i::num_shards], vocab_file, do_lower_case, sp_model,
+           max_seq_length) for i, shard_file in enumerate(shard_files)]
+  if num_workers == 1:
+    n_records = sum(_serialize_shard(*shard_args) for shard_args in args)
+  else:
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+      futures = [
+          executor.submit(_serialize_shard, *shard_args) for shard_args in args
+      ]
+      n_records = sum(future.result() for future in futures)
+
+  # Written last, it marks the shards as complete.
+  with tf.io.gfile.GFile(key_file, "w") as f:
+    f.write(key)
+  logging.info("Done writing {} tf examples.".format(n_records))
+  return pattern
@@ -45,6 +45,27 @@ flags.DEFINE_string(
 # See model.py and lib/experiment_utils.py for other important flags.
 
 
+def _encode_and_serialize(ratings_file, tfrecord_file, bleurt_params):
+  """Encodes a set of ratings into TFRecord shards, returns their pattern."""
+  return encoding.encode_and_serialize_sharded(
+      ratings_file,
+      tfrecord_file,
+      vocab_file=bleurt_params["vocab_file"],
+      do_lower_case=bleurt_params["do_lower_case"],
+      sp_model=bleurt_params["sp_model"],
+      max_seq_length=bleurt_params["max_seq_length"],
+      num_shards=FLAGS.serialization_shards,
+      num_workers=FLAGS.serialization_workers,
+      cache_dir=FLAGS.serialization_cache_dir)
+
+
+def _remove_shards(tfrecord_file):
+  shard_files = encoding.sharded_file_names(tfrecord_file,
+                                            FLAGS.serialization_shards)
+  for path in shard_files + [tfrecord_file + ".sha256"]:
+    tf.io.gfile.remove(path)
+
+
 def run_finetuning_pipeline(train_set, dev_set, run_in_lazy_mode=True):
   """Runs the full BLEURT fine-tuning pipeline."""
 
@@ -59,39 +80,28 @@ def run_finetuning_pipeline(train_set, dev_set, run_in_lazy_mode=True):
     train_tfrecord = FLAGS.serialized_train_set
   else:
     train_tfrecord = train_set + ".tfrecord"
-  encoding.encode_and_serialize(
-      train_set,
-      train_tfrecord,
-      vocab_file=bleurt_params["vocab_file"],
-      do_lower_case=bleurt_params["do_lower_case"],
-      sp_model=bleurt_params["sp_model"],
-      max_seq_length=bleurt_params["max_seq_length"])
+  train_pattern = _encode_and_serialize(train_set, train_tfrecord,
+                                        bleurt_params)
 
   logging.info("*** Running pre-processing pipeline for eval examples.")
   if FLAGS.serialized_dev_set:
     dev_tfrecord = FLAGS.serialized_dev_set
   else:
     dev_tfrecord = dev_set + ".tfrecord"
-  encoding.encode_and_serialize(
-      dev_set,
-      dev_tfrecord,
-      vocab_file=bleurt_params["vocab_file"],
-      do_lower_case=bleurt_params["do_lower_case"],
-      sp_model=bleurt_params["sp_model"],
-      max_seq_length=bleurt_params["max_seq_length"])
+  dev_pattern = _encode_and_serialize(dev_set, dev_tfrecord, bleurt_params)
 
   # Actual fine-tuning work.
   logging.info("*** Running fine-tuning.")
   train_eval_fun = experiment_utils.run_experiment
-  model.run_finetuning(train_tfrecord, dev_tfrecord, train_eval_fun)
+  model.run_finetuning(train_pattern, dev_pattern, train_eval_fun)
 
-  # Deletes temp files.
-  if not FLAGS.serialized_train_set:
+  # Deletes temp files, cached shards are kept.
+  if not FLAGS.serialized_train_set and not FLAGS.serialization_cache_dir:
     logging.info("Deleting serialized training examples.")
-    tf.io.gfile.remove(train_tfrecord)
-  if not FLAGS.serialized_dev_set:
+    _remove_shards(train_tfrecord)
+  if not FLAGS.serialized_dev_set and not FLAGS.serialization_cache_dir:
     logging.info("Deleting serialized dev examples.")
-    tf.io.gfile.remove(dev_tfrecord)
+    _remove_shards(dev_tfrecord)
 
   # Gets export location.
   glob_pattern = os.path.join(FLAGS.model_dir, "export", "bleurt_best", "*")
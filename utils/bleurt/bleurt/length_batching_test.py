@@ -108,6 +108,12 @@ class FinetuneTest(tf.test.TestCase):
       self.assertLen(scores, 2)
       self.assertAllClose(scores, ref_scores)
 
+      # Same scores with batches bounded by a token budget.
+      scores = scorer.score(
+          references=references, candidates=candidates, token_budget=16)
+      self.assertLen(scores, 2)
+      self.assertAllClose(scores, ref_scores)
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -376,18 +376,29 @@ def input_fn_builder(tfrecord_file,
 
   def input_fn(params):  # pylint: disable=unused-argument
     """Acutal data generator."""
-    tfrecord_file_expanded = tf.io.gfile.glob(tfrecord_file)
+    tfrecord_file_expanded = sorted(tf.io.gfile.glob(tfrecord_file))
     n_files = len(tfrecord_file_expanded)
+    assert n_files, "No file matching {}".format(tfrecord_file)
     if n_files > 1:
       logging.info("Found {} files matching {}".format(
           str(n_files), tfrecord_file))
 
-    d = tf.data.TFRecordDataset(tfrecord_file_expanded)
+    # Reads the shards in parallel, in a round robin that preserves the
+    # order of the examples (see encoding.encode_and_serialize_sharded).
+    d = tf.data.Dataset.from_tensor_slices(tfrecord_file_expanded)
+    d = d.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=n_files,
+        block_length=1,
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
     if is_training:
       d = d.repeat()
       d = d.shuffle(buffer_size=FLAGS.shuffle_buffer_size)
-    d = d.map(lambda record: _decode_record(record, name_to_features))
+    d = d.map(
+        lambda record: _decode_record(record, name_to_features),
+        num_parallel_calls=tf.data.experimental.AUTOTUNE)
     d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+    d = d.prefetch(tf.data.experimental.AUTOTUNE)
     return d
 
   return input_fn
@@ -197,27 +197,58 @@ class BleurtScorer(object):
     if not candidates:
       return []
 
+    return self.score_encoded(
+        self.encode(references, candidates), batch_size=batch_size)
+
+  def encode(self, references, candidates):
+    """Tokenizes and encodes sentence pairs, to be scored by `score_encoded`.
+
+    Encoding can thus run separately from (e.g., concurrently with) inference.
+
+    Args:
+      references: a list of strings.
+      candidates: a list of strings.
+
+    Returns:
+      The tuple returned by `encoding.encode_batch_ragged`, with int32 arrays.
+    """
+    return encoding.encode_batch_ragged(
+        references, candidates, self.tokenizer, self.max_seq_length,
+        dtype=np.int32)
+
+  def score_encoded(self, encoded, batch_size=None):
+    """Scores sentence pairs encoded with `encode`.
+
+    Args:
+      encoded: output of `encode`.
+      batch_size: number of pairs to process per call to `predict_fn`.
+
+    Returns:
+      A list of scores.
+    """
+    input_ids, input_mask, segment_ids, _ = encoded
+    n_items = input_ids.shape[0]
+
     if not batch_size:
       batch_size = DEFAULT_BLEURT_BATCH_SIZE
 
     all_results = []
-    for i in range(0, len(candidates), batch_size):
-      batch_ref = references[i:i + batch_size]
-      batch_cand = candidates[i:i + batch_size]
-      input_ids, input_mask, segment_ids = encoding.encode_batch(
-          batch_ref, batch_cand, self.tokenizer, self.max_seq_length)
-      tf_input = {
-          "input_ids": input_ids,
-          "input_mask": input_mask,
-          "segment_ids": segment_ids
-      }
+    for i in range(0, n_items, batch_size):
+      # Pads the batch to the sequence length of the checkpoint.
+      tf_input = {}
+      for name, array in [("input_ids", input_ids), ("input_mask", input_mask),
+                          ("segment_ids", segment_ids)]:
+        batch = array[i:i + batch_size]
+        padded = np.zeros((batch.shape[0], self.max_seq_length), dtype=np.int64)
+        padded[:, :batch.shape[1]] = batch
+        tf_input[name] = padded
       predict_out = self._predictor.predict(tf_input)
       batch_results = predict_out.tolist()
       all_results.extend(batch_results)
 
-    assert len(all_results) == len(candidates), (
+    assert len(all_results) == n_items, (
         "Number of predictions does not match sentences: {} vs. {}".format(
-            len(all_results), len(candidates)))
+            len(all_results), n_items))
     return all_results
 
   def close(self):
@@ -242,7 +273,8 @@ class LengthBatchingBleurtScorer(BleurtScorer):
         "The checkpoint does not support dynamic sequence lengths. Please use "
         "another checkpoint, or use disable same length batching.")
 
-  def score(self, *args, references=[], candidates=[], batch_size=None):
+  def score(self, *args, references=[], candidates=[], batch_size=None,
+            token_budget=None):
     """Scores a collection of references and candidates.
 
     Args:
@@ -251,6 +283,10 @@ class LengthBatchingBleurtScorer(BleurtScorer):
       candidates: a list of strings.
       batch_size: number of pairs to process per call to `predict_fn`. A high
         value makes the eval speedier but also more memory-intensive.
+      token_budget: (optional) maximum number of tokens (batch size x padded
+        sequence length) per call to `predict_fn`. Batches are then filled up
+        to `batch_size` pairs as long as they fit in the budget, so batches of
+        short pairs are larger than batches of long ones.
 
     Returns:
       A list of scores.
@@ -264,26 +300,54 @@ class LengthBatchingBleurtScorer(BleurtScorer):
     assert len(candidates) == len(references), (
         "The number of candidate sentences must match the number of "
         "reference sentences.")
-    n_items = len(candidates)
     if not candidates:
       return []
 
+    return self.score_encoded(
+        self.encode(references, candidates), batch_size=batch_size,
+        token_budget=token_budget)
+
+  def score_encoded(self, encoded, batch_size=None, token_budget=None):
+    """Scores sentence pairs encoded with `encode`, in batches of same length.
+
+    Args:
+      encoded: output of `encode`.
+      batch_size: number of pairs to process per call to `predict_fn`.
+      token_budget: (optional) maximum number of tokens per call to
+        `predict_fn`, see `score`.
+
+    Returns:
+      A list of scores.
+    """
+    input_ids, input_mask, segment_ids, seq_lengths = encoded
+    n_items = input_ids.shape[0]
+
     if not batch_size:
       batch_size = DEFAULT_BLEURT_BATCH_SIZE
 
     # Sorts the sentences by length.
-    input_ids, input_mask, segment_ids = encoding.encode_batch(
-        references, candidates, self.tokenizer, self.max_seq_length)
-    seq_lengths = np.sum(input_mask, axis=1)
     sorted_indices = np.argsort(seq_lengths)
     assert sorted_indices.shape[0] == n_items
 
+    # Splits the sorted examples into batches.
+    batches = []
+    start = 0
+    while start < n_items:
+      end = min(start + batch_size, n_items)
+      if token_budget:
+        # The examples are sorted by increasing length, so the last one of a
+        # batch sets its padded length.
+        end = start + 1
+        while (end < n_items and end - start < batch_size and
+               (end - start + 1) * seq_lengths[sorted_indices[end]] <=
+               token_budget):
+          end += 1
+      batches.append(sorted_indices[start:end])
+      start = end
+
     all_results = np.repeat(self.DEFAULT_SCORE, n_items).astype(np.float64)
     batch_lens = []
-    for i in range(0, n_items, batch_size):
-
-      # Gets the ids of the examples in the batch.
-      batch_indices = sorted_indices[i:i + batch_size]
+    for batch_indices in batches:
 
       # Computes the max sequence length.
       batch_lenghts = seq_lengths[batch_indices]
@@ -291,9 +355,12 @@ class LengthBatchingBleurtScorer(BleurtScorer):
       batch_lens.append(batch_max_len)
 
       # Retrieves the examples and truncates the extra padding.
-      batch_input_ids = input_ids[batch_indices, :batch_max_len]
-      batch_input_mask = input_mask[batch_indices, :batch_max_len]
-      batch_segment_ids = segment_ids[batch_indices, :batch_max_len]
+      batch_input_ids = input_ids[batch_indices, :batch_max_len].astype(
+          np.int64)
+      batch_input_mask = input_mask[batch_indices, :batch_max_len].astype(
+          np.int64)
+      batch_segment_ids = segment_ids[batch_indices, :batch_max_len].astype(
+          np.int64)
 
       # Runs the inference.
       tf_input = {
@@ -311,7 +378,7 @@ class LengthBatchingBleurtScorer(BleurtScorer):
     all_results = list(all_results)
     assert len(all_results) == n_items, (
         "Number of predictions does not match sentences: {} vs. {}".format(
-            len(all_results), len(candidates)))
+            len(all_results), n_items))
 
     logging.info("Average batch sequence length: {}".format(
         np.mean(batch_lens)))
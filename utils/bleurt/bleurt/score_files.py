@@ -15,8 +15,11 @@
 """BLEURT scoring library."""
 
 import itertools
+import json
+import queue
+import threading
+
 from bleurt import score as score_lib
-import pandas as pd
 import tensorflow as tf
 
 flags = tf.compat.v1.flags
@@ -67,8 +70,11 @@ def _json_generator(sentence_pairs_file):
       sentence_pairs_file), "Sentence pairs file {} not found".format(
           sentence_pairs_file)
   with tf.io.gfile.GFile(sentence_pairs_file, "r") as pairs_file:
-    ratings_df = pd.read_json(pairs_file, lines=True)
-    for _, row in ratings_df.iterrows():
+    # Parses one record at a time, the file is never loaded as a whole.
+    for line in pairs_file:
+      if not line.strip():
+        continue
+      row = json.loads(line)
       assert row.get("reference") is not None, (
           "Reference sentence not found, are you sure the JSON record "
           "contains a 'reference' field?")
@@ -97,6 +103,50 @@ def _text_generator(reference_file, candidate_file):
         yield ref_sentence, cand_sentence
 
 
+def _read_buffers(generator, buffer_size):
+  """Groups the sentence pairs into (references, candidates) buffers."""
+  ref_buffer = []
+  cand_buffer = []
+  for ref_sentence, cand_sentence in generator:
+    ref_buffer.append(ref_sentence)
+    cand_buffer.append(cand_sentence)
+    if len(ref_buffer) >= buffer_size:
+      yield ref_buffer, cand_buffer
+      ref_buffer = []
+      cand_buffer = []
+  if ref_buffer:
+    yield ref_buffer, cand_buffer
+
+
+def _prefetch(iterator, max_prefetch=1):
+  """Runs an iterator on a background thread, `max_prefetch` items ahead.
+
+  Exceptions raised by the iterator are re-raised in the consuming thread.
+  """
+  items = queue.Queue(maxsize=max_prefetch)
+  end = object()
+
+  def _produce():
+    try:
+      for item in iterator:
+        items.put((item, None))
+    except Exception as e:  # pylint: disable=broad-except
+      items.put((None, e))
+      return
+    items.put((end, None))
+
+  thread = threading.Thread(target=_produce, daemon=True)
+  thread.start()
+  while True:
+    item, error = items.get()
+    if error is not None:
+      raise error
+    if item is end:
+      break
+    yield item
+  thread.join()
+
+
 def score_files(generator, bleurt_checkpoint):
   """Computes BLEURT scores from a sentence pairs generator.
 
@@ -104,14 +154,15 @@ def score_files(generator, bleurt_checkpoint):
   sentences or two individual candidate and reference text files be specified,
   with the former overriding the latter if both flags are specified.
 
+  The pairs are processed in buffers of `read_buffer_size` pairs: the next
+  buffer is read and tokenized on a background thread while the model scores
+  the current one, and the scores of each buffer are written as soon as they
+  are computed, so memory use does not grow with the number of pairs.
+
   Args:
     generator: A generator yielding reference and candidate sentences.
     bleurt_checkpoint: BLEURT checkpoint used for scoring.
   """
-  ref_buffer = []
-  cand_buffer = []
-  scores_buffer = []
-
   if not FLAGS.batch_same_length:
     scorer = score_lib.BleurtScorer(bleurt_checkpoint)
   else:
@@ -120,33 +171,33 @@ def score_files(generator, bleurt_checkpoint):
         "feature.")
     scorer = score_lib.LengthBatchingBleurtScorer(bleurt_checkpoint)
 
-  def _consume_buffer():
-    scores = scorer.score(
-        references=ref_buffer,
-        candidates=cand_buffer,
-        batch_size=FLAGS.bleurt_batch_size)
-    del ref_buffer[:]
-    del cand_buffer[:]
-    scores_buffer.extend(scores)
-
-  logging.info("Computing BLEURT scores...")
-  for ref_sentence, cand_sentence in generator:
-    ref_buffer.append(ref_sentence)
-    cand_buffer.append(cand_sentence)
-    if len(ref_buffer) >= FLAGS.read_buffer_size:
-      _consume_buffer()
-  if ref_buffer:
-    _consume_buffer()
-  logging.info("BLEURT scores computed.")
+  def _encode_buffers():
+    for ref_buffer, cand_buffer in _read_buffers(generator,
+                                                 FLAGS.read_buffer_size):
+      yield scorer.encode(ref_buffer, cand_buffer)
 
   if FLAGS.scores_file:
-    logging.info("Writing to disk.")
-    with tf.io.gfile.GFile(FLAGS.scores_file, "w+") as score_file:
-      for s in scores_buffer:
-        score_file.write("{}\n".format(str(s)))
+    score_file = tf.io.gfile.GFile(FLAGS.scores_file, "w+")
   else:
-    for s in scores_buffer:
-      print("{}".format(str(s)))
+    score_file = None
+
+  logging.info("Computing BLEURT scores...")
+  try:
+    n_scores = 0
+    for encoded in _prefetch(_encode_buffers()):
+      scores = scorer.score_encoded(
+          encoded, batch_size=FLAGS.bleurt_batch_size)
+      lines = "".join("{}\n".format(str(s)) for s in scores)
+      if score_file is not None:
+        score_file.write(lines)
+        score_file.flush()
+      else:
+        print(lines, end="", flush=True)
+      n_scores += len(scores)
+      logging.info("Scored {} sentence pairs.".format(n_scores))
+  finally:
+    if score_file is not None:
+      score_file.close()
   logging.info("Done.")
 
 
@@ -15,7 +15,9 @@
 """Tests for scoring function."""
 import os
 
+from bleurt import encoding
 from bleurt import score
+import numpy as np
 import tensorflow.compat.v1 as tf
 tf.enable_eager_execution()
 
@@ -75,6 +77,30 @@ class ScoreTest(tf.test.TestCase):
     self.assertLen(scores, 2)
     self.assertAllClose(scores, ref_scores)
 
+  def test_encode_batch_matches_encode_example(self):
+    bleurt = score.BleurtScorer()
+    test_references = references + ["", "A much longer reference " * 10]
+    test_candidates = candidates + ["Short.", ""]
+    for max_seq_length in [8, 16, 128]:
+      expected = np.stack([
+          np.stack(
+              encoding.encode_example(ref, cand, bleurt.tokenizer,
+                                      max_seq_length))
+          for ref, cand in zip(test_references, test_candidates)
+      ])
+      batch = encoding.encode_batch(test_references, test_candidates,
+                                    bleurt.tokenizer, max_seq_length)
+      for i in range(3):
+        self.assertAllEqual(batch[i], expected[:, i, :])
+      input_ids, input_mask, segment_ids, seq_lengths = (
+          encoding.encode_batch_ragged(test_references, test_candidates,
+                                       bleurt.tokenizer, max_seq_length))
+      width = max(seq_lengths)
+      self.assertAllEqual(seq_lengths, expected[:, 1, :].sum(axis=1))
+      self.assertAllEqual(input_ids, expected[:, 0, :width])
+      self.assertAllEqual(input_mask, expected[:, 1, :width])
+      self.assertAllEqual(segment_ids, expected[:, 2, :width])
+
   def test_tf_bleurt_score_eager(self):
     # Creates the TF Graph.
     bleurt_ops = score.create_bleurt_ops()
@@ -65,21 +65,23 @@ def run_benchmark():
       print("Done.")
 
   logging.info("\n*** Creating training data. ***")
-  db_builder.create_wmt_dataset(train_ratings_file, FLAGS.train_years,
-                                FLAGS.target_language)
-  db_builder.postprocess(train_ratings_file)
-  db_builder.shuffle_split(
+  db_builder.build_wmt_dataset(
       train_ratings_file,
-      train_ratings_file,
-      dev_ratings_file,
+      FLAGS.train_years,
+      FLAGS.target_language,
       dev_ratio=FLAGS.dev_ratio,
-      prevent_leaks=FLAGS.prevent_leaks)
+      train_file=train_ratings_file,
+      dev_file=dev_ratings_file,
+      prevent_leaks=FLAGS.prevent_leaks,
+      num_workers=FLAGS.wmt_import_workers)
 
   logging.info("\n*** Creating test data. ***")
-  db_builder.create_wmt_dataset(test_ratings_file, FLAGS.test_years,
-                                FLAGS.target_language)
-  db_builder.postprocess(
-      test_ratings_file, average_duplicates=FLAGS.average_duplicates_on_test)
+  db_builder.build_wmt_dataset(
+      test_ratings_file,
+      FLAGS.test_years,
+      FLAGS.target_language,
+      average_duplicates=FLAGS.average_duplicates_on_test,
+      num_workers=FLAGS.wmt_import_workers)
 
   # Trains BLEURT.
   logging.info("\n*** Training BLEURT. ***")
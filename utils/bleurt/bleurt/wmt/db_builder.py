@@ -16,7 +16,11 @@ r"""Library to build download and aggregate WMT ratings data.
 
 More info about the datasets: https://www.statmt.org/wmt19/metrics-task.html
 """
+import concurrent.futures
+import itertools
+import json
 import os
+import shutil
 import tempfile
 from bleurt.wmt import downloaders
 import pandas as pd
@@ -63,6 +67,10 @@ flags.DEFINE_bool(
     "Prevent leaks when splitting, i.e., train and dev examples with the same "
     "reference sentence.")
 
+flags.DEFINE_integer(
+    "wmt_import_workers", None,
+    "Number of processes importing language pairs. Uses all the CPUs if None.")
+
 WMT_IMPORTERS = {
     "2015": downloaders.Importer1516,
     "2016": downloaders.Importer1516,
@@ -72,7 +80,112 @@ WMT_IMPORTERS = {
 }
 
 
-def create_wmt_dataset(target_file, rating_years, target_language):
+def _import_lang_pair(year, year_directory, lang_pair, shard_file):
+  """Generates the records of a language pair into a shard file."""
+  tmp_file = shard_file + ".tmp"
+  if tf.io.gfile.exists(tmp_file):
+    tf.io.gfile.remove(tmp_file)
+  importer = WMT_IMPORTERS[year](year, year_directory, tmp_file)
+  n_records = importer.generate_records_for_lang(lang_pair)
+  # Only complete shards get their final name, so that they can be cached.
+  tf.io.gfile.rename(tmp_file, shard_file, overwrite=True)
+  return n_records
+
+
+def _shard_directory(importer, year, work_directory):
+  """Directory of the shards of a year, in the cache if there is one."""
+  cache = FLAGS.wmt_cache_dir
+  if cache:
+    checksum = importer.archives_checksum(cache)
+    if checksum:
+      return os.path.join(cache, "shards", "{}-{}".format(year, checksum[:16]))
+  return os.path.join(work_directory, "shards")
+
+
+def import_wmt_shards(rating_years, target_language, work_directory,
+                      num_workers=None):
+  """Imports WMT ratings into one JSONL shard per year and language pair.
+
+  The language pairs are processed in a process pool. If `wmt_cache_dir` is
+  set, the shards are cached next to the archives, keyed by their checksum, and
+  a rerun on the same archives neither extracts nor parses them again.
+
+  Args:
+    rating_years: years of the ratings, e.g. ["2015", "2016"].
+    target_language: two letter code of the target language, or `*`.
+    work_directory: directory where the archives are extracted.
+    num_workers: number of processes, all the CPUs if None.
+
+  Returns:
+    The paths of the shards, sorted by language pair and year.
+  """
+  tasks, shards = [], []
+  for year_ix, year in enumerate(rating_years):
+    logging.info("\nProcessing ratings for year {}".format(year))
+    year_directory = os.path.join(work_directory, "wmt" + year)
+    tf.io.gfile.makedirs(year_directory)
+    importer = WMT_IMPORTERS[year](year, year_directory, None)
+
+    # Reuses the shards parsed from the same archives in a previous run.
+    shard_directory = _shard_directory(importer, year, year_directory)
+    manifest_file = os.path.join(shard_directory, "manifest.json")
+    lang_pairs = None
+    if tf.io.gfile.exists(manifest_file):
+      with tf.io.gfile.GFile(manifest_file, "r") as f:
+        lang_pairs = json.load(f)["lang_pairs"]
+
+    def _kept(lang_pairs):
+      return [
+          lang_pair for lang_pair in lang_pairs
+          if target_language == "*" or lang_pair.endswith(target_language)
+      ]
+
+    def _shard_file(lang_pair):
+      return os.path.join(shard_directory, lang_pair + ".jsonl")
+
+    if lang_pairs is None or not all(
+        tf.io.gfile.exists(_shard_file(lang_pair))
+        for lang_pair in _kept(lang_pairs)):
+      importer.fetch_files()
+      lang_pairs = sorted(importer.list_lang_pairs())
+      shard_directory = _shard_directory(importer, year, year_directory)
+      manifest_file = os.path.join(shard_directory, "manifest.json")
+      tf.io.gfile.makedirs(shard_directory)
+      with tf.io.gfile.GFile(manifest_file, "w") as f:
+        json.dump({"year": year, "lang_pairs": lang_pairs}, f)
+    logging.info("Lang pairs found:")
+    logging.info(" ".join(lang_pairs))
+
+    for lang_pair in lang_pairs:
+      if lang_pair not in _kept(lang_pairs):
+        logging.info("Skipping language pair {}".format(lang_pair))
+        continue
+      shard_file = _shard_file(lang_pair)
+      shards.append((lang_pair, year_ix, shard_file))
+      if tf.io.gfile.exists(shard_file):
+        logging.info("Found cached records for {} and language pair {}".format(
+            year, lang_pair))
+        continue
+      tasks.append((year, year_directory, lang_pair, shard_file))
+
+  logging.info("Generating records for {} language pairs.".format(len(tasks)))
+  if num_workers == 1:
+    n_records = [_import_lang_pair(*task) for task in tasks]
+  else:
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+      futures = [executor.submit(_import_lang_pair, *task) for task in tasks]
+      n_records = [future.result() for future in futures]
+  for task, n in zip(tasks, n_records):
+    logging.info("Imported {} records for {} and language pair {}.".format(
+        n, task[0], task[2]))
+
+  return [shard_file for _, _, shard_file in sorted(shards)]
+
+
+def create_wmt_dataset(target_file,
+                       rating_years,
+                       target_language,
+                       num_workers=None):
   """Creates a JSONL file for a given set of years and a target language."""
   logging.info("*** Downloading ratings data from WMT.")
   assert target_file
@@ -87,36 +200,44 @@ def create_wmt_dataset(target_file, rating_years, target_language):
 
   with tempfile.TemporaryDirectory(dir=FLAGS.temp_directory) as tmpdir:
     logging.info("Using tmp directory: {}".format(tmpdir))
+    shard_files = import_wmt_shards(rating_years, target_language, tmpdir,
+                                    num_workers)
+
+    logging.info("Concatenating {} shards...".format(len(shard_files)))
+    with tf.io.gfile.GFile(target_file, "w") as dest_file:
+      for shard_file in shard_files:
+        with tf.io.gfile.GFile(shard_file, "r") as f:
+          shutil.copyfileobj(f, dest_file)
+    logging.info("Done.")
+  return shard_files
 
-    n_records_total = 0
-    for year in rating_years:
-      logging.info("\nProcessing ratings for year {}".format(year))
-      tmp_file = os.path.join(tmpdir, "tmp_ratings.json")
 
-      # Builds an importer.
-      importer_class = WMT_IMPORTERS[year]
-      importer = importer_class(year, tmpdir, tmp_file)
-      importer.fetch_files()
-      lang_pairs = importer.list_lang_pairs()
-      logging.info("Lang pairs found:")
-      logging.info(" ".join(lang_pairs))
+def _postprocess_df(ratings_df, remove_null_refs=True, average_duplicates=True):
+  """Cleans a DataFrame of ratings downloaded from WMT."""
+  # ratings_df = ratings_df[["lang", "reference", "candidate", "rating"]]
+  ratings_df = ratings_df.rename(columns={"rating": "score"})
 
-      for lang_pair in lang_pairs:
+  if remove_null_refs:
+    ratings_df = ratings_df[ratings_df["reference"].notnull()]
 
-        if target_language != "*" and not lang_pair.endswith(target_language):
-          logging.info("Skipping language pair {}".format(lang_pair))
-          continue
+  if average_duplicates and not ratings_df.empty:
+    ratings_df = ratings_df.groupby(by=["lang", "candidate", "reference"]).agg({
+        "source": "first",
+        "year": "first",
+        "n_ratings": "first",
+        "system": "first",
+        "segment_id": "first",
+        "raw_rating": "mean",
+        "score": "mean",
+    }).reset_index()
+    ratings_df = ratings_df.sort_values(["lang", "reference", "candidate"])
+  return ratings_df
 
-        logging.info("Generating records for {} and language pair {}".format(
-            year, lang_pair))
-        n_records = importer.generate_records_for_lang(lang_pair)
-        logging.info("Imported {} records.".format(str(n_records)))
-        n_records_total += n_records
 
-    logging.info("Done processing {} elements".format(n_records_total))
-    logging.info("Copying temp file...")
-    tf.io.gfile.copy(tmp_file, target_file, overwrite=True)
-    logging.info("Done.")
+def _warn_average_duplicates():
+  logging.warning(
+      "*** WARNING! Averaging duplicates will collapse system names for the same candidate and reference pair, leaving only the first system name in the resulting file. This behavior is non-deterministic and may result in inaccurate results."
+  )
 
 
 def postprocess(target_file, remove_null_refs=True, average_duplicates=True):
@@ -129,27 +250,11 @@ def postprocess(target_file, remove_null_refs=True, average_duplicates=True):
   logging.info("Reading and processing wmt data...")
   with tf.io.gfile.GFile(base_file, "r") as f:
     ratings_df = pd.read_json(f, lines=True)
-  # ratings_df = ratings_df[["lang", "reference", "candidate", "rating"]]
-  ratings_df.rename(columns={"rating": "score"}, inplace=True)
-
-  if remove_null_refs:
-    ratings_df = ratings_df[ratings_df["reference"].notnull()]
-    assert not ratings_df.empty
-
   if average_duplicates:
-    logging.warning(
-        "*** WARNING! Averaging duplicates will collapse system names for the same candidate and reference pair, leaving only the first system name in the resulting file. This behavior is non-deterministic and may result in inaccurate results."
-    )
-    ratings_df = ratings_df.groupby(by=["lang", "candidate", "reference"]).agg({
-        "source": "first",
-        "year": "first",
-        "n_ratings": "first",
-        "system": "first",
-        "segment_id": "first",
-        "raw_rating": "mean",
-        "score": "mean",
-    }).reset_index()
-    ratings_df = ratings_df.sort_values(["lang", "reference", "candidate"])
+    _warn_average_duplicates()
+  ratings_df = _postprocess_df(ratings_df, remove_null_refs,
+                               average_duplicates)
+  assert not ratings_df.empty
 
   logging.info("Saving clean file.")
   with tf.io.gfile.GFile(target_file, "w+") as f:
@@ -158,6 +263,55 @@ def postprocess(target_file, remove_null_refs=True, average_duplicates=True):
   tf.io.gfile.remove(base_file)
 
 
+def postprocess_shards(shard_files,
+                       remove_null_refs=True,
+                       average_duplicates=True):
+  """Postprocesses shards of WMT ratings one language pair at a time.
+
+  The shards must be sorted by language pair (see `import_wmt_shards`). Since
+  duplicates are only averaged within a language pair, the concatenation of
+  the yielded DataFrames equals `postprocess` on the concatenated shards.
+
+  Args:
+    shard_files: JSONL shards named after their language pair.
+    remove_null_refs: whether to remove the ratings without reference.
+    average_duplicates: whether to average the ratings of the same translation.
+
+  Yields:
+    A DataFrame of clean ratings per language pair.
+  """
+  if average_duplicates:
+    _warn_average_duplicates()
+
+  def _lang_pair(shard_file):
+    return os.path.splitext(os.path.basename(shard_file))[0]
+
+  n_ratings = 0
+  for lang_pair, lang_shards in itertools.groupby(shard_files, key=_lang_pair):
+    lang_dfs = []
+    for shard_file in lang_shards:
+      if tf.io.gfile.stat(shard_file).length == 0:
+        continue
+      with tf.io.gfile.GFile(shard_file, "r") as f:
+        lang_dfs.append(pd.read_json(f, lines=True))
+    if not lang_dfs:
+      continue
+    logging.info("Processing ratings for language pair {}".format(lang_pair))
+    ratings_df = _postprocess_df(
+        pd.concat(lang_dfs, ignore_index=True), remove_null_refs,
+        average_duplicates)
+    if ratings_df.empty:
+      continue
+    n_ratings += len(ratings_df)
+    yield ratings_df
+  assert n_ratings > 0, "No WMT ratings left after post-processing."
+
+
+def _to_json_lines(ratings_df):
+  return ratings_df.to_json(orient="records", lines=True).rstrip("\n").split(
+      "\n")
+
+
 def _shuffle_no_leak(all_ratings_df, n_train):
   """Splits and shuffles such that there is no train/dev example with the same ref."""
 
@@ -216,6 +370,21 @@ def _shuffle_leaky(all_ratings_df, n_train):
   return train_ratings_df, dev_ratings_df
 
 
+def _split(ratings_df, dev_ratio, prevent_leaks):
+  """Shuffles and splits a DataFrame of ratings into train/dev."""
+  logging.info("Doing the shuffle / split.")
+  n_rows, n_train = len(ratings_df), int((1 - dev_ratio) * len(ratings_df))
+  logging.info("Will attempt to set aside {} out of {} rows for dev.".format(
+      n_rows - n_train, n_rows))
+  if prevent_leaks:
+    train_df, dev_df = _shuffle_no_leak(ratings_df, n_train)
+  else:
+    train_df, dev_df = _shuffle_leaky(ratings_df, n_train)
+  logging.info("Created train and dev files with {} and {} records.".format(
+      len(train_df), len(dev_df)))
+  return train_df, dev_df
+
+
 def shuffle_split(ratings_file,
                   train_file=None,
                   dev_file=None,
@@ -232,16 +401,7 @@ def shuffle_split(ratings_file,
   with tf.io.gfile.GFile(base_file, "r") as f:
     ratings_df = pd.read_json(f, lines=True)
 
-  logging.info("Doing the shuffle / split.")
-  n_rows, n_train = len(ratings_df), int((1 - dev_ratio) * len(ratings_df))
-  logging.info("Will attempt to set aside {} out of {} rows for dev.".format(
-      n_rows - n_train, n_rows))
-  if prevent_leaks:
-    train_df, dev_df = _shuffle_no_leak(ratings_df, n_train)
-  else:
-    train_df, dev_df = _shuffle_leaky(ratings_df, n_train)
-  logging.info("Created train and dev files with {} and {} records.".format(
-      len(train_df), len(dev_df)))
+  train_df, dev_df = _split(ratings_df, dev_ratio, prevent_leaks)
 
   logging.info("Saving clean file.")
   if not train_file:
@@ -257,15 +417,85 @@ def shuffle_split(ratings_file,
   tf.io.gfile.remove(base_file)
 
 
+def build_wmt_dataset(target_file,
+                      rating_years,
+                      target_language,
+                      average_duplicates=True,
+                      dev_ratio=None,
+                      train_file=None,
+                      dev_file=None,
+                      prevent_leaks=True,
+                      num_workers=None):
+  """Imports, post-processes and optionally splits WMT ratings.
+
+  Same output as `create_wmt_dataset`, `postprocess` and `shuffle_split` in a
+  row, but the language pairs are imported in parallel into (cached) shards
+  and post-processed shard by shard, without writing and re-reading the raw
+  and clean ratings as single files.
+
+  Args:
+    target_file: JSONL file of clean ratings to be created.
+    rating_years: years of the ratings, e.g. ["2015", "2016"].
+    target_language: two letter code of the target language, or `*`.
+    average_duplicates: whether to average the ratings of the same translation.
+    dev_ratio: ratio of data allocated to dev set. No split if None.
+    train_file: train split, `target_file` + "_train" if None.
+    dev_file: dev split, `target_file` + "_dev" if None.
+    prevent_leaks: whether to prevent train and dev examples with the same
+      reference sentence.
+    num_workers: number of processes importing language pairs.
+  """
+  assert rating_years, "No target year detected."
+  for year in rating_years:
+    assert year in WMT_IMPORTERS, "No importer for year {}.".format(year)
+  assert target_language == "*" or len(target_language) == 2, \
+      "target_language must be a two-letter language code or `*`."
+
+  with tempfile.TemporaryDirectory(dir=FLAGS.temp_directory) as tmpdir:
+    logging.info("Using tmp directory: {}".format(tmpdir))
+    shard_files = import_wmt_shards(rating_years, target_language, tmpdir,
+                                    num_workers)
+    ratings_dfs = postprocess_shards(
+        shard_files, average_duplicates=average_duplicates)
+
+    if not dev_ratio:
+      logging.info("Saving clean file.")
+      with tf.io.gfile.GFile(target_file, "w+") as f:
+        for ratings_df in ratings_dfs:
+          f.write("\n".join(_to_json_lines(ratings_df)) + "\n")
+      return
+
+    # Only the serialized records and their references are kept for the
+    # split, which depends on nothing else.
+    lines, references = [], []
+    for ratings_df in ratings_dfs:
+      lines.extend(_to_json_lines(ratings_df))
+      references.extend(ratings_df["reference"].tolist())
+
+  logging.info("\n*** Splitting WMT data in train/dev.")
+  lines_df = pd.DataFrame({"reference": references, "__line__": lines})
+  train_df, dev_df = _split(lines_df, dev_ratio, prevent_leaks)
+
+  logging.info("Saving clean file.")
+  if not train_file:
+    train_file = target_file + "_train"
+  with tf.io.gfile.GFile(train_file, "w+") as f:
+    f.write("\n".join(train_df["__line__"]) + "\n")
+  if not dev_file:
+    dev_file = target_file + "_dev"
+  with tf.io.gfile.GFile(dev_file, "w+") as f:
+    f.write("\n".join(dev_df["__line__"]) + "\n")
+
+
 def main(_):
-  create_wmt_dataset(FLAGS.target_file, FLAGS.rating_years,
-                     FLAGS.target_language)
-  postprocess(FLAGS.target_file, average_duplicates=FLAGS.average_duplicates)
-  if FLAGS.dev_ratio:
-    shuffle_split(
-        FLAGS.target_file,
-        dev_ratio=FLAGS.dev_ratio,
-        prevent_leaks=FLAGS.prevent_leaks)
+  build_wmt_dataset(
+      FLAGS.target_file,
+      FLAGS.rating_years,
+      FLAGS.target_language,
+      average_duplicates=FLAGS.average_duplicates,
+      dev_ratio=FLAGS.dev_ratio,
+      prevent_leaks=FLAGS.prevent_leaks,
+      num_workers=FLAGS.wmt_import_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Tests for the WMT import pipeline, on local archives."""
+import json
+import os
+import tarfile
+import tempfile
+
+from bleurt.wmt import db_builder
+from bleurt.wmt import downloaders
+import tensorflow.compat.v1 as tf
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+
+# Ratings of a tiny WMT15 archive, in the DAseg format.
+segments = {
+    "de-en": [
+        ("Ein Apfel am Tag.", "An apple a day.", "One apple a day.", "0.5"),
+        ("Ein Apfel am Tag.", "An apple a day.", "One apple a day.", "0.7"),
+        ("Hallo Welt.", "Hello world.", "Hello world.", "1.0"),
+        ("Guten Morgen.", "Good morning.", "Good tomorrow.", "-0.3"),
+    ],
+    "fr-en": [
+        ("Bonjour.", "Hello.", "Good day.", "0.1"),
+        ("Merci.", "Thank you.", "Thanks.", "0.8"),
+    ],
+    "en-de": [
+        ("Thank you.", "Danke.", "Danke schoen.", "0.2"),
+    ],
+}
+
+
+def make_wmt15_archive(cache_dir):
+  """Writes a DAseg archive for 2015 in `cache_dir`."""
+  folder_name, archive_name, _ = downloaders.WMT_LOCATIONS[2015]["eval_data"]
+  with tempfile.TemporaryDirectory() as tmpdir:
+    folder = os.path.join(tmpdir, folder_name)
+    os.makedirs(folder)
+    for lang, rows in segments.items():
+      for column, file_type in enumerate(
+          ["source", "reference", "mt-system", "human"]):
+        file_name = "DAseg.newstest2015.{}.{}".format(file_type, lang)
+        with open(os.path.join(folder, file_name), "w") as f:
+          f.write("".join(row[column] + "\n" for row in rows))
+    with tarfile.open(os.path.join(cache_dir, archive_name), "w:gz") as tar:
+      tar.add(folder, arcname=folder_name)
+
+
+def read_jsonl(path):
+  with tf.io.gfile.GFile(path, "r") as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+class DbBuilderTest(tf.test.TestCase):
+
+  def setUp(self):
+    # Saves default FLAG values.
+    super(DbBuilderTest, self).setUp()
+    self._old_flags_val = (FLAGS.wmt_cache_dir, FLAGS.temp_directory,
+                           FLAGS.target_file)
+    self._fetch_files = downloaders.WMTImporter.fetch_files
+
+  def tearDown(self):
+    # Restores default FLAG values.
+    (FLAGS.wmt_cache_dir, FLAGS.temp_directory,
+     FLAGS.target_file) = self._old_flags_val
+    downloaders.WMTImporter.fetch_files = self._fetch_files
+    super(DbBuilderTest, self).tearDown()
+
+  def test_import_is_cached(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      FLAGS.wmt_cache_dir = cache_dir
+      make_wmt15_archive(cache_dir)
+
+      with tempfile.TemporaryDirectory() as work_dir:
+        shard_files = db_builder.import_wmt_shards(["2015"], "en", work_dir,
+                                                   num_workers=2)
+        self.assertEqual([os.path.basename(f) for f in shard_files],
+                         ["de-en.jsonl", "fr-en.jsonl"])
+        ratings = [read_jsonl(f) for f in shard_files]
+        self.assertLen(ratings[0], 4)
+        self.assertLen(ratings[1], 2)
+
+      # The second import must not extract nor parse the archive.
+      def fail_fetch(_):
+        raise AssertionError("The archives should not be fetched again.")
+
+      downloaders.WMTImporter.fetch_files = fail_fetch
+      with tempfile.TemporaryDirectory() as work_dir:
+        cached_files = db_builder.import_wmt_shards(["2015"], "en", work_dir,
+                                                    num_workers=1)
+        self.assertEqual(cached_files, shard_files)
+        self.assertEqual([read_jsonl(f) for f in cached_files], ratings)
+
+  def test_build_matches_file_pipeline(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      FLAGS.wmt_cache_dir = cache_dir
+      make_wmt15_archive(cache_dir)
+      sharded_file = os.path.join(cache_dir, "sharded.jsonl")
+      db_builder.build_wmt_dataset(
+          sharded_file, ["2015"], "en", num_workers=1)
+      self.assertLen(read_jsonl(sharded_file), 5)
+
+      FLAGS.target_file = os.path.join(cache_dir, "ratings.jsonl")
+      db_builder.create_wmt_dataset(
+          FLAGS.target_file, ["2015"], "en", num_workers=1)
+      db_builder.postprocess(FLAGS.target_file)
+      self.assertEqual(read_jsonl(sharded_file), read_jsonl(FLAGS.target_file))
+
+  def test_build_split(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      FLAGS.wmt_cache_dir = cache_dir
+      make_wmt15_archive(cache_dir)
+      target_file = os.path.join(cache_dir, "ratings.jsonl")
+      db_builder.build_wmt_dataset(
+          target_file, ["2015"], "*", dev_ratio=0.4, num_workers=1)
+      train = read_jsonl(target_file + "_train")
+      dev = read_jsonl(target_file + "_dev")
+      self.assertLen(train + dev, 6)
+      self.assertEmpty({r["reference"] for r in train} &
+                       {r["reference"] for r in dev})
+
+
+if __name__ == "__main__":
+  tf.test.main()
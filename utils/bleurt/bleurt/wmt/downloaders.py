@@ -20,12 +20,14 @@ import abc
 import collections
 import glob
 import gzip
+import hashlib
 import itertools
 import json
 import os
 import re
 import shutil
 import tarfile
+from bleurt import encoding
 import numpy as np
 
 import six
@@ -144,6 +146,26 @@ class WMTImporter(object):
         tf.io.gfile.copy(download_path, cache_path, overwrite=True)
         logging.info("Done.")
 
+  def archives_checksum(self, directory):
+    """Checksum of the importer and of the year's archives in `directory`.
+
+    Identifies the records the importer generates from these archives.
+
+    Args:
+      directory: folder containing the archives, e.g., the WMT cache.
+
+    Returns:
+      A hex digest, or None if an archive is missing from `directory`.
+    """
+    sha = hashlib.sha256(type(self).__name__.encode("utf-8"))
+    for file_type in sorted(self.location_info):
+      _, archive_name, _ = self.location_info[file_type]
+      archive_path = os.path.join(directory, archive_name)
+      if not tf.io.gfile.exists(archive_path):
+        return None
+      sha.update(encoding.file_checksum(archive_path).encode("utf-8"))
+    return sha.hexdigest()
+
   def list_lang_pairs(self):
     """List all language pairs included in the WMT files for the target year."""
     pass
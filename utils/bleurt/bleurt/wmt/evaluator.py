@@ -14,6 +14,7 @@
 # limitations under the License.
 """Computes correlation betweem BLEURT and human ratings on a test file from WMT."""
 import collections
+import concurrent.futures
 import json
 
 from bleurt import score
@@ -48,6 +49,11 @@ flags.DEFINE_integer(
 
 flags.DEFINE_boolean("to_english", False, "To-English language pairs only.")
 
+flags.DEFINE_integer(
+    "wmt_kendall_workers", 1,
+    "Number of processes computing WMT's Kendall variant over the groups of "
+    "translations of each reference.")
+
 
 def kendall(pred, ref):
   return stats.kendalltau(pred, ref)[0]
@@ -61,26 +67,50 @@ def spearman(pred, ref):
   return stats.spearmanr(pred, ref)[0]
 
 
-def grouped_wmt_kendall(df, year=2019, threshold=25):
+def grouped_wmt_kendall(df, year=2019, threshold=25, num_workers=1):
   """Groups translations by source and computes WMT's Kendall variant."""
 
   tf.logging.debug("Subset size: {}".format(len(df.index)))
   n_sentences = df["reference"].nunique()
   tf.logging.debug("Number of reference sentences: {}".format(n_sentences))
-  df = df.dropna(subset=["bleurt"])
-  groups = df.groupby(["reference"])
+  df = df.dropna(subset=["bleurt", "reference"])
+
+  # Splits the ratings by reference with one sort, rather than going through
+  # a DataFrame per group.
+  group_ids, _ = pd.factorize(df["reference"])
+  order = np.argsort(group_ids, kind="stable")
+  boundaries = np.flatnonzero(np.diff(group_ids[order])) + 1
+  raw_ratings = np.split(df["raw_rating"].to_numpy()[order], boundaries)
+  predictions = np.split(df["bleurt"].to_numpy()[order], boundaries)
 
-  agreement, n_pairs, n_skipped = 0, 0, 0
   n_kept_groups, n_skipped_groups = 0, 0
-  for _, group_df in groups:
+  group_ratings = []
+  for group_raw_ratings, group_predictions in zip(raw_ratings, predictions):
 
-    if len(group_df.index) == 1:
-      n_skipped_groups += 1
+    if len(group_raw_ratings) <= 1:
+      n_skipped_groups += len(group_raw_ratings)
       continue
 
     n_kept_groups += 1
-    local_agreement, local_n_pairs, local_n_skipped = wmt_kendall(
-        group_df, year, threshold, return_counts=True)
+    group_ratings.append((group_raw_ratings, group_predictions))
+
+  if num_workers > 1 and len(group_ratings) > 1:
+    chunksize = max(1, len(group_ratings) // (4 * num_workers))
+    with concurrent.futures.ProcessPoolExecutor(num_workers) as executor:
+      group_counts = list(
+          executor.map(
+              wmt_kendall_counts, [ratings[0] for ratings in group_ratings],
+              [ratings[1] for ratings in group_ratings],
+              [year] * len(group_ratings), [threshold] * len(group_ratings),
+              chunksize=chunksize))
+  else:
+    group_counts = [
+        wmt_kendall_counts(raw_ratings, predictions, year, threshold)
+        for raw_ratings, predictions in group_ratings
+    ]
+
+  agreement, n_pairs, n_skipped = 0, 0, 0
+  for local_agreement, local_n_pairs, local_n_skipped in group_counts:
     if local_agreement is None or local_n_pairs is None or n_skipped is None:
       # return None
       continue
@@ -105,8 +135,48 @@ def grouped_wmt_kendall(df, year=2019, threshold=25):
 def wmt_kendall(df, year=2018, threshold=25, return_counts=False):
   """Implement the variant of Kendall Tau used in the WMT metrics shared task."""
 
-  raw_ratings = df["raw_rating"].to_numpy()
-  predictions = df["bleurt"].to_numpy()
+  agreement, n_pairs, n_skipped = wmt_kendall_counts(
+      df["raw_rating"].to_numpy(), df["bleurt"].to_numpy(), year, threshold)
+
+  if agreement is None:
+    if return_counts:
+      return None, None, None
+    else:
+      return None
+
+  if return_counts:
+    return agreement, n_pairs, n_skipped
+
+  tf.logging.debug("Found {} agreements among {} pairs".format(
+      agreement, n_pairs))
+  return agreement * 1.0 / n_pairs
+
+
+# Groups up to this size are compared all pairs at once with broadcasting,
+# larger ones with the O(n log n) sorting algorithm.
+MAX_BROADCAST_GROUP_SIZE = 1000
+
+
+def wmt_kendall_counts(raw_ratings, predictions, year=2018, threshold=25):
+  """Counts of WMT's Kendall variant over all pairs of ratings.
+
+  A pair of translations is skipped if their human ratings are equal or closer
+  than `threshold`. Otherwise, it counts +1, -1 or the tie weight of the year
+  (see WMT17_TIES_MATRIX and WMT18_TIES_MATRIX) depending on whether the
+  predictions rank it like the human ratings, the other way round, or tie.
+
+  Args:
+    raw_ratings: array of human ratings, non-finite ratings are ignored.
+    predictions: array of metric scores.
+    year: WMT year, which decides the weight of ties.
+    threshold: minimum difference of the human ratings of a pair.
+
+  Returns:
+    A triplet (agreement, n_pairs, n_skipped), or (None, None, None) if there
+    are no finite ratings.
+  """
+  raw_ratings = np.asarray(raw_ratings, dtype=np.float64)
+  predictions = np.asarray(predictions, dtype=np.float64)
 
   finite_ratings = np.isfinite(raw_ratings)
   raw_ratings = raw_ratings[finite_ratings]
@@ -114,62 +184,131 @@ def wmt_kendall(df, year=2018, threshold=25, return_counts=False):
 
   if not raw_ratings.size:
     tf.logging.warn("Cannot compute WMT Kendall variant on null raw ratings.")
-    if return_counts:
-      return None, None, None
-    else:
-      return None
+    return None, None, None
 
   if year < 2018:
     ties_matrix = WMT17_TIES_MATRIX
   else:
     ties_matrix = WMT18_TIES_MATRIX
-  agreement = 0
-  n_pairs = 0
-  n_skipped = 0
-  n_total = 0
   n_items = len(raw_ratings)
   assert len(predictions) == n_items
-  for i in range(n_items - 1):
-    for j in range(i + 1, n_items):
-      n_total += 1
-
-      if (raw_ratings[i] == raw_ratings[j] or threshold is not None and
-          abs(raw_ratings[i] - raw_ratings[j]) < threshold):
-        n_skipped += 1
-        continue
-
-      if raw_ratings[i] < raw_ratings[j]:
-        human_rank = "<"
-      elif raw_ratings[i] == raw_ratings[j]:
-        human_rank = "="
-      elif raw_ratings[i] > raw_ratings[j]:
-        human_rank = ">"
-      else:
-        raise ValueError("Wrong raw_ratings values: {}, {}".format(
-            raw_ratings[i], raw_ratings[j]))
-
-      if predictions[i] < predictions[j]:
-        pred_rank = "<"
-      elif predictions[i] == predictions[j]:
-        pred_rank = "="
-      elif predictions[i] > predictions[j]:
-        pred_rank = ">"
-      else:
-        raise ValueError("Wrong prediction values: {}, {}".format(
-            predictions[i], predictions[j]))
-
-      increment = ties_matrix[(human_rank, pred_rank)]
-      assert increment is not None
-      agreement += increment
-      n_pairs += 1
+  n_total = n_items * (n_items - 1) // 2
 
-  assert n_pairs + n_skipped == n_total
-  if return_counts:
-    return agreement, n_pairs, n_skipped
+  if n_items <= MAX_BROADCAST_GROUP_SIZE:
+    n_concordant, n_discordant, n_ties, has_pair = _broadcast_kendall_counts(
+        raw_ratings, predictions, threshold)
+  else:
+    n_concordant, n_discordant, n_ties, has_pair = _sorted_kendall_counts(
+        raw_ratings, predictions, threshold)
+
+  if np.any(np.isnan(predictions) & has_pair):
+    raise ValueError("Wrong prediction values: {}".format(
+        predictions[np.isnan(predictions) & has_pair]))
+
+  agreement = (ties_matrix[("<", "<")] * n_concordant +
+               ties_matrix[("<", ">")] * n_discordant +
+               ties_matrix[("<", "=")] * n_ties)
+  n_pairs = n_concordant + n_discordant + n_ties
+  n_skipped = n_total - n_pairs
+  return agreement, n_pairs, n_skipped
+
+
+def _broadcast_kendall_counts(raw_ratings, predictions, threshold):
+  """Concordant, discordant and tied pairs, comparing all pairs at once."""
+  rating_diffs = raw_ratings[:, None] - raw_ratings[None, :]
+  skipped = rating_diffs == 0
+  if threshold is not None:
+    skipped |= np.abs(rating_diffs) < threshold
+  counted = np.triu(~skipped, k=1)
+  # Pairs are counted from the upper triangle, the ratings are never equal.
+  agreement = np.sign(rating_diffs) * np.sign(
+      predictions[:, None] - predictions[None, :])
+  n_concordant = int(np.sum(counted & (agreement > 0)))
+  n_discordant = int(np.sum(counted & (agreement < 0)))
+  n_ties = int(np.sum(counted & (agreement == 0)))
+  has_pair = np.any(counted | counted.T, axis=1)
+  return n_concordant, n_discordant, n_ties, has_pair
+
+
+def _first_counted(sorted_ratings, threshold):
+  """For each rating, the first index of the ratings it is compared to.
+
+  With sorted ratings, item i is compared to the items j > i that are at least
+  `threshold` above, which are all the items from the returned index on.
+  """
+  n_items = len(sorted_ratings)
+  if threshold is None or threshold <= 0:
+    return np.searchsorted(sorted_ratings, sorted_ratings, side="right")
+  first = np.searchsorted(
+      sorted_ratings, sorted_ratings + threshold, side="left")
+  # `rating + threshold` is rounded, moves the boundaries to where the exact
+  # test of the pairwise loop, rating_j - rating_i < threshold, switches.
+  indices = np.arange(n_items)
+  while True:
+    down = first > indices + 1
+    down[down] = (sorted_ratings[first[down] - 1] - sorted_ratings[down] >=
+                  threshold)
+    if not down.any():
+      break
+    first[down] -= 1
+  while True:
+    up = first < n_items
+    up[up] = sorted_ratings[first[up]] - sorted_ratings[up] < threshold
+    if not up.any():
+      break
+    first[up] += 1
+  return first
+
+
+def _sorted_kendall_counts(raw_ratings, predictions, threshold):
+  """Concordant, discordant and tied pairs in O(n log n).
+
+  Walks the items by decreasing human rating while inserting the items they
+  are compared to in a Fenwick tree over the prediction ranks, which then
+  counts the higher, lower and equal predictions among them.
+  """
+  n_items = len(raw_ratings)
+  order = np.argsort(raw_ratings, kind="stable")
+  sorted_ratings = raw_ratings[order]
+  first = _first_counted(sorted_ratings, threshold)
+  _, ranks = np.unique(predictions[order], return_inverse=True)
+  ranks = ranks.reshape(-1) + 1
+  n_ranks = int(ranks.max())
+
+  tree = [0] * (n_ranks + 1)
+
+  def _count_up_to(rank):
+    count = 0
+    while rank > 0:
+      count += tree[rank]
+      rank -= rank & -rank
+    return count
+
+  n_concordant, n_discordant, n_ties = 0, 0, 0
+  n_inserted = 0
+  next_insert = n_items
+  for i in range(n_items - 1, -1, -1):
+    while next_insert > first[i]:
+      next_insert -= 1
+      n_inserted += 1
+      rank = int(ranks[next_insert])
+      while rank <= n_ranks:
+        tree[rank] += 1
+        rank += rank & -rank
+    if not n_inserted:
+      continue
+    n_lower = _count_up_to(int(ranks[i]) - 1)
+    n_lower_or_equal = _count_up_to(int(ranks[i]))
+    n_discordant += n_lower
+    n_ties += n_lower_or_equal - n_lower
+    n_concordant += n_inserted - n_lower_or_equal
 
-  tf.logging.debug("Found {} agreements among {} pairs".format(
-      agreement, n_pairs))
-  return agreement * 1.0 / n_pairs
+  # Items compared to a later item, or to an earlier one.
+  has_pair = np.zeros(n_items, dtype=bool)
+  has_pair[order] = ((first < n_items) |
+                     (np.searchsorted(first, np.arange(n_items), side="right")
+                      > 0))
+  return n_concordant, n_discordant, n_ties, has_pair
 
 
 # The WMT Metrics shared tasks used different weighing schemes in 2017 and 2018.
@@ -369,7 +508,9 @@ def run_eval(scoring_fun, test_file, results_json=None, exclude_sys=None):
 
     for metric_name in METRICS:
       if metric_name == "wmt_da_rr_kendall":
-        metric_value = METRICS[metric_name](group_df, year, THRESHOLDS[year])
+        metric_value = METRICS[metric_name](
+            group_df, year, THRESHOLDS[year],
+            num_workers=FLAGS.wmt_kendall_workers)
       else:
         metric_value = METRICS[metric_name](predictions, reference)
       logging.info("** {}: {}".format(metric_name, metric_value))
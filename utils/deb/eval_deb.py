@@ -16,6 +16,7 @@ import argparse
 
 from transformers import AutoTokenizer, RobertaTokenizer, AutoModelWithLMHead, AutoModelForSequenceClassification
 from transformers import RobertaModel, BertModel, BertConfig, BertForNextSentencePrediction
+from utils.Dataset import HistoryTokenizer
 
 
 import matplotlib.pyplot as plt
@@ -51,7 +52,10 @@ import random
 
 # A Class for DEB evaluation on lists of contexts and responses
 class DEB:
-    def __init__(self, deb_ckpt_basepath="./deb/data/deb_model/", is_deb_adversarial=False):
+    def __init__(self, deb_ckpt_basepath="./deb/data/deb_model/", is_deb_adversarial=False, precision="fp32"):
+        """
+        precision: "fp32", or on CPU "bf16" (autocast) / "int8" (dynamically quantized linear layers) for score()
+        """
         if is_deb_adversarial:
             deb_ckpt_dir = os.path.join(deb_ckpt_basepath, "random_and_adversarial")
         else:
@@ -73,23 +77,82 @@ class DEB:
         # print(f"# Using device: {device}")
         core_model.to(device)
 
+        core_model.eval()
+        if precision == "int8":
+            if device.type != "cpu":
+                raise Exception("int8 DEB is only available on CPU")
+            core_model = torch.quantization.quantize_dynamic(core_model, {nn.Linear}, dtype=torch.qint8)
+        elif precision not in ["fp32", "bf16"]:
+            raise Exception(f"Unknown DEB precision {precision}")
+
         self.model = core_model
         self.tokenizer = tokenizer
+        self.history_tokenizer = HistoryTokenizer(tokenizer)
         self.device = device
+        self.precision = precision
+
+    def _forward(self, inputs):
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        with torch.inference_mode():
+            if self.precision == "bf16":
+                with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                    logits = self.model(**inputs).logits
+            else:
+                logits = self.model(**inputs).logits
+        return logits.float()
 
     def evaluate(self, contexts, responses):
         inputs = self.tokenizer(contexts, responses, padding=True, truncation=True, return_tensors='pt')
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        outputs = self.model(**inputs)
+        logits = self._forward(inputs)
         
         # Labels (0: Next sentence, 1: not next sentence)
-        labels = torch.argmax(outputs.logits, axis=-1)
+        labels = torch.argmax(logits, axis=-1)
         # Flip the labels
         labels = 1 - labels
         labels = labels.tolist()
 
         # Probability that it's a valid response
-        probs = F.softmax(outputs.logits, dim=-1)[:, 0].tolist()
+        probs = F.softmax(logits, dim=-1)[:, 0].tolist()
+        return labels, probs
+
+    def score(self, contexts, responses, token_budget=16384, max_batch_size=256, show_progress=True):
+        """
+        Same output as evaluate() for any number of pairs.
+        Pairs are tokenized once, sorted by length and batched under a token budget (batch size x padded
+        length), so short pairs go in large batches and no batch pads to an unrelated long history.
+        Results come back in the original order.
+        Contexts are "\\n"-joined histories: their utterances are tokenized once (see HistoryTokenizer), not once per turn.
+        """
+        encodings = []
+        for context, response in zip(contexts, responses):
+            encoding = self.history_tokenizer.encode_pair(context, response)
+            if encoding is None:
+                encoding = self.tokenizer(context, response, truncation=True)
+            encodings.append(encoding)
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i]["input_ids"]), reverse=True)
+
+        batches = []
+        batch = []
+        for i in order:
+            # Longest first: the first pair of a batch sets its padded length
+            max_len = len(encodings[batch[0]]["input_ids"]) if batch else len(encodings[i]["input_ids"])
+            if batch and ((len(batch) + 1) * max_len > token_budget or len(batch) == max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+
+        labels = [None] * len(encodings)
+        probs = [None] * len(encodings)
+        for batch in tqdm.tqdm(batches, desc="DEB...", disable=not show_progress):
+            inputs = self.tokenizer.pad([encodings[i] for i in batch], return_tensors='pt')
+            logits = self._forward(inputs)
+            batch_labels = (1 - torch.argmax(logits, axis=-1)).tolist()
+            batch_probs = F.softmax(logits, dim=-1)[:, 0].tolist()
+            for j, i in enumerate(batch):
+                labels[i] = batch_labels[j]
+                probs[i] = batch_probs[j]
         return labels, probs
 
 
@@ -0,0 +1,202 @@
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk store of per-token sentence embeddings.
+    embeddings.f16 (float16, memory-mapped) and ids.i32 hold the tokens of all sentences back to back,
+    index.jsonl maps a sentence hash to its (offset, length) in them.
+
+    The index is the source of truth: data is written before its index lines, appends hold an exclusive
+    flock on store.lock and start at the end of the indexed tokens, and whatever lies past them (left by
+    an interrupted append) is truncated away. So several evaluation jobs can share one store.
+    """
+
+    def __init__(self, store_dir, dim):
+        self.store_dir = store_dir
+        self.dim = dim
+        os.makedirs(store_dir, exist_ok=True)
+        self.emb_path = os.path.join(store_dir, "embeddings.f16")
+        self.ids_path = os.path.join(store_dir, "ids.i32")
+        self.index_path = os.path.join(store_dir, "index.jsonl")
+        self.lock_path = os.path.join(store_dir, "store.lock")
+        self.index = {}
+        self.n_tokens = 0
+        self._index_pos = 0
+        self._emb = None
+        self._ids = None
+        with self._locked():
+            self._read_index()
+            self._truncate()
+
+    @staticmethod
+    def key(sentence):
+        return hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+
+    def __contains__(self, sentence):
+        return self.key(sentence) in self.index
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        """Load the complete index lines written since the last call (by this or another process)"""
+        if not os.path.exists(self.index_path):
+            return
+        # Tokens actually on disk, entries past them come from data files truncated by hand
+        on_disk = min(os.path.getsize(self.ids_path) // 4 if os.path.exists(self.ids_path) else 0,
+                      os.path.getsize(self.emb_path) // (2 * self.dim) if os.path.exists(self.emb_path) else 0)
+        with open(self.index_path, "rb") as fp:
+            fp.seek(self._index_pos)
+            for line in fp:
+                # A line without its newline is an interrupted write, truncated by the next append
+                if not line.endswith(b"\n"):
+                    break
+                self._index_pos += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                end = entry["offset"] + entry["length"]
+                if end <= on_disk:
+                    self.index[entry["key"]] = (entry["offset"], entry["length"])
+                    self.n_tokens = max(self.n_tokens, end)
+
+    def _truncate(self):
+        """Cut the data files back to the indexed tokens and the index to its complete lines (lock held)"""
+        for path, size in [(self.emb_path, self.n_tokens * 2 * self.dim), (self.ids_path, self.n_tokens * 4),
+                           (self.index_path, self._index_pos)]:
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+    def _open(self):
+        if self._emb is None and self.n_tokens > 0:
+            self._emb = np.memmap(self.emb_path, dtype=np.float16, mode="r", shape=(self.n_tokens, self.dim))
+            self._ids = np.memmap(self.ids_path, dtype=np.int32, mode="r", shape=(self.n_tokens,))
+
+    def get(self, sentence):
+        """(token ids, embeddings) of a stored sentence"""
+        self._open()
+        offset, length = self.index[self.key(sentence)]
+        return self._ids[offset:offset + length], self._emb[offset:offset + length]
+
+    def add(self, items):
+        """items: list of (sentence, token ids, embeddings), the ones already stored are skipped"""
+        if len(items) == 0:
+            return
+        with self._locked():
+            # Appends of other processes since this store was opened
+            self._read_index()
+            self._truncate()
+            offset = self.n_tokens
+            entries = {}
+            with open(self.emb_path, "ab") as emb_fp, open(self.ids_path, "ab") as ids_fp:
+                for sentence, ids, emb in items:
+                    key = self.key(sentence)
+                    if key in self.index or key in entries:
+                        continue
+                    emb_fp.write(np.ascontiguousarray(emb, dtype=np.float16).tobytes())
+                    ids_fp.write(np.asarray(ids, dtype=np.int32).tobytes())
+                    entries[key] = {"key": key, "offset": offset, "length": len(ids)}
+                    offset += len(ids)
+            with open(self.index_path, "a") as fp:
+                for entry in entries.values():
+                    fp.write(json.dumps(entry) + "\n")
+            self._read_index()
+        # Remap to see the appended tokens
+        self._emb = None
+        self._ids = None
+
+
+class BertScorer:
+    """
+    BERTScore (P/R/F1, no idf, no baseline rescaling) as computed by evaluate's "bertscore" with lang="en":
+    roberta-large truncated to 17 layers, L2-normalized token embeddings, greedy cosine matching,
+    [CLS]/[SEP] weighted 0.
+
+    Reference embeddings are cached on disk (see EmbeddingStore) so each unique reference is encoded once
+    over all output files; predictions are deduplicated and encoded in length-sorted batches.
+    """
+
+    def __init__(self, model_type="roberta-large", num_layers=17, cache_dir="cache/bertscore", batch_size=64, device=None):
+        from transformers import AutoModel, AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_type, use_fast=False)
+        model = AutoModel.from_pretrained(model_type)
+        model.encoder.layer = torch.nn.ModuleList([layer for layer in model.encoder.layer[:num_layers]])
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.model = model.to(device).eval()
+        self.batch_size = batch_size
+        self.special_ids = [self.tokenizer.cls_token_id, self.tokenizer.sep_token_id]
+        store_dir = os.path.join(cache_dir, f"{model_type.replace('/', '__')}_L{num_layers}")
+        self.refs = EmbeddingStore(store_dir, model.config.hidden_size)
+
+    def _encode_ids(self, sentence):
+        # Same tokenization as bert_score's sent_encode for RoBERTa
+        sentence = sentence.strip()
+        if sentence == "":
+            return self.tokenizer.build_inputs_with_special_tokens([])
+        return self.tokenizer.encode(sentence, add_special_tokens=True, add_prefix_space=True,
+                                     max_length=self.tokenizer.model_max_length, truncation=True)
+
+    def encode(self, sentences, desc="BERTScore..."):
+        """{sentence: (token ids, normalized float32 embeddings)} for the unique sentences, longest first in batches"""
+        ids = {sentence: self._encode_ids(sentence) for sentence in set(sentences)}
+        order = sorted(ids, key=lambda sentence: len(ids[sentence]), reverse=True)
+        out = {}
+        with torch.inference_mode():
+            for i in tqdm(range(0, len(order), self.batch_size), desc=desc):
+                batch = order[i:i + self.batch_size]
+                max_len = len(ids[batch[0]])
+                input_ids = torch.full((len(batch), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+                attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+                for j, sentence in enumerate(batch):
+                    input_ids[j, :len(ids[sentence])] = torch.tensor(ids[sentence])
+                    attention_mask[j, :len(ids[sentence])] = 1
+                emb = self.model(input_ids.to(self.device), attention_mask=attention_mask.to(self.device))[0]
+                emb = emb / torch.norm(emb, dim=-1, keepdim=True)
+                emb = emb.float().cpu().numpy()
+                for j, sentence in enumerate(batch):
+                    out[sentence] = (np.asarray(ids[sentence]), emb[j, :len(ids[sentence])])
+        return out
+
+    def _weights(self, ids):
+        return (~np.isin(ids, self.special_ids)).astype(np.float32)
+
+    def score(self, predictions, references):
+        """Returns {"precision", "recall", "f1"}: arrays aligned with the pairs"""
+        new_refs = [ref for ref in set(references) if ref not in self.refs]
+        if len(new_refs) > 0:
+            encoded = self.encode(new_refs, desc="BERTScore references...")
+            self.refs.add([(ref, ids, emb) for ref, (ids, emb) in encoded.items()])
+        hyps = self.encode(predictions, desc="BERTScore predictions...")
+
+        n = len(predictions)
+        P, R, F = np.zeros(n), np.zeros(n), np.zeros(n)
+        for i, (pred, ref) in enumerate(zip(predictions, references)):
+            hyp_ids, hyp_emb = hyps[pred]
+            ref_ids, ref_emb = self.refs.get(ref)
+            hyp_w, ref_w = self._weights(hyp_ids), self._weights(ref_ids)
+            # Empty candidate or reference (only special tokens) scores 0, as in bert_score
+            if hyp_w.sum() == 0 or ref_w.sum() == 0:
+                continue
+            sim = hyp_emb @ ref_emb.astype(np.float32).T
+            P[i] = (sim.max(axis=1) * hyp_w).sum() / hyp_w.sum()
+            R[i] = (sim.max(axis=0) * ref_w).sum() / ref_w.sum()
+            F[i] = 2 * P[i] * R[i] / (P[i] + R[i]) if P[i] + R[i] != 0 else 0.0
+        return {"precision": P, "recall": R, "f1": F}
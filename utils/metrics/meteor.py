@@ -0,0 +1,211 @@
+import os
+import json
+import fcntl
+import tempfile
+
+import numpy as np
+
+
+class MeteorLexicon:
+    """
+    Memoized stem and WordNet synonym lookups per unique token.
+    Filled lazily (or for a whole vocabulary with update()), and optionally persisted to a json file
+    so that the lookups are done once for all output files of a sweep.
+    """
+
+    def __init__(self, path=None, stemmer=None, wordnet=None):
+        if stemmer is None:
+            from nltk.stem.porter import PorterStemmer
+            stemmer = PorterStemmer()
+        if wordnet is None:
+            from nltk.corpus import wordnet
+        self.path = path
+        self.stemmer = stemmer
+        self.wordnet = wordnet
+        self.stems = {}
+        self.synonyms = {}
+        self.dirty = False
+        if path is not None:
+            self.stems, self.synonyms = self._load(path)
+
+    @staticmethod
+    def _load(path):
+        if not os.path.exists(path):
+            return {}, {}
+        with open(path, "r") as fp:
+            saved = json.load(fp)
+        return saved["stems"], {word: frozenset(syns) for word, syns in saved["synonyms"].items()}
+
+    def stem(self, word):
+        if word not in self.stems:
+            self.stems[word] = self.stemmer.stem(word)
+            self.dirty = True
+        return self.stems[word]
+
+    def synonym_set(self, word):
+        """Single-word lemma names of all synsets of word, plus the word itself (as in nltk's meteor_score)"""
+        if word not in self.synonyms:
+            syns = set(lemma.name() for synset in self.wordnet.synsets(word) for lemma in synset.lemmas() if lemma.name().find("_") < 0)
+            syns.add(word)
+            self.synonyms[word] = frozenset(syns)
+            self.dirty = True
+        return self.synonyms[word]
+
+    def update(self, words):
+        """Resolve the stems of words, and the synonyms of their stems (what the synonym stage looks up)"""
+        for word in words:
+            self.synonym_set(self.stem(word))
+
+    def save(self):
+        """
+        Merge the lookups with the ones saved by other processes since this lexicon was loaded, and
+        atomically replace the file (a temp file in the same directory, then os.replace), so that
+        concurrent evaluation jobs neither drop each other's entries nor leave a truncated file.
+        """
+        if self.path is None or not self.dirty:
+            return
+        out_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(out_dir, exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            stems, synonyms = self._load(self.path)
+            stems.update(self.stems)
+            synonyms.update(self.synonyms)
+            self.stems, self.synonyms = stems, synonyms
+            fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as fp:
+                    json.dump({"stems": self.stems, "synonyms": {word: sorted(syns) for word, syns in self.synonyms.items()}}, fp)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        self.dirty = False
+
+
+def _match(hyp, ref, matches):
+    """
+    One alignment stage over the still unmatched (position, word) lists: every hypothesis word, last
+    to first, takes the last unused reference word equal to it (nltk's reverse scan).
+    Returns the unmatched lists.
+    """
+    positions = {}
+    for j, (_, word) in enumerate(ref):
+        positions.setdefault(word, []).append(j)
+    matched_hyp, matched_ref = set(), set()
+    for i in range(len(hyp) - 1, -1, -1):
+        candidates = positions.get(hyp[i][1])
+        if candidates:
+            j = candidates.pop()
+            matched_hyp.add(i)
+            matched_ref.add(j)
+            matches.append((hyp[i][0], ref[j][0]))
+    return [x for i, x in enumerate(hyp) if i not in matched_hyp], [x for j, x in enumerate(ref) if j not in matched_ref]
+
+
+def _count_chunks(matches):
+    chunks = 1
+    for (h0, r0), (h1, r1) in zip(matches, matches[1:]):
+        if not (h1 == h0 + 1 and r1 == r0 + 1):
+            chunks += 1
+    return chunks
+
+
+class Meteor:
+    """
+    Sentence METEOR, equal to nltk's single_meteor_score (as used by evaluate's "meteor" metric):
+    exact, then Porter stem, then WordNet synonym alignment, F-mean with alpha and a fragmentation
+    penalty gamma * (chunks / matches) ** beta.
+    Tokenization and lowercasing are cached per distinct string, stem and synonym lookups per
+    distinct token (see MeteorLexicon), so repeated references and words cost one lookup.
+    """
+
+    def __init__(self, lexicon_path=None, alpha=0.9, beta=3.0, gamma=0.5, tokenizer=None, stemmer=None, wordnet=None, max_cached=500000):
+        if tokenizer is None:
+            from nltk import word_tokenize
+            tokenizer = word_tokenize
+        self.tokenizer = tokenizer
+        self.lexicon = MeteorLexicon(lexicon_path, stemmer=stemmer, wordnet=wordnet)
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self._tokens = {}
+        self.max_cached = max_cached
+
+    def tokenize(self, text):
+        if text not in self._tokens:
+            self._tokens[text] = [token.lower() for token in self.tokenizer(text)]
+        return self._tokens[text]
+
+    def align(self, hyp_tokens, ref_tokens):
+        """Matched (hypothesis position, reference position) pairs over pre-tokenized, lowercased inputs"""
+        matches = []
+        hyp = list(enumerate(hyp_tokens))
+        ref = list(enumerate(ref_tokens))
+        hyp, ref = _match(hyp, ref, matches)
+
+        # The later stages, like nltk, see the stemmed forms of the leftover words
+        hyp = [(i, self.lexicon.stem(word)) for i, word in hyp]
+        ref = [(j, self.lexicon.stem(word)) for j, word in ref]
+        hyp, ref = _match(hyp, ref, matches)
+
+        if len(hyp) > 0 and len(ref) > 0:
+            positions = {}
+            for j, (_, word) in enumerate(ref):
+                positions.setdefault(word, []).append(j)
+            for i in range(len(hyp) - 1, -1, -1):
+                best_j, best_word = -1, None
+                for syn in self.lexicon.synonym_set(hyp[i][1]):
+                    candidates = positions.get(syn)
+                    if candidates and candidates[-1] > best_j:
+                        best_j, best_word = candidates[-1], syn
+                if best_word is not None:
+                    positions[best_word].pop()
+                    matches.append((hyp[i][0], ref[best_j][0]))
+
+        matches.sort(key=lambda pair: pair[0])
+        return matches
+
+    def score_tokens(self, hyp_tokens, ref_tokens):
+        matches = self.align(hyp_tokens, ref_tokens)
+        n_matches = len(matches)
+        if n_matches == 0 or len(hyp_tokens) == 0 or len(ref_tokens) == 0:
+            return 0.0
+        precision = float(n_matches) / len(hyp_tokens)
+        recall = float(n_matches) / len(ref_tokens)
+        fmean = (precision * recall) / (self.alpha * precision + (1 - self.alpha) * recall)
+        frag_frac = float(_count_chunks(matches)) / n_matches
+        penalty = self.gamma * frag_frac ** self.beta
+        return (1 - penalty) * fmean
+
+    def score(self, predictions, references):
+        """METEOR of every (prediction, reference) pair, as an array"""
+        # Predictions are mostly unique to a file, keep the tokenization cache bounded over a sweep
+        if len(self._tokens) > self.max_cached:
+            self._tokens.clear()
+        scores = np.array([self.score_tokens(self.tokenize(pred), self.tokenize(ref)) for pred, ref in zip(predictions, references)])
+        self.lexicon.save()
+        return scores
+
+
+# Unit Test
+if __name__ == "__main__":
+    import time
+    import random
+    from nltk.translate.meteor_score import single_meteor_score
+
+    random.seed(0)
+    words = "The cat cats sat sitting on a mat , . ran running fast quick big large small little red blue".split()
+    predictions = [" ".join(random.choices(words, k=random.randint(0, 20))) for _ in range(3000)]
+    references = [" ".join(random.choices(words, k=random.randint(0, 20))) for _ in range(3000)]
+
+    meteor = Meteor()
+    start = time.time()
+    scores = meteor.score(predictions, references)
+    print(f"{len(predictions)} pairs in {time.time() - start:.3f}s")
+
+    from nltk import word_tokenize
+    for pred, ref, score in zip(predictions, references, scores):
+        expected = single_meteor_score(word_tokenize(ref), word_tokenize(pred), alpha=0.9, beta=3, gamma=0.5)
+        assert abs(score - expected) < 1e-12, (pred, ref, score, expected)
+    print("OK")
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import sqlite3
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class ScoreStore:
+    """
+    Persistent per-pair metric scores, keyed by (metric, metric version, hash(prediction), hash(reference or context)).
+    Every sweep config is scored against the same gold responses, so recurring predictions
+    ("NO RESPONSE", stock replies) and re-evaluated files are looked up instead of recomputed.
+    Scores are written as they are computed, which also makes an interrupted evaluation resumable.
+    """
+
+    def __init__(self, path="cache/scores.sqlite"):
+        self.path = path
+        store_dir = os.path.dirname(path)
+        if store_dir and not os.path.isdir(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores (metric TEXT, version TEXT, pair TEXT, scores TEXT, PRIMARY KEY (metric, version, pair))")
+        self.conn.commit()
+
+    @staticmethod
+    def pair_key(prediction, reference):
+        return text_hash(prediction) + text_hash(reference)
+
+    def get_many(self, metric, version, keys):
+        """Stored scores ({submetric: value}) of the given pair keys, as a dict (misses are absent)"""
+        keys = list(set(keys))
+        found = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = f"SELECT pair, scores FROM scores WHERE metric = ? AND version = ? AND pair IN ({','.join('?' * len(chunk))})"
+            for pair, scores in self.conn.execute(query, [metric, version] + chunk):
+                found[pair] = json.loads(scores)
+        return found
+
+    def put_many(self, metric, version, items):
+        """items: iterable of (pair key, {submetric: value})"""
+        self.conn.executemany("INSERT OR REPLACE INTO scores (metric, version, pair, scores) VALUES (?, ?, ?, ?)",
+                              [(metric, version, pair, json.dumps(scores)) for pair, scores in items])
+        self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+# Unit Test (python -m utils.score_store)
+if __name__ == "__main__":
+    import tempfile
+    from utils.Evaluator import Evaluator
+
+    class WhitespaceTokenizer:
+        # Stands in for the flan-t5 tokenizer of the length metric
+        def __call__(self, text):
+            return {"input_ids": text.split() + ["</s>"]}
+
+    # A "prompt" file and a "prompts" file sharing pairs, and a file without prompts, against one store
+    pairs = [(f"response {i} " + "word " * i, f"prompt {i} " + "context " * (2 * i)) for i in range(10)]
+    expected = {
+        "response_length": [len(response.split()) + 1 for response, _ in pairs],
+        "prompt_length": [len(prompt.split()) + 1 for _, prompt in pairs],
+    }
+    files = [
+        ("prompt", [{"predicted_response": response, "prompt": prompt, "history": ""} for response, prompt in pairs[:6]]),
+        ("prompts", [{"predicted_response": response, "prompts": prompt, "history": ""} for response, prompt in pairs]),
+        ("none", [{"predicted_response": response, "history": ""} for response, _ in pairs]),
+        ("prompt_again", [{"predicted_response": response, "prompt": prompt, "history": ""} for response, prompt in pairs]),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        my_eval = Evaluator(meteor_lexicon=None, score_store=os.path.join(tmp_dir, "scores.sqlite"))
+        my_eval.tokenizer = WhitespaceTokenizer()
+        for name, rows in files:
+            input_file = os.path.join(tmp_dir, name + ".jsonl")
+            with open(input_file, "w") as f:
+                f.write("".join(json.dumps(row) + "\n" for row in rows))
+            res, length, logs = my_eval.compute(input_file, metrics=["length"])
+            n = len(rows)
+            assert res["length"]["response_length"] == expected["response_length"][:n], (name, res["length"])
+            if name == "none":
+                assert "prompt_length" not in res["length"], (name, res["length"])
+            else:
+                assert res["length"]["prompt_length"] == expected["prompt_length"][:n], (name, res["length"])
+        print(f"{len(my_eval.store)} length scores stored")
+        my_eval.close()
+    print("OK")